@@ -0,0 +1,155 @@
+"""
+Sequential vs. async pipelined refresh of every table on synthetic schemas.
+
+For each scale the schemas are built and loaded once, then every engine
+reloads all tables from an empty destination through its incremental path
+(watermarks reset to the start), so each engine does the same work:
+
+    python -m benchmarks.bench_async --dsn postgresql://localhost/scratch \
+        --source-dsn postgresql://localhost/scratch_source --scales 100000 1000000
+
+sequential        refresh_table per spec in dependency order, streaming
+                  through COPY staging (pipe and INSERT ... SELECT off), as
+                  the notebook cells did before the scheduler
+sequential_fast   the same with the sync engine's defaults (piped COPY and
+                  same-database INSERT ... SELECT where the spec allows)
+scheduled         the sync engine on run_dependency_graph threads
+async             refresh_tables_async: one event loop, fetch and load
+                  overlapped through a bounded queue, every table streamed
+async_fast        refresh_tables_async with the sync engine's defaults, as
+                  the notebook runs it: specs with a piped COPY or
+                  INSERT ... SELECT path take it in a worker thread. Only
+                  version has neither, and only with a separate source
+                  database, so async_fast streams at most that one table;
+                  the report lists the streamed specs per scale
+
+--dsn and --source-dsn must be throwaway databases.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+
+import psycopg2
+
+from benchmarks.bench_refresh import bench_pool
+from benchmarks.synthetic import create_destination, create_source, drop_all
+from refresh.async_engine import run_async_refresh, streams
+from refresh.engine import RefreshOptions, ensure_refresh_stores, refresh_table, table_refresh_tasks
+from refresh.scheduler import run_dependency_graph
+from refresh.tables import TABLE_SPECS
+from refresh.watermark import INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, WATERMARK_TABLE
+
+
+def reset_destination(dest_conn):
+    """
+    Empties every refreshed table and rewinds its watermark, so the next run
+    reloads everything through the incremental path rather than a backfill.
+    """
+    with dest_conn.cursor() as dest_cursor:
+        dest_cursor.execute(f"TRUNCATE {', '.join(f'analytical_model.{spec.name}' for spec in TABLE_SPECS)}")
+        dest_cursor.execute(f'''
+            UPDATE analytical_model.{WATERMARK_TABLE} SET watermark_ts = %s, watermark_key = %s
+        ''', (INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY))
+    dest_conn.commit()
+
+
+def run_engine(engine, source_pool, dest_pool, batch_size, max_concurrency, queue_size):
+    stream_options = RefreshOptions(batch_size=batch_size, pipe=False, server_side=False)
+    if engine == "sequential":
+        for spec in TABLE_SPECS:
+            refresh_table(spec, source_pool, dest_pool, stream_options)
+    elif engine == "sequential_fast":
+        for spec in TABLE_SPECS:
+            refresh_table(spec, source_pool, dest_pool, RefreshOptions(batch_size=batch_size))
+    elif engine == "scheduled":
+        tasks, dependencies = table_refresh_tasks(TABLE_SPECS, source_pool, dest_pool, stream_options)
+        _, errors = run_dependency_graph(tasks, dependencies, max_workers=max_concurrency)
+        if errors:
+            raise RuntimeError(f"Scheduled refresh failed for {', '.join(sorted(errors))}")
+    elif engine == "async":
+        run_async_refresh(TABLE_SPECS, source_pool, dest_pool, stream_options, max_concurrency, queue_size)
+    else:
+        run_async_refresh(TABLE_SPECS, source_pool, dest_pool, RefreshOptions(batch_size=batch_size), max_concurrency,
+                          queue_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), required=not os.environ.get("BENCH_DSN"),
+                        help="Throwaway destination Postgres (or set BENCH_DSN)")
+    parser.add_argument("--source-dsn", help="Throwaway source Postgres; defaults to --dsn")
+    parser.add_argument("--scales", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--engines", nargs="+", default=["sequential", "sequential_fast", "scheduled", "async",
+                                                         "async_fast"])
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--report", default="bench_async.json")
+    args = parser.parse_args()
+    source_dsn = args.source_dsn or args.dsn
+
+    source_conn = psycopg2.connect(source_dsn)
+    dest_conn = psycopg2.connect(args.dsn)
+    report = {
+        "started_at": datetime.datetime.utcnow().replace(tzinfo=None).isoformat(),
+        "python": platform.python_version(),
+        "same_database": source_dsn == args.dsn,
+        "options": {"batch_size": args.batch_size, "max_concurrency": args.max_concurrency,
+                    "queue_size": args.queue_size},
+        "results": [],
+    }
+
+    print(f"{'versions':>10} {'engine':>16} {'seconds':>10} {'rows':>10}")
+    for scale in args.scales:
+        with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+            create_source(source_cursor, scale)
+            create_destination(dest_cursor, scale)
+            ensure_refresh_stores(dest_cursor)
+        source_conn.commit()
+        dest_conn.commit()
+
+        source_pool = bench_pool(source_dsn, "source")
+        dest_pool = bench_pool(args.dsn, "dest")
+        # The first load (backfill) leaves every table with a watermark
+        for spec in TABLE_SPECS:
+            refresh_table(spec, source_pool, dest_pool, RefreshOptions())
+
+        streamed = [spec.name for spec in TABLE_SPECS
+                    if streams(spec, source_pool, dest_pool, RefreshOptions(batch_size=args.batch_size))]
+        report.setdefault("async_fast_streamed", {})[scale] = streamed
+        print(f"async_fast streams {', '.join(streamed) or 'no tables'}; the rest run on the sync engine")
+
+        for engine in args.engines:
+            reset_destination(dest_conn)
+            started = time.perf_counter()
+            run_engine(engine, source_pool, dest_pool, args.batch_size, args.max_concurrency, args.queue_size)
+            seconds = time.perf_counter() - started
+
+            with dest_conn.cursor() as dest_cursor:
+                rows = 0
+                for spec in TABLE_SPECS:
+                    dest_cursor.execute(f"SELECT COUNT(*) FROM analytical_model.{spec.name}")
+                    rows += dest_cursor.fetchone()[0]
+            dest_conn.rollback()
+            report["results"].append({"scale": scale, "engine": engine, "seconds": round(seconds, 4), "rows": rows})
+            print(f"{scale:>10} {engine:>16} {seconds:>10.3f} {rows:>10}")
+
+        source_pool.closeall()
+        dest_pool.closeall()
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+        drop_all(source_cursor, dest_cursor)
+    source_conn.commit()
+    dest_conn.commit()
+    source_conn.close()
+    dest_conn.close()
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Rows/sec of the COPY staging loader against the old executemany upsert.
+
+Runs against a throwaway Postgres, never the production databases:
+
+    python -m benchmarks.bench_bulk_load --dsn postgresql://localhost/scratch
+"""
+import argparse
+import datetime
+import os
+import time
+
+import psycopg2
+
+from refresh.bulk_load import copy_upsert
+
+BENCH_SCHEMA = "bench_bulk_load"
+TABLE_NAME = "campaign"
+KEY = "id_campaign"
+
+
+def make_rows(count, offset=0):
+    """
+    Builds synthetic rows shaped like the campaign source query.
+    """
+    start = datetime.date(2024, 1, 1)
+    modified = datetime.datetime(2025, 1, 1, 12, 0, 0)
+    return [
+        (
+            i,
+            f"Campaign {i}",
+            f"Members with upcoming arrivals {i % 97}",
+            '',
+            "Active" if i % 3 else "Draft",
+            start,
+            start + datetime.timedelta(days=30),
+            start,
+            start + datetime.timedelta(days=30 + offset),
+            modified + datetime.timedelta(seconds=i),
+        )
+        for i in range(1, count + 1)
+    ]
+
+
+COLUMNS = [
+    "id_campaign", "campaign_name", "audience_desc", "primary_objective", "status",
+    "planned_start_dte", "planned_end_dte", "actual_start_dte", "actual_end_dte",
+    "modified_ts",
+]
+
+
+def reset_table(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {BENCH_SCHEMA}")
+        cursor.execute(f"DROP TABLE IF EXISTS {BENCH_SCHEMA}.{TABLE_NAME}")
+        cursor.execute(f'''
+            CREATE TABLE {BENCH_SCHEMA}.{TABLE_NAME} (
+                id_campaign int8 PRIMARY KEY,
+                campaign_name text,
+                audience_desc text,
+                primary_objective text,
+                status text,
+                planned_start_dte date,
+                planned_end_dte date,
+                actual_start_dte date,
+                actual_end_dte date,
+                modified_ts timestamp
+            )
+        ''')
+    conn.commit()
+
+
+def executemany_upsert(conn, rows):
+    """
+    The per-row upsert the notebook cells used before the COPY loader.
+    """
+    column_names = ', '.join(COLUMNS)
+    placeholders = ', '.join(['%s'] * len(COLUMNS))
+    update_clause = ', '.join([f"{col} = EXCLUDED.{col}" for col in COLUMNS if col != KEY])
+    upsert_query = f'''
+        INSERT INTO {BENCH_SCHEMA}.{TABLE_NAME} ({column_names})
+        VALUES ({placeholders})
+        ON CONFLICT ({KEY}) DO UPDATE SET {update_clause};
+    '''
+    with conn.cursor() as cursor:
+        cursor.executemany(upsert_query, rows)
+
+
+def copy_staging_upsert(conn, rows):
+    copy_upsert(conn, TABLE_NAME, KEY, COLUMNS, rows, schema=BENCH_SCHEMA)
+
+
+def time_load(conn, loader, rows):
+    started = time.perf_counter()
+    loader(conn, rows)
+    conn.commit()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), required=not os.environ.get("BENCH_DSN"),
+                        help="Throwaway Postgres to benchmark against (or set BENCH_DSN)")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    loaders = [("executemany", executemany_upsert), ("copy_staging", copy_staging_upsert)]
+
+    print(f"{'rows':>10} {'loader':>14} {'insert rows/s':>15} {'update rows/s':>15}")
+    for count in args.rows:
+        for loader_name, loader in loaders:
+            reset_table(conn)
+            # First pass inserts fresh keys, second pass hits ON CONFLICT for every row
+            insert_secs = time_load(conn, loader, make_rows(count))
+            update_secs = time_load(conn, loader, make_rows(count, offset=1))
+            print(f"{count:>10} {loader_name:>14} {count / insert_secs:>15,.0f} {count / update_secs:>15,.0f}")
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA {BENCH_SCHEMA} CASCADE")
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
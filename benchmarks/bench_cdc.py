@@ -0,0 +1,206 @@
+"""
+Change capture latency: how long committed source changes take to reach
+analytical_model through the logical replication slot.
+
+For each scale the synthetic schemas are built, a slot is created and the
+tables are loaded once by polling (run_cdc). The consumer then keeps
+running while rounds of source transactions update, insert and delete
+rows across the paign_*/cf_* tables; each round ends by renaming a marker
+campaign, and its latency is the time until the marker is visible in
+analytical_model.campaign. Afterwards every change-captured table is
+compared with a fresh read of its whole source query:
+
+    python -m benchmarks.bench_cdc --dsn postgresql://localhost/scratch \
+        --source-dsn postgresql://localhost/scratch_source --scales 100000
+
+The source must run with wal_level=logical. --dsn and --source-dsn must be
+throwaway databases.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import threading
+import time
+
+import psycopg2
+
+from benchmarks.bench_refresh import bench_pool
+from benchmarks.synthetic import SOURCE_SCHEMA, create_destination, create_source, drop_all, scale_counts
+from refresh.backfill import key_range_params
+from refresh.cdc import cdc_targets, drop_cdc_source, ensure_cdc_store, run_cdc
+from refresh.engine import RefreshOptions, ensure_refresh_stores
+from refresh.exclusions import read_exclusions
+from refresh.partitioned import partition_params
+from refresh.tables import TABLE_SPECS
+from refresh.watermark import INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, watermark_params
+
+# Columns left out of the comparison: positions are numbered within each extraction
+IGNORED_COLUMNS = {"position_row", "position_column"}
+
+
+def change_round(source_cursor, versions, round_no, fraction=0.001):
+    """
+    One source transaction's worth of edits, ending with the marker campaign rename.
+    """
+    n = scale_counts(versions)
+    step = max(int(1 / fraction), 1)
+    offset = round_no * 7
+    source_cursor.execute(f'''
+        SET LOCAL search_path = {SOURCE_SCHEMA};
+        UPDATE paign_placement_version SET name = name || ' r{round_no}', update_dt = LOCALTIMESTAMP
+        WHERE id % {step} = {offset % step};
+        DELETE FROM paign_placement_version WHERE id % {step * 5} = {(offset + 1) % (step * 5)};
+        UPDATE paign_placement_version SET tactic_id = 1 + tactic_id % {n["tactic"]}, update_dt = LOCALTIMESTAMP
+        WHERE id % {step * 3} = {(offset + 2) % (step * 3)};
+        INSERT INTO paign_module_link_ids_prod
+        SELECT id + {n["link"] * (round_no + 1)}, tactic_id, module_id, original_url || '/r{round_no}', final_url,
+               linked_text, bit_type_name, LOCALTIMESTAMP, false
+        FROM paign_module_link_ids_prod WHERE id % {step} = {(offset + 3) % step} AND id <= {n["link"]};
+        DELETE FROM paign_module_link_ids_prod WHERE id % {step * 2} = {(offset + 4) % (step * 2)};
+        UPDATE paign_module_link_ids_prod SET outdated_flag = NOT outdated_flag
+        WHERE id % {step * 2} = {(offset + 5) % (step * 2)};
+        UPDATE cf_modules SET content_group_id = 1 + content_group_id % {n["content_group"]}
+        WHERE id = {1 + round_no % n["module"]};
+        UPDATE audience_segment_placement_versions SET audiencesegment_id = audiencesegment_id + 1
+        WHERE placementversion_id % {step} = {(offset + 6) % step};
+        DELETE FROM paign_default_offer WHERE id = {n["offer"] - round_no};
+        UPDATE paign_default_campaign SET name = 'CDC round {round_no}', update_dt = LOCALTIMESTAMP WHERE id = 1;
+    ''')
+
+
+def wait_for_marker(dest_conn, round_no, timeout=60.0):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        with dest_conn.cursor() as dest_cursor:
+            dest_cursor.execute("SELECT campaign_name FROM analytical_model.campaign WHERE id_campaign = 1")
+            row = dest_cursor.fetchone()
+        dest_conn.rollback()
+        if row and row[0] == f"CDC round {round_no}":
+            return time.perf_counter() - started
+        time.sleep(0.005)
+    raise RuntimeError(f"Round {round_no} was not applied within {timeout} seconds")
+
+
+def compare_tables(source_pool, dest_conn):
+    """
+    Returns {table: (rows in the source query, rows in analytical_model, rows differing)}.
+    """
+    results = {}
+    for spec in TABLE_SPECS:
+        if spec.name not in cdc_targets():
+            continue
+        with dest_conn.cursor() as dest_cursor:
+            params = {**watermark_params(INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY), **key_range_params(),
+                      **partition_params(), **read_exclusions(dest_cursor, spec.exclusions)}
+            with source_pool.connection() as source_conn:
+                with source_conn.cursor() as source_cursor:
+                    source_cursor.execute(spec.query, params)
+                    indexes = [i for i, column in enumerate(source_cursor.description)
+                               if column.name not in IGNORED_COLUMNS]
+                    columns = [source_cursor.description[i].name for i in indexes]
+                    expected = [tuple(row[i] for i in indexes) for row in source_cursor.fetchall()]
+                source_conn.rollback()
+            dest_cursor.execute(f"SELECT {', '.join(columns)} FROM analytical_model.{spec.name}")
+            actual = dest_cursor.fetchall()
+        dest_conn.rollback()
+        differing = len(set(expected) ^ set(actual)) + abs(len(expected) - len(set(expected))) + \
+            abs(len(actual) - len(set(actual)))
+        results[spec.name] = (len(expected), len(actual), differing)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), required=not os.environ.get("BENCH_DSN"),
+                        help="Throwaway destination Postgres (or set BENCH_DSN)")
+    parser.add_argument("--source-dsn", help="Throwaway source Postgres with wal_level=logical; defaults to --dsn")
+    parser.add_argument("--scales", type=int, nargs="+", default=[100000])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--pause", type=float, default=0.2, help="Seconds between rounds")
+    parser.add_argument("--max-latency", type=float, default=0.5)
+    parser.add_argument("--slot", default="bench_cdc")
+    parser.add_argument("--report", default="bench_cdc.json")
+    args = parser.parse_args()
+    source_dsn = args.source_dsn or args.dsn
+
+    source_conn = psycopg2.connect(source_dsn)
+    dest_conn = psycopg2.connect(args.dsn)
+    report = {
+        "started_at": datetime.datetime.utcnow().replace(tzinfo=None).isoformat(),
+        "python": platform.python_version(),
+        "same_database": source_dsn == args.dsn,
+        "results": [],
+    }
+
+    print(f"{'versions':>10} {'rounds':>7} {'p50 s':>8} {'p95 s':>8} {'max s':>8} {'batches':>8} {'changes':>8}")
+    for scale in args.scales:
+        drop_cdc_source(source_conn, args.slot, args.slot)
+        with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+            create_source(source_cursor, scale)
+            create_destination(dest_cursor, scale)
+            ensure_refresh_stores(dest_cursor)
+            ensure_cdc_store(dest_cursor)
+            dest_cursor.execute("DELETE FROM analytical_model.refresh_cdc_state WHERE slot_name = %s", (args.slot,))
+        source_conn.commit()
+        dest_conn.commit()
+
+        source_pool = bench_pool(source_dsn, "source")
+        dest_pool = bench_pool(args.dsn, "dest")
+        stop = threading.Event()
+        totals = {}
+
+        def consume():
+            totals.update(run_cdc(TABLE_SPECS, source_pool, dest_pool, RefreshOptions(), args.slot, args.slot,
+                                  run_seconds=None, max_latency=args.max_latency, stop_event=stop))
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+
+        latencies = []
+        for round_no in range(args.rounds):
+            with source_conn.cursor() as source_cursor:
+                change_round(source_cursor, scale, round_no)
+            source_conn.commit()
+            # The first round also waits for the initial polling load
+            latency = wait_for_marker(dest_conn, round_no, timeout=600.0 if round_no == 0 else 60.0)
+            if round_no:
+                latencies.append(latency)
+            time.sleep(args.pause)
+
+        stop.set()
+        consumer.join()
+        comparison = compare_tables(source_pool, dest_conn)
+        source_pool.closeall()
+        dest_pool.closeall()
+
+        latencies.sort()
+        p50 = statistics.median(latencies) if latencies else 0.0
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+        top = latencies[-1] if latencies else 0.0
+        report["results"].append({"scale": scale, "rounds": args.rounds, "max_latency": args.max_latency,
+                                  "latency_p50": round(p50, 4), "latency_p95": round(p95, 4),
+                                  "latency_max": round(top, 4), "batches": totals.get("batches"),
+                                  "changes": totals.get("changes"), "comparison": comparison})
+        print(f"{scale:>10} {args.rounds:>7} {p50:>8.3f} {p95:>8.3f} {top:>8.3f} "
+              f"{totals.get('batches', 0):>8} {totals.get('changes', 0):>8}")
+        for table_name, (expected, actual, differing) in comparison.items():
+            print(f"    {table_name:>10}: {expected} source rows, {actual} loaded, {differing} differing")
+
+        drop_cdc_source(source_conn, args.slot, args.slot)
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+        drop_all(source_cursor, dest_cursor)
+    source_conn.commit()
+    dest_conn.commit()
+    source_conn.close()
+    dest_conn.close()
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Cleanse timings: old NOT IN tuples against the set-based anti-join cleanse.
+
+Builds a synthetic analytical_model-shaped schema at each scale (number of
+version rows) in a throwaway Postgres:
+
+    python -m benchmarks.bench_cleanse --dsn postgresql://localhost/scratch --scales 10000 100000 1000000
+"""
+import argparse
+import os
+import time
+
+import psycopg2
+
+from refresh.validation import CLEANSE_TARGETS, VALIDATED_CAMPAIGNS_TABLE, build_valid_id_closure, \
+    delete_invalid_records
+from refresh.watermark import ensure_watermark_store
+
+BENCH_SCHEMA = "bench_cleanse"
+
+
+def load_synthetic(conn, versions):
+    """
+    Recreates the schema with `versions` version rows, one link and one
+    treatment per version, and 70% of campaigns validated.
+    """
+    campaigns = max(versions // 1000, 10)
+    tactics = max(versions // 20, 10)
+    offers = max(versions // 50, 10)
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        cursor.execute(f'''
+            CREATE TABLE {BENCH_SCHEMA}.{VALIDATED_CAMPAIGNS_TABLE} AS
+            SELECT g::int8 AS id_campaign FROM generate_series(1, {campaigns}) g WHERE g % 10 < 7;
+
+            CREATE TABLE {BENCH_SCHEMA}.campaign AS
+            SELECT g::int8 AS id_campaign, 'Campaign ' || g AS campaign_name
+            FROM generate_series(1, {campaigns}) g;
+
+            CREATE TABLE {BENCH_SCHEMA}.tactic AS
+            SELECT g::int8 AS id_tactic, (1 + g % {campaigns})::int8 AS id_campaign
+            FROM generate_series(1, {tactics}) g;
+
+            CREATE TABLE {BENCH_SCHEMA}.offer AS
+            SELECT g::int8 AS id_offer FROM generate_series(1, {offers}) g;
+
+            CREATE TABLE {BENCH_SCHEMA}.version AS
+            SELECT g::int8 AS id_version,
+                   (1 + (g::int8 * 7919) % {tactics})::int8 AS id_tactic,
+                   CASE WHEN g % 10 = 0 THEN NULL ELSE (1 + (g::int8 * 104729) % {offers})::int8 END AS id_offer
+            FROM generate_series(1, {versions}) g;
+
+            CREATE TABLE {BENCH_SCHEMA}.link AS
+            SELECT g::int8 AS id_link, (1 + (g::int8 * 31) % {versions})::int8 AS id_version
+            FROM generate_series(1, {versions}) g;
+
+            CREATE TABLE {BENCH_SCHEMA}.treatment AS
+            SELECT g::int8 AS id, (g % 500)::int8 AS id_treatment, (1 + (g::int8 * 17) % {versions})::int8 AS id_version
+            FROM generate_series(1, {versions}) g;
+
+            ALTER TABLE {BENCH_SCHEMA}.campaign ADD PRIMARY KEY (id_campaign);
+            ALTER TABLE {BENCH_SCHEMA}.tactic ADD PRIMARY KEY (id_tactic);
+            ALTER TABLE {BENCH_SCHEMA}.offer ADD PRIMARY KEY (id_offer);
+            ALTER TABLE {BENCH_SCHEMA}.version ADD PRIMARY KEY (id_version);
+            ALTER TABLE {BENCH_SCHEMA}.link ADD PRIMARY KEY (id_link);
+            CREATE INDEX ON {BENCH_SCHEMA}.tactic (id_campaign);
+            CREATE INDEX ON {BENCH_SCHEMA}.version (id_tactic);
+
+            -- Empty refresh bookkeeping, so the closure cache builds in full
+            CREATE TABLE {BENCH_SCHEMA}.update_log (
+                "table" text, ingest_start_ts timestamp, ingest_end_ts timestamp, "type" text, "count" integer,
+                ids text
+            );
+        ''')
+        ensure_watermark_store(cursor, BENCH_SCHEMA)
+        for table in ["campaign", "tactic", "offer", "version", "link", "treatment", VALIDATED_CAMPAIGNS_TABLE]:
+            cursor.execute(f"ANALYZE {BENCH_SCHEMA}.{table}")
+    conn.commit()
+
+
+def legacy_cleanse(conn):
+    """
+    The previous cleanse: pull every valid ID into Python sets, then
+    DELETE ... NOT IN %s with the whole set as a tuple literal.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT id_campaign FROM {BENCH_SCHEMA}.{VALIDATED_CAMPAIGNS_TABLE}")
+        valid_campaign_ids = {row[0] for row in cursor.fetchall()}
+        cursor.execute(f"SELECT DISTINCT id_tactic FROM {BENCH_SCHEMA}.tactic WHERE id_campaign = ANY(%s)",
+                       (list(valid_campaign_ids),))
+        valid_tactic_ids = {row[0] for row in cursor.fetchall()}
+        cursor.execute(f"SELECT DISTINCT id_version FROM {BENCH_SCHEMA}.version WHERE id_tactic = ANY(%s)",
+                       (list(valid_tactic_ids),))
+        valid_version_ids = {row[0] for row in cursor.fetchall()}
+        cursor.execute(f'''
+            SELECT DISTINCT id_offer FROM {BENCH_SCHEMA}.version
+            WHERE id_tactic = ANY(%s) AND id_offer IS NOT NULL
+        ''', (list(valid_tactic_ids),))
+        valid_offer_ids = {row[0] for row in cursor.fetchall()}
+
+        valid_sets = {
+            "valid_campaign": valid_campaign_ids,
+            "valid_tactic": valid_tactic_ids,
+            "valid_version": valid_version_ids,
+            "valid_offer": valid_offer_ids,
+        }
+        deleted = {}
+        for table, (column, closure_table) in CLEANSE_TARGETS.items():
+            valid_ids = valid_sets[closure_table]
+            if valid_ids:
+                cursor.execute(f"DELETE FROM {BENCH_SCHEMA}.{table} WHERE {column} NOT IN %s", (tuple(valid_ids),))
+                deleted[table] = cursor.rowcount
+    conn.commit()
+    return deleted
+
+
+def set_based_cleanse(conn):
+    with conn.cursor() as cursor:
+        closure_counts = build_valid_id_closure(cursor, schema=BENCH_SCHEMA)
+        deleted = delete_invalid_records(cursor, closure_counts, schema=BENCH_SCHEMA)
+    conn.commit()
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), required=not os.environ.get("BENCH_DSN"),
+                        help="Throwaway Postgres to benchmark against (or set BENCH_DSN)")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    print(f"{'versions':>10} {'cleanse':>10} {'seconds':>10} {'rows deleted':>14}")
+    for versions in args.scales:
+        results = {}
+        for name, cleanse in [("not_in", legacy_cleanse), ("anti_join", set_based_cleanse)]:
+            load_synthetic(conn, versions)
+            started = time.perf_counter()
+            deleted = cleanse(conn)
+            elapsed = time.perf_counter() - started
+            results[name] = deleted
+            print(f"{versions:>10} {name:>10} {elapsed:>10.3f} {sum(deleted.values()):>14,}")
+
+        if results["not_in"] != results["anti_join"]:
+            print(f"WARNING: deleted counts differ at {versions}: {results}")
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA {BENCH_SCHEMA} CASCADE")
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Prepared statements: parse/plan savings on the refresh's repeated statements.
+
+For each scale the synthetic schemas are built and loaded once. Then each
+statement the refresh repeats on every run is executed --repeat times on one
+connection, as plain text and through PREPARE/EXECUTE:
+
+    python -m benchmarks.bench_prepared --dsn postgresql://localhost/scratch \
+        --source-dsn postgresql://localhost/scratch_source --scales 100000
+
+watermark_read     STORED_WATERMARK_QUERY for one table
+watermark_advance  ADVANCE_WATERMARK (a no-op: the watermark never moves back)
+log_insert         UPDATE_LOG_INSERT, rolled back
+merge              a 100-row staging table merged into version, rolled back;
+                   the refresh does not prepare it, this shows why
+
+"ms" is the client-side time per statement; the difference between the modes
+is the parse and plan work saved. "plan ms" is the server's Planning Time
+from EXPLAIN (ANALYZE) of the same statement or its EXECUTE. Finally
+--rounds small incremental refreshes of every table run in each mode,
+the way the daemon repeats them on warm pooled connections.
+
+--dsn and --source-dsn must be throwaway databases.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+
+import psycopg2
+
+from benchmarks.bench_refresh import bench_pool
+from benchmarks.synthetic import SOURCE_SCHEMA, create_destination, create_source, drop_all
+from refresh.bulk_load import create_staging_table, merge_staging_sql
+from refresh.engine import RefreshOptions, ensure_refresh_stores, refresh_table
+from refresh.id_log import UPDATE_LOG_INSERT
+from refresh.statements import execute_prepared, prepared_name, set_prepared_statements, statement_text
+from refresh.tables import TABLE_SPECS
+from refresh.watermark import ADVANCE_WATERMARK, STORED_WATERMARK_QUERY, WATERMARK_TABLE
+
+VERSION_COLUMNS = ["id_version", "id_tactic", "id_content_group", "id_offer", "language_desc", "audience_segment_desc",
+                   "version_name", "planned_start_dte", "planned_end_dte", "actual_start_dte", "actual_end_dte",
+                   "position_row", "position_column", "placement_type", "modified_ts"]
+
+
+def statements():
+    """
+    {name: (sql, params, setup)} for the repeated statements; setup runs
+    before each execution in the same transaction.
+    """
+    now = datetime.datetime.utcnow().replace(tzinfo=None)
+
+    def stage_versions(cursor):
+        staging_table = create_staging_table(cursor, "version", VERSION_COLUMNS)
+        cursor.execute(f'''
+            INSERT INTO {staging_table} ({', '.join(VERSION_COLUMNS)})
+            SELECT {', '.join(VERSION_COLUMNS)} FROM analytical_model.version ORDER BY id_version LIMIT 100
+        ''')
+
+    return {
+        "watermark_read": (STORED_WATERMARK_QUERY.format(schema="analytical_model", watermark_table=WATERMARK_TABLE),
+                           ("version",), None),
+        "watermark_advance": (ADVANCE_WATERMARK.format(schema="analytical_model", watermark_table=WATERMARK_TABLE),
+                              ("version", datetime.datetime(2000, 1, 1), 0, now), None),
+        "log_insert": (UPDATE_LOG_INSERT.format(schema="analytical_model", update_log_table="update_log"),
+                       ("version", now, now, "upsert", 100, "1:100", 0, 0, 100), None),
+        "merge": (statement_text(merge_staging_sql, "_stage_version", "version", "id_version", VERSION_COLUMNS),
+                  (), stage_versions),
+    }
+
+
+def touch_rows(source_cursor, round_no, step=2000):
+    """
+    Stamps one in `step` rows of every source table as changed, a small delta per round.
+    """
+    for table, column in [("paign_default_campaign", "update_dt"), ("paign_default_tactic", "update_dt"),
+                          ("paign_default_offer", "update_dt"), ("paign_placement_version", "update_dt"),
+                          ("paign_module_link_ids_prod", "created_ts")]:
+        source_cursor.execute(f"UPDATE {SOURCE_SCHEMA}.{table} SET {column} = LOCALTIMESTAMP "
+                              f"WHERE id % {step} = {round_no % step}")
+
+
+def planning_ms(cursor, sql, params, prepared):
+    """
+    Planning Time of sql, from EXPLAIN (ANALYZE) of the text or of its EXECUTE.
+    """
+    if prepared:
+        name = prepared_name(cursor.connection, sql)
+        placeholders = f" ({', '.join(['%s'] * len(params))})" if params else ""
+        cursor.execute(f"EXPLAIN (ANALYZE, SUMMARY) EXECUTE {name}{placeholders}", params or None)
+    else:
+        cursor.execute(f"EXPLAIN (ANALYZE, SUMMARY) {sql}", params or None)
+    for (line,) in cursor.fetchall():
+        if line.startswith("Planning Time"):
+            return float(line.split(":")[1].split()[0])
+    return 0.0
+
+
+def time_statement(conn, sql, params, setup, prepared, repeat):
+    """
+    Returns (ms per execution, server planning ms), each execution in its own
+    rolled-back transaction.
+    """
+    set_prepared_statements(prepared)
+    seconds = 0.0
+    with conn.cursor() as cursor:
+        # Warm up: the first EXECUTE includes the PREPARE
+        if setup:
+            setup(cursor)
+        execute_prepared(cursor, sql, params)
+        conn.rollback()
+
+        for _ in range(repeat):
+            if setup:
+                setup(cursor)
+            started = time.perf_counter()
+            execute_prepared(cursor, sql, params)
+            if cursor.description:
+                cursor.fetchall()
+            seconds += time.perf_counter() - started
+            conn.rollback()
+
+        if setup:
+            setup(cursor)
+        plan = planning_ms(cursor, sql, params, prepared)
+        conn.rollback()
+    return seconds / repeat * 1000, plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), required=not os.environ.get("BENCH_DSN"),
+                        help="Throwaway destination Postgres (or set BENCH_DSN)")
+    parser.add_argument("--source-dsn", help="Throwaway source Postgres; defaults to --dsn")
+    parser.add_argument("--scales", type=int, nargs="+", default=[100000])
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--report", default="bench_prepared.json")
+    args = parser.parse_args()
+    source_dsn = args.source_dsn or args.dsn
+
+    source_conn = psycopg2.connect(source_dsn)
+    dest_conn = psycopg2.connect(args.dsn)
+    report = {
+        "started_at": datetime.datetime.utcnow().replace(tzinfo=None).isoformat(),
+        "python": platform.python_version(),
+        "same_database": source_dsn == args.dsn,
+        "results": [],
+    }
+
+    for scale in args.scales:
+        with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+            create_source(source_cursor, scale)
+            create_destination(dest_cursor, scale)
+            ensure_refresh_stores(dest_cursor)
+        source_conn.commit()
+        dest_conn.commit()
+
+        source_pool = bench_pool(source_dsn, "source")
+        dest_pool = bench_pool(args.dsn, "dest")
+        for spec in TABLE_SPECS:
+            refresh_table(spec, source_pool, dest_pool, RefreshOptions())
+
+        print(f"{'versions':>10} {'statement':>18} {'mode':>9} {'ms':>8} {'plan ms':>8} {'saved ms':>9}")
+        for name, (sql, params, setup) in statements().items():
+            plain_ms, plain_plan = time_statement(dest_conn, sql, params, setup, False, args.repeat)
+            prepared_ms, prepared_plan = time_statement(dest_conn, sql, params, setup, True, args.repeat)
+            for mode, ms, plan in (("text", plain_ms, plain_plan), ("prepared", prepared_ms, prepared_plan)):
+                saved = plain_ms - ms
+                report["results"].append({"scale": scale, "statement": name, "mode": mode, "ms": round(ms, 4),
+                                          "plan_ms": plan, "saved_ms": round(saved, 4)})
+                print(f"{scale:>10} {name:>18} {mode:>9} {ms:>8.3f} {plan:>8.3f} {saved:>9.3f}")
+
+        # Repeated small refreshes on the same pooled connections, as the daemon runs them
+        for prepared in (False, True):
+            set_prepared_statements(prepared)
+            seconds = 0.0
+            for round_no in range(args.rounds):
+                with source_conn.cursor() as source_cursor:
+                    touch_rows(source_cursor, round_no + (args.rounds if prepared else 0))
+                source_conn.commit()
+                started = time.perf_counter()
+                for spec in TABLE_SPECS:
+                    refresh_table(spec, source_pool, dest_pool, RefreshOptions())
+                seconds += time.perf_counter() - started
+            mode = "prepared" if prepared else "text"
+            report["results"].append({"scale": scale, "statement": "refresh_round", "mode": mode,
+                                      "ms": round(seconds / args.rounds * 1000, 4)})
+            print(f"{scale:>10} {'refresh_round':>18} {mode:>9} {seconds / args.rounds * 1000:>8.3f}")
+
+        set_prepared_statements(True)
+        source_pool.closeall()
+        dest_pool.closeall()
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+        drop_all(source_cursor, dest_cursor)
+    source_conn.commit()
+    dest_conn.commit()
+    source_conn.close()
+    dest_conn.close()
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
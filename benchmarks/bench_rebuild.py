@@ -0,0 +1,128 @@
+"""
+Full reload of a table: update_log reset vs. shadow-table rebuild.
+
+For each scale the synthetic schemas are built, loaded and cleansed once.
+Then, for every table given, each mode reloads it from the full source:
+
+    python -m benchmarks.bench_rebuild --dsn postgresql://localhost/scratch \
+        --source-dsn postgresql://localhost/scratch_source --scales 100000 1000000
+
+reset     what a rebuild used to take: the table's update_log rows,
+          watermark and backfill checkpoints are deleted, so the next
+          refresh upserts the whole source into the live, indexed table
+          (in one transaction), followed by a full cleanse
+rebuild   rebuild_table: load into an unindexed shadow table, validated-ID
+          filter and dedupe, index build, ANALYZE and swap
+
+--dsn and --source-dsn must be throwaway databases.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+
+import psycopg2
+
+from benchmarks.bench_refresh import bench_pool
+from benchmarks.synthetic import create_destination, create_source, drop_all
+from refresh.backfill import BACKFILL_CHUNK_TABLE, BACKFILL_TABLE
+from refresh.engine import RefreshOptions, ensure_refresh_stores, refresh_table
+from refresh.rebuild import rebuild_table
+from refresh.tables import TABLE_SPECS
+from refresh.validation import run_cleanse
+from refresh.watermark import WATERMARK_TABLE
+
+
+def reset_table(dest_conn, table_name):
+    """
+    Forgets every load of table_name, the old way of forcing a full reload.
+    """
+    with dest_conn.cursor() as dest_cursor:
+        dest_cursor.execute('DELETE FROM analytical_model.update_log WHERE "table" = %s', (table_name,))
+        for state_table in (WATERMARK_TABLE, BACKFILL_TABLE, BACKFILL_CHUNK_TABLE):
+            dest_cursor.execute(f"DELETE FROM analytical_model.{state_table} WHERE table_name = %s", (table_name,))
+    dest_conn.commit()
+
+
+def run_mode(mode, spec, source_pool, dest_pool, dest_conn):
+    if mode == "reset":
+        reset_table(dest_conn, spec.name)
+        refresh_table(spec, source_pool, dest_pool, RefreshOptions(backfill_chunk_size=0))
+        with dest_conn.cursor() as dest_cursor:
+            run_cleanse(dest_cursor, full=True)
+        dest_conn.commit()
+    else:
+        rebuild_table(spec, source_pool, dest_pool)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), required=not os.environ.get("BENCH_DSN"),
+                        help="Throwaway destination Postgres (or set BENCH_DSN)")
+    parser.add_argument("--source-dsn", help="Throwaway source Postgres; defaults to --dsn")
+    parser.add_argument("--scales", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--tables", nargs="+", default=["version", "link"])
+    parser.add_argument("--modes", nargs="+", default=["reset", "rebuild"])
+    parser.add_argument("--report", default="bench_rebuild.json")
+    args = parser.parse_args()
+    source_dsn = args.source_dsn or args.dsn
+    specs = {spec.name: spec for spec in TABLE_SPECS}
+
+    source_conn = psycopg2.connect(source_dsn)
+    dest_conn = psycopg2.connect(args.dsn)
+    report = {
+        "started_at": datetime.datetime.utcnow().replace(tzinfo=None).isoformat(),
+        "python": platform.python_version(),
+        "same_database": source_dsn == args.dsn,
+        "results": [],
+    }
+
+    print(f"{'versions':>10} {'table':>10} {'mode':>8} {'seconds':>10} {'rows':>10}")
+    for scale in args.scales:
+        with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+            create_source(source_cursor, scale)
+            create_destination(dest_cursor, scale)
+            ensure_refresh_stores(dest_cursor)
+        source_conn.commit()
+        dest_conn.commit()
+
+        source_pool = bench_pool(source_dsn, "source")
+        dest_pool = bench_pool(args.dsn, "dest")
+        for spec in TABLE_SPECS:
+            refresh_table(spec, source_pool, dest_pool, RefreshOptions())
+        with dest_conn.cursor() as dest_cursor:
+            run_cleanse(dest_cursor, full=True)
+        dest_conn.commit()
+
+        for table_name in args.tables:
+            for mode in args.modes:
+                started = time.perf_counter()
+                run_mode(mode, specs[table_name], source_pool, dest_pool, dest_conn)
+                seconds = time.perf_counter() - started
+
+                with dest_conn.cursor() as dest_cursor:
+                    dest_cursor.execute(f"SELECT COUNT(*) FROM analytical_model.{table_name}")
+                    rows = dest_cursor.fetchone()[0]
+                dest_conn.rollback()
+                report["results"].append({"scale": scale, "table": table_name, "mode": mode,
+                                          "seconds": round(seconds, 4), "rows": rows})
+                print(f"{scale:>10} {table_name:>10} {mode:>8} {seconds:>10.3f} {rows:>10}")
+
+        source_pool.closeall()
+        dest_pool.closeall()
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+        drop_all(source_cursor, dest_cursor)
+    source_conn.commit()
+    dest_conn.commit()
+    source_conn.close()
+    dest_conn.close()
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+End-to-end refresh timings against synthetic source and destination schemas.
+
+For each scale (number of placement versions) the suite builds the synthetic
+schemas, then times every table refresh, the valid-ID closure and the cleanse
+for a first load, an incremental run after touching ~1% of the source, and a
+run with nothing to do. Results go to a JSON report for run-over-run tracking:
+
+    python -m benchmarks.bench_refresh --dsn postgresql://localhost/scratch --scales 10000 1000000 \
+        --report bench_refresh.json
+
+--dsn must be a throwaway database. For production-like transfers point
+--source-dsn at a second throwaway database; with a single database every
+table takes the same-database INSERT ... SELECT path.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+
+import psycopg2
+from psycopg2.extensions import parse_dsn
+
+from benchmarks.synthetic import SOURCE_SCHEMA, create_destination, create_source, drop_all, touch_source
+from refresh.engine import RefreshOptions, ensure_refresh_stores, refresh_table
+from refresh.pool import ConnectionPool
+from refresh.tables import TABLE_SPECS
+from refresh.validation import CLOSURE_KEYS, build_valid_id_closure, closure_cache_table, run_cleanse
+
+
+def bench_pool(dsn, name):
+    """
+    A pool whose connections resolve the unqualified source table names to
+    the synthetic schema.
+    """
+    conn_info = dict(parse_dsn(dsn), options=f"-c search_path={SOURCE_SCHEMA},public")
+    return ConnectionPool(conn_info, maxconn=4, name=name)
+
+
+def get_valid_ids(dest_pool):
+    """
+    The notebook's get_valid_ids: update the cached closure and read it back as sets.
+    """
+    with dest_pool.connection() as dest_conn:
+        with dest_conn.cursor() as dest_cursor:
+            build_valid_id_closure(dest_cursor)
+            sizes = {}
+            for closure_table, column in CLOSURE_KEYS.items():
+                dest_cursor.execute(f"SELECT {column} FROM {closure_cache_table(closure_table)}")
+                sizes[closure_table] = len({row[0] for row in dest_cursor.fetchall()})
+        dest_conn.commit()
+    return sizes
+
+
+def cleanse_invalid_records(dest_pool):
+    with dest_pool.connection() as dest_conn:
+        with dest_conn.cursor() as dest_cursor:
+            mode, deleted = run_cleanse(dest_cursor)
+        dest_conn.commit()
+    return mode, deleted
+
+
+def timed(function):
+    started = time.perf_counter()
+    value = function()
+    return time.perf_counter() - started, value
+
+
+def run_phase(scale, phase, source_pool, dest_pool, options):
+    """
+    Times each table refresh in dependency order, then get_valid_ids and the
+    cleanse. Returns one result dict per step.
+    """
+    results = []
+    for spec in TABLE_SPECS:
+        seconds, transfer = timed(lambda: refresh_table(spec, source_pool, dest_pool, options))
+        results.append({
+            "scale": scale, "phase": phase, "step": spec.name, "seconds": round(seconds, 4),
+            "records": transfer.record_count, "inserted": transfer.inserted,
+            "updated": transfer.updated, "unchanged": transfer.unchanged,
+        })
+
+    seconds, sizes = timed(lambda: get_valid_ids(dest_pool))
+    results.append({"scale": scale, "phase": phase, "step": "get_valid_ids", "seconds": round(seconds, 4),
+                    "closure_sizes": sizes})
+
+    seconds, (mode, deleted) = timed(lambda: cleanse_invalid_records(dest_pool))
+    results.append({"scale": scale, "phase": phase, "step": "cleanse_invalid_records", "seconds": round(seconds, 4),
+                    "mode": mode, "deleted": deleted})
+
+    for result in results:
+        print(f"{scale:>10} {phase:>12} {result['step']:>24} {result['seconds']:>10.3f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), required=not os.environ.get("BENCH_DSN"),
+                        help="Throwaway destination Postgres (or set BENCH_DSN)")
+    parser.add_argument("--source-dsn", help="Throwaway source Postgres; defaults to --dsn")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 1000000, 10000000])
+    parser.add_argument("--touch-fraction", type=float, default=0.01)
+    parser.add_argument("--backfill-chunk-size", type=int, default=50000)
+    parser.add_argument("--partitions", type=int, default=1, help="Extraction slices for link")
+    parser.add_argument("--report", default="bench_refresh.json")
+    args = parser.parse_args()
+    source_dsn = args.source_dsn or args.dsn
+
+    options = RefreshOptions(backfill_chunk_size=args.backfill_chunk_size,
+                             partitions={"link": args.partitions})
+    source_conn = psycopg2.connect(source_dsn)
+    dest_conn = psycopg2.connect(args.dsn)
+    with dest_conn.cursor() as dest_cursor:
+        dest_cursor.execute("SHOW server_version")
+        server_version = dest_cursor.fetchone()[0]
+
+    report = {
+        "started_at": datetime.datetime.utcnow().replace(tzinfo=None).isoformat(),
+        "python": platform.python_version(),
+        "server_version": server_version,
+        "same_database": source_dsn == args.dsn,
+        "options": {"touch_fraction": args.touch_fraction, "backfill_chunk_size": args.backfill_chunk_size,
+                    "partitions": args.partitions},
+        "results": [],
+    }
+
+    print(f"{'versions':>10} {'phase':>12} {'step':>24} {'seconds':>10}")
+    for scale in args.scales:
+        with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+            create_source(source_cursor, scale)
+            create_destination(dest_cursor, scale)
+            ensure_refresh_stores(dest_cursor)
+        source_conn.commit()
+        dest_conn.commit()
+
+        source_pool = bench_pool(source_dsn, "source")
+        dest_pool = bench_pool(args.dsn, "dest")
+        report["results"] += run_phase(scale, "first_load", source_pool, dest_pool, options)
+
+        with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+            touch_source(source_cursor, dest_cursor, scale, args.touch_fraction)
+        source_conn.commit()
+        dest_conn.commit()
+        report["results"] += run_phase(scale, "incremental", source_pool, dest_pool, options)
+        report["results"] += run_phase(scale, "no_changes", source_pool, dest_pool, options)
+
+        source_pool.closeall()
+        dest_pool.closeall()
+
+        # Flush after every scale so a long run still leaves a usable report
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    with source_conn.cursor() as source_cursor, dest_conn.cursor() as dest_cursor:
+        drop_all(source_cursor, dest_cursor)
+    source_conn.commit()
+    dest_conn.commit()
+    source_conn.close()
+    dest_conn.close()
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Synthetic source and destination schemas for local refresh benchmarks.
+
+Source tables (paign_*, cf_*, audience_segment_placement_versions) go into
+the bench_source schema, which the benchmark puts first on search_path so
+the unqualified table names in refresh.tables resolve to them.
+public.treatment_placement_versions and the analytical_model tables are
+created on the destination under their real names, so the destination must
+be a throwaway database.
+"""
+
+SOURCE_SCHEMA = "bench_source"
+
+# analytical_model tables are only dropped when this marker table exists,
+# so the benchmark never touches a real analytical_model
+MARKER_TABLE = "analytical_model.bench_marker"
+
+
+class NotAScratchDatabase(Exception):
+    pass
+
+
+def check_scratch(cursor):
+    """
+    Raises NotAScratchDatabase when analytical_model exists and was not
+    created by this benchmark.
+    """
+    cursor.execute("SELECT to_regnamespace('analytical_model') IS NOT NULL, to_regclass(%s) IS NOT NULL",
+                   (MARKER_TABLE,))
+    schema_exists, marked = cursor.fetchone()
+    if schema_exists and not marked:
+        raise NotAScratchDatabase("analytical_model already exists and was not created by the benchmark; "
+                                  "point --dsn at a throwaway database")
+
+
+def scale_counts(versions):
+    """
+    Row counts per source table for a given number of placement versions,
+    in roughly the proportions of the production tables.
+    """
+    return {
+        "campaign": max(versions // 1000, 10),
+        "tactic": max(versions // 20, 10),
+        "offer": max(versions // 50, 10),
+        "module": max(versions // 10, 10),
+        "content_group": max(versions // 100, 10),
+        "segment": max(versions // 5, 10),
+        "version": versions,
+        "link": versions,
+        "treatment": versions,
+    }
+
+
+def create_source(cursor, versions):
+    """
+    Recreates bench_source and fills it for `versions` placement versions.
+    Timestamps spread over 2024 so watermarks advance as in production.
+    """
+    n = scale_counts(versions)
+    cursor.execute(f'''
+        DROP SCHEMA IF EXISTS {SOURCE_SCHEMA} CASCADE;
+        CREATE SCHEMA {SOURCE_SCHEMA};
+        SET LOCAL search_path = {SOURCE_SCHEMA};
+
+        CREATE TABLE paign_default_campaign AS
+        SELECT g::int8 AS id, 'Campaign ' || g AS name, 'Audience ' || g % 13 AS audience,
+               CASE WHEN g % 4 = 0 THEN 'Draft' ELSE 'Active' END AS current_status,
+               DATE '2024-01-01' + g % 300 AS planned_start_dt, DATE '2024-02-01' + g % 300 AS planned_end_dt,
+               DATE '2024-01-01' + g % 300 AS actual_start_dt, DATE '2024-02-01' + g % 300 AS actual_end_dt,
+               TIMESTAMP '2024-01-01' + g * interval '1 minute' AS created_dt,
+               CASE WHEN g % 3 = 0 THEN TIMESTAMP '2024-06-01' + g * interval '1 minute' END AS update_dt
+        FROM generate_series(1, {n["campaign"]}) g;
+
+        CREATE TABLE paign_default_tactic AS
+        SELECT g::int8 AS id, (1 + g % {n["campaign"]})::int8 AS campaign_id,
+               CASE WHEN g % 5 = 0 THEN NULL ELSE 'Criteria ' || g % 17 END AS audience_criteria,
+               'Brand ' || g % 7 AS brand_name, 'Tactic ' || g AS name,
+               TIMESTAMP '2024-01-01' + g % 300 * interval '1 day' AS actual_start_dt,
+               TIMESTAMP '2024-03-01' + g % 300 * interval '1 day' AS actual_end_dt,
+               CASE WHEN g % 2 = 0 THEN 'Email' ELSE 'Direct Mail' END AS tactic_type,
+               TIMESTAMP '2024-01-01' + g % 300 * interval '1 day' AS planned_start_dt,
+               TIMESTAMP '2024-03-01' + g % 300 * interval '1 day' AS planned_end_dt,
+               TIMESTAMP '2024-01-01' + g * interval '1 second' AS created_dt,
+               CASE WHEN g % 3 = 0 THEN TIMESTAMP '2024-06-01' + g * interval '1 second' END AS update_dt
+        FROM generate_series(1, {n["tactic"]}) g;
+
+        CREATE TABLE paign_default_valueamounttype AS
+        SELECT g::int8 AS id, 'Type ' || g AS name FROM generate_series(1, 5) g;
+
+        CREATE TABLE paign_default_offer AS
+        SELECT g::int8 AS id, 'Offer ' || g AS name, 'Description ' || g AS description,
+               CASE WHEN g % 2 = 0 THEN 'Points' ELSE 'Discount' END AS offer_type,
+               (g % 500)::text AS value_amount, 'Type ' || (1 + g % 5) AS value_amount_type,
+               (1 + g % 5)::int8 AS value_amount_type_id, 'Active' AS current_status,
+               TIMESTAMP '2024-01-01' + g % 300 * interval '1 day' AS actual_start_dt,
+               TIMESTAMP '2024-04-01' + g % 300 * interval '1 day' AS actual_end_dt,
+               TIMESTAMP '2024-01-01' + g * interval '1 second' AS created_dt,
+               CASE WHEN g % 3 = 0 THEN TIMESTAMP '2024-06-01' + g * interval '1 second' END AS update_dt
+        FROM generate_series(1, {n["offer"]}) g;
+
+        CREATE TABLE cf_content_group AS
+        SELECT g::int8 AS id, (1 + (g::int8 * 7) % {n["offer"]})::int8 AS offer_id
+        FROM generate_series(1, {n["content_group"]}) g;
+
+        CREATE TABLE cf_modules AS
+        SELECT g::int8 AS id, (1 + g % {n["content_group"]})::int8 AS content_group_id
+        FROM generate_series(1, {n["module"]}) g;
+
+        CREATE TABLE cf_placement_type AS
+        SELECT g::int8 AS id, 'Placement ' || g AS placement_type_name FROM generate_series(1, 5) g;
+
+        CREATE TABLE cf_vehicle_placement_position AS
+        SELECT g::int8 AS id, g % 10 AS placement_type_row, g / 10 AS placement_type_column,
+               (1 + g % 5)::int8 AS placement_type_id
+        FROM generate_series(1, 50) g;
+
+        CREATE TABLE paign_placement_version AS
+        SELECT g::int8 AS id, (1 + (g::int8 * 7919) % {n["tactic"]})::int8 AS tactic_id,
+               (1 + g % {n["module"]})::int8 AS module_id, (1 + g % 50)::int8 AS vehicle_placement_position_id,
+               CASE WHEN g % 9 = 0 THEN NULL ELSE 'English' END AS language,
+               'Segment ' || g % 31 AS audience_segment, 'Version ' || g AS name,
+               DATE '2024-01-01' + g % 300 AS start_date, DATE '2024-02-01' + g % 300 AS end_date,
+               TIMESTAMP '2024-01-01' + g % 300 * interval '1 day' AS actual_start_dt,
+               TIMESTAMP '2024-02-01' + g % 300 * interval '1 day' AS actual_end_dt,
+               TIMESTAMP '2024-01-01' + g * interval '1 second' AS created_dt,
+               CASE WHEN g % 3 = 0 THEN TIMESTAMP '2024-06-01' + g * interval '1 second' END AS update_dt
+        FROM generate_series(1, {n["version"]}) g;
+
+        CREATE TABLE audience_segment_placement_versions AS
+        SELECT (1 + g % {n["segment"]})::int8 AS audiencesegment_id, g::int8 AS placementversion_id
+        FROM generate_series(1, {n["version"]}) g;
+
+        CREATE TABLE paign_module_link_ids_prod AS
+        SELECT g::int8 AS id, v.tactic_id, v.module_id,
+               'example.com/offer/' || g AS original_url, 'https://example.com/offer/' || g || '?utm=1' AS final_url,
+               'Book now ' || g % 11 AS linked_text, 'cta' AS bit_type_name,
+               TIMESTAMP '2024-01-01' + g * interval '1 second' AS created_ts,
+               g % 20 = 0 AS outdated_flag
+        FROM generate_series(1, {n["link"]}) g
+        JOIN paign_placement_version v ON v.id = g;
+    ''')
+
+    for table, key in [
+        ("paign_default_campaign", "id"), ("paign_default_tactic", "id"), ("paign_default_offer", "id"),
+        ("paign_default_valueamounttype", "id"), ("cf_content_group", "id"), ("cf_modules", "id"),
+        ("cf_placement_type", "id"), ("cf_vehicle_placement_position", "id"), ("paign_placement_version", "id"),
+        ("paign_module_link_ids_prod", "id"),
+    ]:
+        cursor.execute(f"ALTER TABLE {SOURCE_SCHEMA}.{table} ADD PRIMARY KEY ({key})")
+    cursor.execute(f'''
+        CREATE INDEX ON {SOURCE_SCHEMA}.audience_segment_placement_versions (placementversion_id);
+        CREATE INDEX ON {SOURCE_SCHEMA}.paign_placement_version (tactic_id, module_id);
+    ''')
+
+
+def create_destination(cursor, versions):
+    """
+    Recreates analytical_model and public.treatment_placement_versions on the
+    destination. 70% of campaigns are validated.
+    """
+    n = scale_counts(versions)
+    check_scratch(cursor)
+    cursor.execute(f'''
+        DROP SCHEMA IF EXISTS analytical_model CASCADE;
+        CREATE SCHEMA analytical_model;
+        CREATE TABLE {MARKER_TABLE} ();
+
+        CREATE TABLE analytical_model.update_log (
+            "table" text, ingest_start_ts timestamp, ingest_end_ts timestamp, "type" text, "count" integer, ids text
+        );
+
+        CREATE TABLE analytical_model.validated_campaigns_02282025 AS
+        SELECT g::int8 AS id_campaign FROM generate_series(1, {n["campaign"]}) g WHERE g % 10 < 7;
+
+        CREATE TABLE analytical_model.campaign (
+            id_campaign int8 PRIMARY KEY, campaign_name text, audience_desc text, primary_objective text,
+            status text, planned_start_dte date, planned_end_dte date, actual_start_dte date,
+            actual_end_dte date, modified_ts timestamp
+        );
+
+        CREATE TABLE analytical_model.tactic (
+            id_tactic int8 PRIMARY KEY, id_campaign int8, audience_desc text, tactic_name text,
+            tactic_objective text, tactic_start_dte date, tactic_end_dte date, tactic_status text,
+            tactic_channel text, tactic_setup_type text, tactic_type text, tactic_publisher text,
+            planned_start_dte date, planned_end_dte date, modified_ts timestamp
+        );
+
+        CREATE TABLE analytical_model.version (
+            id_version int8 PRIMARY KEY, id_tactic int8, id_content_group int8, id_offer int8,
+            language_desc text, audience_segment_desc text, version_name text, planned_start_dte date,
+            planned_end_dte date, actual_start_dte timestamp, actual_end_dte timestamp, position_row int8,
+            position_column int8, placement_type text, modified_ts timestamp
+        );
+
+        CREATE TABLE analytical_model.offer (
+            id_offer int8 PRIMARY KEY, offer_name text, offer_type text, hurdle_value text, hurdle_type text,
+            promo_code text, award_value text, award_type text, status text, offer_start_dte date,
+            offer_end_dte date, modified_ts timestamp
+        );
+
+        CREATE TABLE analytical_model.link (
+            id_link int8, id_version int8, domain text, base_url text, final_url text, cta_text text,
+            link_type text, modified_ts timestamp
+        );
+
+        CREATE TABLE analytical_model.treatment (
+            id int8, id_treatment int8, id_version int8, modified_ts timestamp
+        );
+
+        DROP TABLE IF EXISTS public.treatment_placement_versions;
+        CREATE TABLE public.treatment_placement_versions AS
+        SELECT g::int8 AS id, (g % 500)::int8 AS treatment_id, (1 + (g::int8 * 17) % {n["version"]})::int8 AS pv_id,
+               TIMESTAMP '2024-01-01' + g * interval '1 second' AS created_at
+        FROM generate_series(1, {n["treatment"]}) g;
+        ALTER TABLE public.treatment_placement_versions ADD PRIMARY KEY (id);
+    ''')
+
+
+def touch_source(source_cursor, dest_cursor, versions, fraction=0.01):
+    """
+    Updates about `fraction` of every source table and appends as many new
+    link and treatment rows, for timing an incremental run. Changes are
+    stamped with the current time, as the applications do, so they land
+    after the backfill's watermark.
+    """
+    n = scale_counts(versions)
+    step = max(int(1 / fraction), 1)
+    for table in ["paign_default_campaign", "paign_default_tactic", "paign_default_offer",
+                  "paign_placement_version"]:
+        source_cursor.execute(f'''
+            UPDATE {SOURCE_SCHEMA}.{table}
+            SET name = name || ' (edited)', update_dt = LOCALTIMESTAMP
+            WHERE id % {step} = 0
+        ''')
+    new_links = max(n["link"] // step, 1)
+    source_cursor.execute(f'''
+        INSERT INTO {SOURCE_SCHEMA}.paign_module_link_ids_prod
+        SELECT id + {n["link"]}, tactic_id, module_id, original_url || '/new', final_url, linked_text, bit_type_name,
+               LOCALTIMESTAMP, false
+        FROM {SOURCE_SCHEMA}.paign_module_link_ids_prod
+        WHERE id <= {new_links}
+    ''')
+    dest_cursor.execute(f'''
+        INSERT INTO public.treatment_placement_versions
+        SELECT id + {n["treatment"]}, treatment_id, pv_id, LOCALTIMESTAMP
+        FROM public.treatment_placement_versions
+        WHERE id <= {max(n["treatment"] // step, 1)}
+    ''')
+
+
+def drop_all(source_cursor, dest_cursor):
+    source_cursor.execute(f"DROP SCHEMA IF EXISTS {SOURCE_SCHEMA} CASCADE")
+    dest_cursor.execute("DROP SCHEMA IF EXISTS analytical_model CASCADE")
+    dest_cursor.execute("DROP TABLE IF EXISTS public.treatment_placement_versions")
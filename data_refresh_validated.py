@@ -25,716 +25,194 @@ dest_schema = "analytical_model"
 
 update_log_table = "update_log"
 
-# COMMAND ----------
-
-# DBTITLE 1,important setup
-import psycopg2
-import datetime
-
-# COMMAND ----------
-
-# DBTITLE 1,campaign
-# Define the table to copy data from and to
-table_name = "campaign"
-key = "id_campaign"
-
-try:
-    # Connect to destination database to get the latest ingest timestamp
-    dest_conn = psycopg2.connect(**dest_conn_info)
-    dest_cursor = dest_conn.cursor()
-
-    # Fetch latest ingest timestamp for 'version'
-    dest_cursor.execute(f'''
-        SELECT MAX(ingest_start_ts) FROM analytical_model.{update_log_table}
-        WHERE "table" = %s
-    ''', (table_name,))
-    latest_ingest_start_ts = dest_cursor.fetchone()[0]
-
-    # If no previous ingestion, default to a very old date
-    if latest_ingest_start_ts is None:
-        latest_ingest_start_ts = datetime.datetime(2000, 1, 1)
-
-    # Record the new start timestamp
-    ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-    # Connect to source database
-    source_conn = psycopg2.connect(**source_conn_info)
-    source_cursor = source_conn.cursor()
-
-    # Fetch only modified records since last ingest
-    source_query = f'''
-            SELECT CAST(id as int8) AS id_campaign, 
-                name AS campaign_name, 
-                audience AS audience_desc, 
-                '' AS primary_objective, 
-                current_status as status, 
-                planned_start_dt as planned_start_dte, 
-                planned_end_dt as planned_end_dte, 
-                actual_start_dt as actual_start_dte, 
-                actual_end_dt as actual_end_dte, 
-                CASE WHEN update_dt IS NULL THEN created_dt ELSE update_dt END as modified_ts
-            FROM paign_default_campaign 
-            WHERE COALESCE(update_dt, created_dt) > '{latest_ingest_start_ts}'
-        '''
-    
-    source_cursor.execute(source_query, (latest_ingest_start_ts,))
-    rows = source_cursor.fetchall()
-    
-    if not rows:
-        print("No new or updated records found. No changes made.")
-    else:
-        # Extract column names
-        columns = [desc[0] for desc in source_cursor.description]
-        column_names = ', '.join(columns)
-        placeholders = ', '.join(['%s'] * len(columns))
-        
-        # Construct update clause dynamically
-        update_clause = ', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col != key])
-
-        # Extracting IDs for logging
-        record_ids = [str(row[0]) for row in rows]  # row[0] = id_treatment
-        record_ids_str = ', '.join(record_ids)  # Convert list to comma-separated string
-
-        # Upsert query with ON CONFLICT
-        upsert_query = f'''
-            INSERT INTO analytical_model.{table_name} ({column_names})
-            VALUES ({placeholders})
-            ON CONFLICT ({key}) DO UPDATE SET {update_clause};
-        '''
-
-        # Bulk execute upsert query
-        dest_cursor.executemany(upsert_query, rows)
-        dest_conn.commit()
-
-        # Record end timestamp
-        ingest_end_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-        # Log ingestion including IDs
-        log_query = f'''
-            INSERT INTO analytical_model.{update_log_table} ("table", ingest_start_ts, ingest_end_ts, "type", "count", ids)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        '''
-        dest_cursor.execute(log_query, (table_name, ingest_start_ts, ingest_end_ts, "upsert", len(rows), record_ids_str))
-        dest_conn.commit()
-
-        print(f"Upserted {len(rows)} records in {table_name}")
-        print("Update log recorded.")
-
-    # Close connections
-    source_cursor.close()
-    source_conn.close()
-    dest_cursor.close()
-    dest_conn.close()
-
-except Exception as e:
-    print("Error:", e)
-
-# COMMAND ----------
-
-# DBTITLE 1,tactic
-# Define the table to copy data from and to
-table_name = "tactic"
-key = "id_tactic"
-
-try:
-    # Connect to destination database to get the latest ingest timestamp
-    dest_conn = psycopg2.connect(**dest_conn_info)
-    dest_cursor = dest_conn.cursor()
-
-    # Fetch latest ingest timestamp for 'version'
-    dest_cursor.execute(f'''
-        SELECT MAX(ingest_start_ts) FROM analytical_model.{update_log_table}
-        WHERE "table" = %s
-    ''', (table_name,))
-    latest_ingest_start_ts = dest_cursor.fetchone()[0]
-
-    # If no previous ingestion, default to a very old date
-    if latest_ingest_start_ts is None:
-        latest_ingest_start_ts = datetime.datetime(2000, 1, 1)
-
-    # Record the new start timestamp
-    ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-    # Connect to source database
-    source_conn = psycopg2.connect(**source_conn_info)
-    source_cursor = source_conn.cursor()
-
-    # Fetch only modified records since last ingest
-    source_query = f'''
-        SELECT 
-        t.id AS id_tactic,
-        t.campaign_id AS id_campaign,
-        case when audience_criteria is null then 'Members with upcoming arrivals at the ' || brand_name else audience_criteria end as audience_desc, --was for lpa, cleanup
-        name AS tactic_name,
-        '' AS tactic_objective,
-        cast(actual_start_dt as date) AS tactic_start_dte,
-        cast(actual_end_dt as date) AS tactic_end_dte, 
-        'In-Market' as tactic_status, -- double check this with Kyle, WF status needs to be reflected in CP
-        tactic_type AS tactic_channel,
-        'Batch' AS tactic_setup_type, --verify that this metadata is being collected
-        'Marketing' AS tactic_type, --verify that this metadata is being collected
-        'PCM' AS tactic_publisher, --verify that this metadata is being collected
-        cast(planned_start_dt as date) AS planned_start_dte,
-        cast(planned_end_dt as date) AS planned_end_dte,
-        update_dt as modified_ts
-        FROM paign_default_tactic t  
-        WHERE COALESCE(update_dt, created_dt) > '{latest_ingest_start_ts}'
-    '''
-    source_cursor.execute(source_query, (latest_ingest_start_ts,))
-    rows = source_cursor.fetchall()
-    
-    if not rows:
-        print("No new or updated records found. No changes made.")
-    else:
-        # Extract column names
-        columns = [desc[0] for desc in source_cursor.description]
-        column_names = ', '.join(columns)
-        placeholders = ', '.join(['%s'] * len(columns))
-        
-        # Construct update clause dynamically
-        update_clause = ', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col != key])
-
-        # Extracting IDs for logging
-        record_ids = [str(row[0]) for row in rows]  
-        record_ids_str = ', '.join(record_ids)  # Convert list to comma-separated string
-
-        # Upsert query with ON CONFLICT
-        upsert_query = f'''
-            INSERT INTO analytical_model.{table_name} ({column_names})
-            VALUES ({placeholders})
-            ON CONFLICT ({key}) DO UPDATE SET {update_clause};
-        '''
-
-        # Bulk execute upsert query
-        dest_cursor.executemany(upsert_query, rows)
-        dest_conn.commit()
-
-        # Record end timestamp
-        ingest_end_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-        # Log ingestion including IDs
-        log_query = f'''
-            INSERT INTO analytical_model.{update_log_table} ("table", ingest_start_ts, ingest_end_ts, "type", "count", ids)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        '''
-        dest_cursor.execute(log_query, (table_name, ingest_start_ts, ingest_end_ts, "upsert", len(rows), record_ids_str))
-        dest_conn.commit()
-
-        print(f"Upserted {len(rows)} records in {table_name}")
-        print("Update log recorded.")
-
-    # Close connections
-    source_cursor.close()
-    source_conn.close()
-    dest_cursor.close()
-    dest_conn.close()
-
-except Exception as e:
-    print("Error:", e)
-
-# COMMAND ----------
-
-# DBTITLE 1,version
-# Define table details
-table_name = "version"
-key = "id_version"
-update_log_table = "update_log"
-
-try:
-    # Connect to destination database to get the latest ingest timestamp
-    dest_conn = psycopg2.connect(**dest_conn_info)
-    dest_cursor = dest_conn.cursor()
-
-    # Fetch latest ingest timestamp for 'version'
-    dest_cursor.execute(f'''
-        SELECT MAX(ingest_start_ts) FROM analytical_model.{update_log_table}
-        WHERE "table" = %s
-    ''', (table_name,))
-    latest_ingest_start_ts = dest_cursor.fetchone()[0]
-
-    # If no previous ingestion, default to a very old date
-    if latest_ingest_start_ts is None:
-        latest_ingest_start_ts = datetime.datetime(2000, 1, 1)
-
-    # Record the new start timestamp
-    ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-    # Connect to source database
-    source_conn = psycopg2.connect(**source_conn_info)
-    source_cursor = source_conn.cursor()
-
-    # Fetch only modified records since last ingest
-    source_query = f'''
-        WITH ppv_data AS (
-            SELECT 
-                ppv.id AS id_version,
-                ppv.tactic_id AS id_tactic,
-                ppv.module_id,
-                ppv.vehicle_placement_position_id,
-                COALESCE(ppv.language, 'English Global Default') AS language_desc,
-                ppv.audience_segment AS audience_segment_desc,
-                ppv.name AS version_name,
-                ppv.start_date AS planned_start_dte,
-                ppv.end_date AS planned_end_dte,
-                ppv.actual_start_dt AS actual_start_dte,
-                ppv.actual_end_dt AS actual_end_dte,
-                COALESCE(ppv.update_dt, ppv.created_dt) AS modified_ts
-            FROM paign_placement_version ppv 
-            left join paign_default_tactic t 
-            ON ppv.tactic_id = t.id
-            WHERE COALESCE(ppv.update_dt, ppv.created_dt) > '{latest_ingest_start_ts}'
-        )
-        SELECT 
-            ppv_data.id_version,
-            ppv_data.id_tactic,
-            ccg.id AS id_content_group,
-            ccg.offer_id AS id_offer,
-            ppv_data.language_desc,
-            ppv_data.audience_segment_desc,
-            ppv_data.version_name,
-            ppv_data.planned_start_dte,
-            ppv_data.planned_end_dte,
-            ppv_data.actual_start_dte,
-            ppv_data.actual_end_dte,
-            ROW_NUMBER() OVER (PARTITION BY aspv.audiencesegment_id ORDER BY cvpp.placement_type_row) AS position_row,
-            ROW_NUMBER() OVER (PARTITION BY aspv.audiencesegment_id ORDER BY cvpp.placement_type_column) AS position_column,
-            pt.placement_type_name AS placement_type,
-            ppv_data.modified_ts
-        FROM ppv_data
-        LEFT JOIN cf_modules cm ON ppv_data.module_id = cm.id
-        LEFT JOIN cf_content_group ccg ON cm.content_group_id = ccg.id
-        LEFT JOIN audience_segment_placement_versions aspv ON ppv_data.id_version = aspv.placementversion_id
-        LEFT JOIN cf_vehicle_placement_position cvpp ON ppv_data.vehicle_placement_position_id = cvpp.id
-        LEFT JOIN cf_placement_type pt ON cvpp.placement_type_id = pt.id
-        WHERE ppv_data.id_tactic NOT IN(1267
-        ,1271
-        ,1277
-        ,1280
-        ,1285
-        ,1270
-        ,1279
-        ,1274
-        ,1272
-        ,1265
-        ,1261
-        ,1264
-        ,1262
-        ,1275
-        ,1259
-        ,1283
-        ,1281
-        ,1273
-        ,1284
-        ,1263
-        ,1282
-        ,1286
-        ,1266
-        ,1278
-        ,1260
-        ,1269
-        ,1268
-        ,1276);
-    '''
-
-    source_cursor.execute(source_query, (latest_ingest_start_ts,))
-    rows = source_cursor.fetchall()
-    
-    if not rows:
-        print("No new or updated records found. No changes made.")
-    else:
-        # Extract column names
-        columns = [desc[0] for desc in source_cursor.description]
-        column_names = ', '.join(columns)
-        placeholders = ', '.join(['%s'] * len(columns))
-        
-        # Construct update clause dynamically
-        update_clause = ', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col != key])
-
-        # Extracting IDs for logging
-        record_ids = [str(row[0]) for row in rows]  # row[0] = id_treatment
-        record_ids_str = ', '.join(record_ids)  # Convert list to comma-separated string
-
-        # Upsert query with ON CONFLICT
-        upsert_query = f'''
-            INSERT INTO analytical_model.{table_name} ({column_names})
-            VALUES ({placeholders})
-            ON CONFLICT ({key}) DO UPDATE SET {update_clause};
-        '''
-
-        # Bulk execute upsert query
-        dest_cursor.executemany(upsert_query, rows)
-        dest_conn.commit()
-
-        # Record end timestamp
-        ingest_end_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-        # Log ingestion including IDs
-        log_query = f'''
-            INSERT INTO analytical_model.{update_log_table} ("table", ingest_start_ts, ingest_end_ts, "type", "count", ids)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        '''
-        dest_cursor.execute(log_query, (table_name, ingest_start_ts, ingest_end_ts, "upsert", len(rows), record_ids_str))
-        dest_conn.commit()
-
-        print(f"Upserted {len(rows)} records in {table_name}")
-        print("Update log recorded.")
-
-    # Close connections
-    source_cursor.close()
-    source_conn.close()
-    dest_cursor.close()
-    dest_conn.close()
-
-except Exception as e:
-    print("Error:", e)
+# Stream the source through a server-side cursor in fixed-size batches
+# instead of fetchall(), so a first run or large backfill can't OOM the driver
+stream_extract = True
+stream_itersize = 10000
+stream_batch_size = 50000
+
+# Streamed batches start at stream_batch_size rows and are then resized after every batch
+# to stay under batch_memory_budget bytes of fetched rows and batch_target_seconds of
+# destination load and commit time. Each batch of an upserted table commits on its own,
+# bounding lock hold time and WAL bursts; set both to 0 for fixed batches in one transaction
+batch_memory_budget = 256 * 1024 * 1024
+batch_target_seconds = 2.0
+
+# Tables whose spec is marked pipe (the query only projects and renames columns)
+# skip Python rows entirely: COPY TO STDOUT on the source is piped into COPY FROM STDIN here.
+# "binary" avoids text parsing but needs source and target column types to match exactly
+pipe_extract = True
+pipe_copy_format = "text"
+
+# Tables whose source lives in the destination database (treatment) are refreshed
+# with one server-side INSERT ... SELECT, so no rows cross the wire
+server_side_same_db = True
+
+# First loads (no watermark or update_log history) walk the source key in chunks of
+# backfill_chunk_size keys, committing and checkpointing each chunk so an interrupted
+# backfill resumes where it stopped; chunks load backfill_workers at a time
+backfill_chunk_size = 50000
+backfill_workers = 1
+
+# Tables rebuilt from scratch this run instead of refreshed incrementally, e.g. after a
+# source-side correction: the full source is loaded into an unindexed shadow table with
+# invalid rows filtered out, indexed, analyzed and swapped in by rename
+rebuild_tables = []
+
+# Large sources can be extracted as parallel hash slices, each on its own source
+# connection, all feeding one staging load; {table name: number of slices}. version
+# numbers positions across the whole delta and cannot be sliced
+extract_partitions = {"link": 1}
+
+# How many table refreshes may run at the same time
+refresh_max_workers = 4
+
+# Refresh every table on one asyncio event loop with psycopg 3, overlapping source
+# fetches with destination COPY writes (needs psycopg[binary]); first loads still backfill,
+# and tables with a piped COPY or INSERT ... SELECT path keep it, so with the default
+# settings only version streams through the event loop. Its connections take slots from
+# source_pool and dest_pool, so refresh_max_workers still caps them
+async_refresh = False
+async_queue_size = 4
+
+# Apply source changes from a logical replication slot instead of polling watermarks, for
+# campaign, tactic, version, offer and link (treatment is still polled). Needs wal_level=logical
+# and a REPLICATION role on the source; the first run creates the slot and loads once by polling.
+# Each run then applies committed changes for cdc_run_seconds, within cdc_max_latency seconds
+cdc_mode = False
+cdc_slot_name = "refresh_cdc"
+cdc_run_seconds = 300
+cdc_max_latency = 1.0
+
+# Keep refreshing instead of running once: each table is polled every daemon_intervals[table]
+# seconds (daemon_default_interval otherwise), backing off up to daemon_max_interval while its
+# deltas are empty, and loaded rows are cleansed every daemon_cleanse_interval seconds.
+# Runs for daemon_run_seconds, or until the cell is cancelled when None
+daemon_mode = False
+daemon_intervals = {"campaign": 300, "offer": 300}
+daemon_default_interval = 60
+daemon_max_interval = 900
+daemon_cleanse_interval = 300
+daemon_run_seconds = None
+
+# The cleanse only re-validates rows touched since the last cleanse; set to True
+# to re-validate the whole model (it also runs full when the validated list changes)
+full_cleanse = False
+
+# Report each table's watermark, delta size and EXPLAIN (ANALYZE, BUFFERS) source plan, plus
+# the delete plans of the cleanse that would run (full or incremental), without changing
+# anything. Plans are kept in dry_run_plan_dir and compared with the previous dry run to
+# flag plan regressions
+dry_run = False
+dry_run_plan_dir = "dry_run_plans"
+
+# Every table refresh and the cleanse record per-stage seconds, rows and bytes into
+# analytical_model.refresh_metrics and as one JSON line per run; set a path to
+# append the JSON lines to a file instead of printing them
+metrics_jsonl_path = None
+
+# The watermark and update_log statements are prepared once per pooled connection and
+# re-executed with EXECUTE, skipping the parse and plan; set to False to send them as text
+prepare_statements = True
 
 # COMMAND ----------
 
-# DBTITLE 1,offer
-# Define the table to copy data from and to
-table_name = "offer"
-key = "id_offer"
-
-try:
-    # Connect to destination database to get the latest ingest timestamp
-    dest_conn = psycopg2.connect(**dest_conn_info)
-    dest_cursor = dest_conn.cursor()
-
-    # Fetch latest ingest timestamp for 'version'
-    dest_cursor.execute(f'''
-        SELECT MAX(ingest_start_ts) FROM analytical_model.{update_log_table}
-        WHERE "table" = %s
-    ''', (table_name,))
-    latest_ingest_start_ts = dest_cursor.fetchone()[0]
-
-    # If no previous ingestion, default to a very old date
-    if latest_ingest_start_ts is None:
-        latest_ingest_start_ts = datetime.datetime(2000, 1, 1)
-
-    # Record the new start timestamp
-    ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-    # Connect to source database
-    source_conn = psycopg2.connect(**source_conn_info)
-    source_cursor = source_conn.cursor()
-
-    # Fetch only modified records since last ingest
-    source_query = f'''
-        SELECT DISTINCT
-        o.id AS id_offer,
-        o.name || '-' || o.description AS offer_name,
-        o.offer_type,
-        '' AS hurdle_value,
-        '' AS hurdle_type,
-        '' AS promo_code,
-        value_amount AS award_value,
-        value_amount_type AS award_type,
-        o.current_status AS status,
-        CAST(o.actual_start_dt AS DATE) AS offer_start_dte,
-        CAST(o.actual_end_dt AS DATE) AS offer_end_dte, 
-        CASE WHEN o.update_dt IS NULL THEN o.created_dt ELSE o.update_dt END AS modified_ts
-        FROM paign_default_offer o 
-        LEFT JOIN paign_default_valueamounttype vat ON o.value_amount_type_id = vat.id
-        WHERE COALESCE(o.update_dt, o.created_dt) > '{latest_ingest_start_ts}'
-    '''
-
-    source_cursor.execute(source_query, (latest_ingest_start_ts,))
-    rows = source_cursor.fetchall()
-    
-    if not rows:
-        print("No new or updated records found. No changes made.")
-    else:
-        # Extract column names
-        columns = [desc[0] for desc in source_cursor.description]
-        column_names = ', '.join(columns)
-        placeholders = ', '.join(['%s'] * len(columns))
-        
-        # Construct update clause dynamically
-        update_clause = ', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col != key])
-
-        # Extracting IDs for logging
-        record_ids = [str(row[0]) for row in rows]  # row[0] = id_treatment
-        record_ids_str = ', '.join(record_ids)  # Convert list to comma-separated string
-
-        # Upsert query with ON CONFLICT
-        upsert_query = f'''
-            INSERT INTO analytical_model.{table_name} ({column_names})
-            VALUES ({placeholders})
-            ON CONFLICT ({key}) DO UPDATE SET {update_clause};
-        '''
-
-        # Bulk execute upsert query
-        dest_cursor.executemany(upsert_query, rows)
-        dest_conn.commit()
-
-        # Record end timestamp
-        ingest_end_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-        # Log ingestion including IDs
-        log_query = f'''
-            INSERT INTO analytical_model.{update_log_table} ("table", ingest_start_ts, ingest_end_ts, "type", "count", ids)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        '''
-        dest_cursor.execute(log_query, (table_name, ingest_start_ts, ingest_end_ts, "upsert", len(rows), record_ids_str))
-        dest_conn.commit()
-
-        print(f"Upserted {len(rows)} records in {table_name}")
-        print("Update log recorded.")
-
-    # Close connections
-    source_cursor.close()
-    source_conn.close()
-    dest_cursor.close()
-    dest_conn.close()
-
-except Exception as e:
-    print("Error:", e)
+# DBTITLE 1,important setup
+import functools
+
+from refresh.engine import RefreshOptions, ensure_refresh_stores, table_refresh_tasks
+from refresh.metrics import JsonLinesExporter, MetricsTableExporter, add_exporter, clear_exporters, \
+    ensure_metrics_store, run_metrics, stage
+from refresh.pool import ConnectionPool
+from refresh.rebuild import rebuild_table
+from refresh.scheduler import run_dependency_graph
+from refresh.statements import set_prepared_statements
+from refresh.tables import TABLE_SPECS
+
+# Shared connection pools; every refresh step and the validation functions
+# borrow from these instead of opening their own connections. The treatment
+# step holds two destination connections at once, hence the extra slot. Every
+# slot's connection is opened up front and kept open between checkouts, so
+# refreshes never pay the connect/auth handshake twice
+source_pool = ConnectionPool(source_conn_info, maxconn=refresh_max_workers, name="source")
+dest_pool = ConnectionPool(dest_conn_info, maxconn=refresh_max_workers + 1, name="dest")
+
+# Per-table watermarks live in analytical_model.refresh_watermark; update_log is audit only
+# and records how many rows each run inserted, updated and skipped as unchanged
+# A dry run changes nothing, so it relies on a destination an earlier run has set up
+if not dry_run:
+    with dest_pool.connection() as setup_conn:
+        # IDs the source queries skip (e.g. excluded tactics) live in analytical_model.refresh_exclusion;
+        # manage them with refresh.exclusions.add_exclusions / remove_exclusions
+        ensure_refresh_stores(setup_conn.cursor(), update_log_table)
+        ensure_metrics_store(setup_conn.cursor())
+        setup_conn.commit()
+
+set_prepared_statements(prepare_statements)
+
+# Stage metrics exporters; cleared first so re-running this cell doesn't register them twice
+clear_exporters()
+add_exporter(JsonLinesExporter(metrics_jsonl_path))
+if not dry_run:
+    add_exporter(MetricsTableExporter(dest_pool))
 
 # COMMAND ----------
 
-# DBTITLE 1,link
-# Define the table to copy data from and to
-table_name = "link"
-key = "id_link"
-
-try:
-    # Connect to destination database to get the latest ingest timestamp
-    dest_conn = psycopg2.connect(**dest_conn_info)
-    dest_cursor = dest_conn.cursor()
-
-    # Fetch latest ingest timestamp for 'version'
-    dest_cursor.execute(f'''
-        SELECT MAX(ingest_start_ts) FROM analytical_model.{update_log_table}
-        WHERE "table" = %s
-    ''', (table_name,))
-    latest_ingest_start_ts = dest_cursor.fetchone()[0]
-
-    # If no previous ingestion, default to a very old date
-    if latest_ingest_start_ts is None:
-        latest_ingest_start_ts = datetime.datetime(2000, 1, 1)
-
-    # Record the new start timestamp
-    ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-    # Connect to source database
-    source_conn = psycopg2.connect(**source_conn_info)
-    source_cursor = source_conn.cursor()
-
-    # Fetch only modified records since last ingest
-    source_query = f'''
-            SELECT DISTINCT
-            l.id AS id_link,
-            v.id AS id_version,
-            split_part(l."original_url", '/', 1) AS domain,
-            l.original_url AS base_url,
-            l.final_url,
-            l.linked_text AS cta_text,
-            l.bit_type_name AS link_type,
-            l.created_ts AS modified_ts
-            FROM paign_module_link_ids_prod l
-            JOIN paign_placement_version v
-            ON v.tactic_id = l.tactic_id AND l.module_id = v.module_id
-            WHERE outdated_flag IS false AND l.created_ts > '{latest_ingest_start_ts}';
-        '''
-
-    source_cursor.execute(source_query, (latest_ingest_start_ts,))
-    rows = source_cursor.fetchall()
-    
-    if not rows:
-        print("No new or updated records found. No changes made.")
-    else:
-        # Extract column names
-        columns = [desc[0] for desc in source_cursor.description]
-        column_names = ', '.join(columns)
-        placeholders = ', '.join(['%s'] * len(columns))
-        
-        # Construct update clause dynamically
-        update_clause = ', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col != key])
-
-        # Extracting IDs for logging
-        record_ids = [str(row[0]) for row in rows]  # row[0] = id_treatment
-        record_ids_str = ', '.join(record_ids)  # Convert list to comma-separated string
-
-        # Upsert query with ON CONFLICT
-        upsert_query = f'''
-            INSERT INTO analytical_model.{table_name} ({column_names})
-            VALUES ({placeholders})
-            --ON CONFLICT ({key}) DO UPDATE SET {update_clause};
-        '''
-
-        # Bulk execute upsert query
-        dest_cursor.executemany(upsert_query, rows)
-        dest_conn.commit()
-
-        # Record end timestamp
-        ingest_end_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-        # Log ingestion including IDs
-        log_query = f'''
-            INSERT INTO analytical_model.{update_log_table} ("table", ingest_start_ts, ingest_end_ts, "type", "count", ids)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        '''
-        dest_cursor.execute(log_query, (table_name, ingest_start_ts, ingest_end_ts, "upsert", len(rows), record_ids_str))
-        dest_conn.commit()
-
-        print(f"Upserted {len(rows)} records in {table_name}")
-        print("Update log recorded.")
-
-    # Close connections
-    source_cursor.close()
-    source_conn.close()
-    dest_cursor.close()
-    dest_conn.close()
-
-except Exception as e:
-    print("Error:", e)
-
-# COMMAND ----------
-
-# DBTITLE 1,treatment
-# Define the table to copy data from and to
-table_name = "treatment"
-key = "id_treatment"
-
-dest_schema2 = "public" 
-
-dest_conn = psycopg2.connect(**dest_conn_info)
-dest_cursor = dest_conn.cursor()
-
-try:
-    # Fetch latest ingest timestamp for 'version'
-    dest_cursor.execute(f'''
-        SELECT MAX(ingest_start_ts) FROM analytical_model.{update_log_table}
-        WHERE "table" = %s
-    ''', (table_name,))
-    latest_ingest_start_ts = dest_cursor.fetchone()[0]
-
-    # If no previous ingestion, default to a very old date
-    if latest_ingest_start_ts is None:
-        latest_ingest_start_ts = datetime.datetime(2000, 1, 1)
-
-    # Record the new start timestamp
-    ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-    # Connect to source database
-    source_conn = psycopg2.connect(**dest_conn_info)  # Using dest_conn_info
-    source_cursor = source_conn.cursor()
-
-    # Fetch only modified records since last ingest
-    source_query = f'''
-        SELECT DISTINCT
-            id,
-            treatment_id as id_treatment,
-            pv_id as id_version,
-            created_at as modified_ts
-        FROM {dest_schema2}.treatment_placement_versions
-        WHERE created_at > %s;
-    '''
-
-    source_cursor.execute(source_query, (latest_ingest_start_ts,))
-    rows = source_cursor.fetchall()
-    
-    if not rows:
-        print("No new or updated records found. No changes made.")
-    else:
-        # Extract column names
-        columns = [desc[0] for desc in source_cursor.description]
-        column_names = ', '.join(columns)
-        placeholders = ', '.join(['%s'] * len(columns))
-        
-        # Construct update clause dynamically
-        update_clause = ', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col != key])
-
-        # Extracting IDs for logging
-        record_ids = [str(row[0]) for row in rows]  # row[0] = id_treatment
-        record_ids_str = ', '.join(record_ids)
-
-        # Upsert query with ON CONFLICT
-        upsert_query = f'''
-            INSERT INTO analytical_model.{table_name} ({column_names})
-            VALUES ({placeholders})
-            --ON CONFLICT ({key}) DO UPDATE SET {update_clause};
-        '''
-
-        # Bulk execute upsert query
-        dest_cursor.executemany(upsert_query, rows)
-        dest_conn.commit()
-
-        # Record end timestamp
-        ingest_end_ts = datetime.datetime.utcnow().replace(tzinfo=None)
-
-        # Log ingestion including IDs
-        log_query = f'''
-            INSERT INTO analytical_model.{update_log_table} ("table", ingest_start_ts, ingest_end_ts, "type", "count", ids)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        '''
-        dest_cursor.execute(log_query, (table_name, ingest_start_ts, ingest_end_ts, "upsert", len(rows), record_ids_str))
-        dest_conn.commit()
-
-        print(f"Upserted {len(rows)} records in {table_name}")
-        print("Update log recorded.")
-
-    # Close connections
-    source_cursor.close()
-    source_conn.close()
-    dest_cursor.close()
-    dest_conn.close()
-
-except Exception as e:
-    print("Error:", e)
-
+# DBTITLE 1,table refresh
+# Every table in refresh/tables.py TABLE_SPECS is refreshed by the same engine:
+# watermark read, extract, COPY staging load and upsert, watermark advance and
+# update_log entry. Add a table by adding a spec there, not another cell
+refresh_options = RefreshOptions(
+    stream=stream_extract,
+    itersize=stream_itersize,
+    batch_size=stream_batch_size,
+    batch_memory_budget=batch_memory_budget,
+    batch_target_seconds=batch_target_seconds,
+    pipe=pipe_extract,
+    copy_format=pipe_copy_format,
+    server_side=server_side_same_db,
+    backfill_chunk_size=backfill_chunk_size,
+    backfill_workers=backfill_workers,
+    partitions=extract_partitions,
+    update_log_table=update_log_table,
+)
+
+table_tasks, table_dependencies = table_refresh_tasks(TABLE_SPECS, source_pool, dest_pool, refresh_options)
+for spec in TABLE_SPECS:
+    if spec.name in rebuild_tables:
+        table_tasks[spec.name] = functools.partial(rebuild_table, spec, source_pool, dest_pool, refresh_options)
 
 # COMMAND ----------
 
 # DBTITLE 1,define valid data
-import psycopg2
+from refresh.validation import CLOSURE_KEYS, build_valid_id_closure, closure_cache_table, run_cleanse
 
-def get_valid_ids(dest_conn_info, source_conn_info):
+def get_valid_ids(dest_pool):
     """
     Retrieves valid campaign, tactic, version, and offer IDs from the appropriate tables.
-    Now pulls valid tactics, versions, and offers from the destination DB instead of the source DB.
+    The closure is cached server-side in analytical_model.cached_valid_* and only patched for
+    the tactics and versions refreshed since it was last brought up to date; read back as sets.
     """
     valid_campaign_ids, valid_tactic_ids, valid_version_ids, valid_offer_ids = set(), set(), set(), set()
 
     try:
-        # Step 1: Get valid campaign IDs from the destination DB
-        with psycopg2.connect(**dest_conn_info) as dest_conn:
-            with dest_conn.cursor() as dest_cursor:
-                dest_cursor.execute('''
-                    SELECT id_campaign FROM analytical_model.validated_campaigns_02282025
-                ''')
-                valid_campaign_ids = {row[0] for row in dest_cursor.fetchall()}  # Convert to a set
-
-        if not valid_campaign_ids:
-            print("No validated campaigns found.")
-            return valid_campaign_ids, valid_tactic_ids, valid_version_ids, valid_offer_ids
-
-        # Step 2: Get valid tactic IDs from the destination DB
-        with psycopg2.connect(**dest_conn_info) as dest_conn:
+        with dest_pool.connection() as dest_conn:
             with dest_conn.cursor() as dest_cursor:
-                dest_cursor.execute('''
-                    SELECT DISTINCT id_tactic FROM analytical_model.tactic
-                    WHERE id_campaign = ANY(%s)
-                ''', (list(valid_campaign_ids),))
-                valid_tactic_ids = {row[0] for row in dest_cursor.fetchall()}  # Convert to a set
+                # Bring the cached campaign -> tactic -> version -> offer closure up to date
+                closure_counts = build_valid_id_closure(dest_cursor, update_log_table=update_log_table)
 
-                if not valid_tactic_ids:
+                if not closure_counts["valid_campaign"]:
+                    print("No validated campaigns found.")
+                elif not closure_counts["valid_tactic"]:
                     print("No valid tactics found.")
-                    return valid_campaign_ids, valid_tactic_ids, valid_version_ids, valid_offer_ids
-
-                # Step 3: Get valid version IDs from the destination DB
-                dest_cursor.execute('''
-                    SELECT DISTINCT id_version FROM analytical_model.version
-                    WHERE id_tactic = ANY(%s)
-                ''', (list(valid_tactic_ids),))
-                valid_version_ids = {row[0] for row in dest_cursor.fetchall()}  # Convert to a set
-
-                # Step 4: Get valid offer IDs from the version table in the destination DB
-                dest_cursor.execute('''
-                    SELECT DISTINCT id_offer FROM analytical_model.version
-                    WHERE id_tactic = ANY(%s) AND id_offer IS NOT NULL
-                ''', (list(valid_tactic_ids),))
-                valid_offer_ids = {row[0] for row in dest_cursor.fetchall()}  # Convert to a set
+
+                valid_sets = []
+                for closure_table, column in CLOSURE_KEYS.items():
+                    dest_cursor.execute(f"SELECT {column} FROM {closure_cache_table(closure_table)}")
+                    valid_sets.append({row[0] for row in dest_cursor.fetchall()})  # Convert to a set
+                valid_campaign_ids, valid_tactic_ids, valid_version_ids, valid_offer_ids = valid_sets
+            # Keep the cache update
+            dest_conn.commit()
 
         return valid_campaign_ids, valid_tactic_ids, valid_version_ids, valid_offer_ids
 
@@ -746,48 +224,70 @@ def get_valid_ids(dest_conn_info, source_conn_info):
 
 # COMMAND ----------
 
-import psycopg2
-
-def cleanse_invalid_records(dest_conn_info, source_conn_info):
+def cleanse_invalid_records(dest_pool, full=False):
     """
     Removes records from tables in the destination database that do not exist in the valid ID lists.
+    Runs entirely server-side: the valid closure goes into temp tables and deletes are anti-joins.
+    Incremental by default: only rows logged in update_log since the last cleanse (and their
+    dependents) are re-validated, unless full is set or the validated campaign list changed.
     """
     try:
-        # Fetch valid IDs
-        valid_campaign_ids, valid_tactic_ids, valid_version_ids, valid_offer_ids = get_valid_ids(dest_conn_info, source_conn_info)
-
-        # Connect to the destination database
-        dest_conn = psycopg2.connect(**dest_conn_info)
-        dest_cursor = dest_conn.cursor()
-
-        # Define tables and corresponding valid ID lists
-        tables_to_clean = {
-            "campaign": ("id_campaign", valid_campaign_ids),
-            "link": ("id_version", valid_version_ids),
-            "offer": ("id_offer", valid_offer_ids),
-            "tactic": ("id_tactic", valid_tactic_ids),
-            "version": ("id_version", valid_version_ids),
-            "treatment": ("id_version", valid_version_ids)
-        }
-
-        # Iterate over tables and remove invalid records
-        for table, (column, valid_ids) in tables_to_clean.items():
-            if valid_ids:  # Only proceed if there are valid IDs
-                query = f'''
-                    DELETE FROM analytical_model.{table}
-                    WHERE {column} NOT IN %s
-                '''
-                dest_cursor.execute(query, (tuple(valid_ids),))
-                print(f"Cleaned up {table}: Removed records not in valid IDs.")
-
-        # Commit changes and close connection
-        dest_conn.commit()
-        dest_cursor.close()
-        dest_conn.close()
-        print("Cleanup process completed successfully.")
+        # Borrow a pooled connection to the destination database; the cleanse is its own metrics run
+        with run_metrics("cleanse"), dest_pool.connection() as dest_conn:
+            dest_cursor = dest_conn.cursor()
+
+            # Remove invalid records and advance the cleanse checkpoint in one transaction
+            mode, deleted = run_cleanse(dest_cursor, full=full, update_log_table=update_log_table)
+            for table, count in deleted.items():
+                print(f"Cleaned up {table} ({mode}): Removed {count} records not in valid IDs.")
+
+            # Commit changes
+            with stage("commit"):
+                dest_conn.commit()
+            dest_cursor.close()
+        print(f"Cleanup process completed successfully ({mode} cleanse).")
 
     except Exception as e:
         print("Error during cleanup:", e)
 
-# Run the cleanup process
-cleanse_invalid_records(dest_conn_info, source_conn_info)
+# COMMAND ----------
+
+# DBTITLE 1,run refresh
+# Independent tables refresh concurrently; a step starts once everything it
+# depends on has finished. If a table fails, its dependents are skipped, so
+# the cleanse only runs against a fully refreshed model
+refresh_tasks = dict(table_tasks)
+refresh_dependencies = dict(table_dependencies)
+if async_refresh and not rebuild_tables:
+    # One step runs every table refresh on an event loop instead of one thread per table
+    from refresh.async_engine import run_async_refresh
+    refresh_tasks = {"tables": lambda: run_async_refresh(TABLE_SPECS, source_pool, dest_pool, refresh_options,
+                                                         refresh_max_workers, async_queue_size)}
+    refresh_dependencies = {}
+elif cdc_mode and not rebuild_tables:
+    # One step streams the slot for every change-captured table; the rest keep polling
+    from refresh.cdc import cdc_targets, run_cdc
+    refresh_tasks = {name: task for name, task in table_tasks.items() if name not in cdc_targets()}
+    refresh_dependencies = {name: [dependency for dependency in table_dependencies.get(name, [])
+                                   if dependency not in cdc_targets()] for name in refresh_tasks}
+    refresh_tasks["cdc"] = lambda: run_cdc(TABLE_SPECS, source_pool, dest_pool, refresh_options, cdc_slot_name,
+                                           run_seconds=cdc_run_seconds, max_latency=cdc_max_latency)
+
+refresh_dependencies["cleanse"] = list(refresh_tasks)
+refresh_tasks["cleanse"] = lambda: cleanse_invalid_records(dest_pool, full=full_cleanse)
+
+if dry_run:
+    from refresh.dry_run import dry_run_refresh
+    dry_run_refresh(TABLE_SPECS, source_pool, dest_pool, refresh_options, plan_dir=dry_run_plan_dir,
+                    full_cleanse=full_cleanse)
+elif daemon_mode:
+    from refresh.daemon import RefreshDaemon
+    RefreshDaemon(TABLE_SPECS, source_pool, dest_pool, refresh_options, daemon_intervals, daemon_default_interval,
+                  daemon_max_interval, cleanse_interval=daemon_cleanse_interval,
+                  max_workers=refresh_max_workers).run(daemon_run_seconds)
+else:
+    run_dependency_graph(refresh_tasks, refresh_dependencies, max_workers=refresh_max_workers)
+
+# Connection pool usage, for sizing refresh_max_workers and the pools
+source_pool.report()
+dest_pool.report()
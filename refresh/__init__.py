@@ -0,0 +1,21 @@
+"""
+Shared helpers for the analytical_model refresh notebook.
+"""
+from refresh.async_engine import refresh_table_async, refresh_tables_async, run_async_refresh
+from refresh.backfill import ensure_backfill_store, run_backfill
+from refresh.batching import AdaptiveBatcher
+from refresh.bulk_load import copy_upsert
+from refresh.cdc import consume_changes, run_cdc
+from refresh.copy_pipe import pipe_copy
+from refresh.engine import RefreshOptions, TableSpec, ensure_refresh_stores, ensure_update_log_counts, refresh_table, \
+    table_refresh_tasks
+from refresh.extract import fetch_all, stream_batches
+from refresh.id_log import compact_ids, expand_ids, read_logged_ids
+from refresh.metrics import JsonLinesExporter, MetricsTableExporter, add_exporter, ensure_metrics_store, run_metrics, \
+    stage
+from refresh.partitioned import partitioned_delta
+from refresh.pool import ConnectionPool
+from refresh.rebuild import rebuild_table
+from refresh.scheduler import run_dependency_graph
+from refresh.transfer import TransferResult, pipe_delta, transfer_delta
+from refresh.watermark import advance_watermark, ensure_watermark_store, read_watermark, watermark_params
@@ -0,0 +1,391 @@
+"""
+Pipelined refresh engine on asyncio and psycopg 3.
+
+The sync engine runs execute, fetch, write and commit strictly in turn, so
+one database always sits idle. Here each table refresh runs two tasks: a
+producer fetching batches from a server-side cursor on the source, and a
+loader COPYing them into the staging table on the destination. They are
+joined by a bounded asyncio.Queue, so batch N+1 is read while batch N is
+written, and a full queue stops the producer, holding memory at queue_size
+batches. Independent tables refresh concurrently on one event loop, and
+the closing watermark, commit and update_log statements go out in one
+pipeline-mode round trip.
+
+The watermark, staging, merge and update_log SQL is shared with the sync
+engine. First loads still go through the sync chunked backfill, run in a
+worker thread. Partitioned extraction, piped COPY and the same-database
+INSERT ... SELECT are sync-engine features, and faster than streaming, so
+a spec that would take one of them is refreshed by the sync engine in a
+worker thread too; only specs the sync engine would stream stream here.
+With the default RefreshOptions that is version alone (every other spec
+pipes or reads the destination), and only when the source is another
+database; see streams().
+
+Finished runs go to the metrics exporters from a worker thread, since
+exporters such as MetricsTableExporter block on database I/O.
+
+Connections are opened with the ConnectionPools' settings and kept open
+for the whole run, and every checkout takes one of its pool's slots, so
+the async engine shares the pools' limits and counters.
+
+Needs psycopg 3 (pip install "psycopg[binary]"); the rest of the package
+stays on psycopg2.
+"""
+import asyncio
+import datetime
+from contextlib import asynccontextmanager
+
+try:
+    import psycopg
+    from psycopg.conninfo import make_conninfo
+except ImportError:
+    psycopg = None
+
+from refresh.backfill import key_range_params, run_backfill
+from refresh.bulk_load import format_copy_row, merge_staging_sql, staging_table_sql
+from refresh.engine import RefreshOptions, needs_backfill, refresh_table
+from refresh.exclusions import EXCLUDED_IDS_QUERY, exclusion_params
+from refresh.id_log import UPDATE_LOG_INSERT, compact_ids_sql
+from refresh.metrics import export, run_metrics, stage
+from refresh.partitioned import partition_params, slice_count
+from refresh.transfer import TransferResult, newest_mark_sql
+from refresh.watermark import ADVANCE_WATERMARK, INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, SEED_WATERMARK_QUERY, \
+    STORED_WATERMARK_QUERY, WATERMARK_TABLE, watermark_params
+
+
+def _require_psycopg():
+    if psycopg is None:
+        raise ImportError('The async refresh engine needs psycopg 3: pip install "psycopg[binary]"')
+
+
+class AsyncConnections:
+    """
+    psycopg 3 async connections opened with ConnectionPools' settings and
+    kept open until close(). Each checkout holds one of its pool's maxconn
+    slots and counts as a pool checkout.
+    """
+
+    def __init__(self):
+        # {ConnectionPool: [idle AsyncConnection]}
+        self._idle = {}
+
+    @asynccontextmanager
+    async def connection(self, pool):
+        """
+        Borrows a connection to pool's database for the duration of the
+        async with block; anything left uncommitted is rolled back after.
+        """
+        _require_psycopg()
+        await _acquire_slot(pool)
+        idle = self._idle.setdefault(pool, [])
+        try:
+            if idle:
+                conn = idle.pop()
+            else:
+                conn = await psycopg.AsyncConnection.connect(make_conninfo(**pool.conn_info))
+                pool.count_opened()
+        except BaseException:
+            pool.release_slot()
+            raise
+
+        try:
+            yield conn
+        finally:
+            if not conn.closed:
+                try:
+                    await conn.rollback()
+                except Exception:
+                    await conn.close()
+            if not conn.closed:
+                idle.append(conn)
+            pool.release_slot()
+
+    async def close(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                await conn.close()
+        self._idle.clear()
+
+
+async def _acquire_slot(pool):
+    """
+    Waits for one of pool's slots in a worker thread, without blocking the loop.
+    """
+    acquiring = asyncio.ensure_future(asyncio.to_thread(pool.acquire_slot))
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        # The thread still takes the slot; hand it back once it has
+        acquiring.add_done_callback(lambda done: done.cancelled() or done.exception() or pool.release_slot())
+        raise
+
+
+def streams(spec, source_pool, dest_pool, options):
+    """
+    True when the sync engine would stream spec as well, i.e. has no faster
+    path for it (partitioned extraction, piped COPY or a same-database
+    INSERT ... SELECT).
+    """
+    query_pool = dest_pool if spec.source == "dest" else source_pool
+    same_database = query_pool is dest_pool or all(query_pool.conn_info.get(name) == dest_pool.conn_info.get(name)
+                                                   for name in ("host", "port", "dbname"))
+    return not (slice_count(spec, options.partitions) > 1 or (options.pipe and spec.pipe)
+                or (options.server_side and same_database))
+
+
+@asynccontextmanager
+async def run_metrics_async(name):
+    """
+    run_metrics for a coroutine. Exporters do blocking I/O (MetricsTableExporter
+    waits for a pooled connection and inserts), so they run in a worker thread
+    instead of stalling the event loop.
+    """
+    try:
+        with run_metrics(name, export_on_exit=False) as run:
+            yield run
+    finally:
+        await asyncio.to_thread(export, run)
+
+
+async def read_watermark_async(cursor, table_name, schema="analytical_model", update_log_table="update_log"):
+    """
+    read_watermark for a psycopg 3 async cursor.
+    """
+    await cursor.execute(STORED_WATERMARK_QUERY.format(schema=schema, watermark_table=WATERMARK_TABLE),
+                         (table_name,))
+    row = await cursor.fetchone()
+    if row is not None:
+        return row[0], row[1]
+
+    await cursor.execute(SEED_WATERMARK_QUERY.format(schema=schema, update_log_table=update_log_table),
+                         (table_name,))
+    last_ingest_start_ts = (await cursor.fetchone())[0]
+    return last_ingest_start_ts or INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY
+
+
+async def produce_batches(source_conn, table_name, query, batch_size, itersize, batches):
+    """
+    Reads query through a server-side cursor and puts row batches on the
+    queue, ending with None, also after an error. Blocks while the queue is
+    full.
+    """
+    try:
+        async with source_conn.cursor(name=f"refresh_{table_name}") as cursor:
+            cursor.itersize = itersize
+            with stage("source_execute"):
+                await cursor.execute(query)
+
+            while True:
+                with stage("fetch") as fetch_stage:
+                    rows = await cursor.fetchmany(batch_size)
+                    fetch_stage.rows = len(rows)
+                if not rows:
+                    break
+                await batches.put(rows)
+    except Exception:
+        # Wake the loader so it stops; the error is raised when the producer is awaited
+        await batches.put(None)
+        raise
+    await batches.put(None)
+
+
+async def load_batches(dest_cursor, staging_table, columns, batches):
+    """
+    COPYs every batch from the queue into the staging table until None.
+    """
+    copy_statement = f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN"
+    while True:
+        rows = await batches.get()
+        if rows is None:
+            return
+        with stage("load") as load_stage:
+            data = "".join(format_copy_row(row) for row in rows)
+            async with dest_cursor.copy(copy_statement) as copy:
+                await copy.write(data)
+            load_stage.rows, load_stage.bytes = len(rows), len(data)
+
+
+async def stream_delta_async(source_conn, dest_conn, table_name, key, source_query, params,
+                             on_conflict=True, batch_size=50000, itersize=10000, queue_size=4):
+    """
+    Streams the delta into a staging table with fetch and load overlapped,
+    then merges it. The caller owns the destination transaction and must
+    commit. Returns a TransferResult.
+    """
+    # Bind client-side like the sync pipe path: the optional filters compare
+    # NULL parameters, whose types the server could not infer
+    query = psycopg.AsyncClientCursor(source_conn).mogrify(source_query, params).strip().rstrip(";")
+    async with source_conn.cursor() as cursor:
+        await cursor.execute(f"SELECT * FROM ({query}\n) AS q LIMIT 0")
+        columns = [column.name for column in cursor.description]
+    await source_conn.commit()
+
+    result = TransferResult()
+    staging_table = f"_stage_{table_name}"
+    async with dest_conn.cursor() as dest_cursor:
+        await dest_cursor.execute(staging_table_sql(staging_table, table_name, columns))
+
+        batches = asyncio.Queue(maxsize=queue_size)
+        producer = asyncio.create_task(produce_batches(source_conn, table_name, query, batch_size, itersize, batches))
+        try:
+            await load_batches(dest_cursor, staging_table, columns, batches)
+        finally:
+            # A failed load leaves the producer blocked on a full queue; cancel it
+            if not producer.done():
+                producer.cancel()
+            producer_error = (await asyncio.gather(producer, return_exceptions=True))[0]
+        if isinstance(producer_error, BaseException) and not isinstance(producer_error, asyncio.CancelledError):
+            raise producer_error
+
+        await dest_cursor.execute(f"SELECT COUNT(*) FROM {staging_table}")
+        result.record_count = (await dest_cursor.fetchone())[0]
+        if result.record_count:
+            await dest_cursor.execute(compact_ids_sql(staging_table, columns[0]))
+            result.logged_ids = (await dest_cursor.fetchone())[0]
+            if "modified_ts" in columns:
+                await dest_cursor.execute(newest_mark_sql(staging_table, columns[0]))
+                mark = await dest_cursor.fetchone()
+                result.add_high_water(tuple(mark) if mark else None)
+
+            with stage("merge") as merge_stage:
+                await dest_cursor.execute(merge_staging_sql(staging_table, table_name, key, columns, on_conflict))
+                result.add_counts(await dest_cursor.fetchone() if on_conflict else (dest_cursor.rowcount, 0, 0))
+                merge_stage.rows = result.record_count
+        await dest_cursor.execute(f"DROP TABLE {staging_table}")
+    await source_conn.commit()
+
+    return result
+
+
+async def refresh_table_async(spec, source_pool, dest_pool, options=None, queue_size=4, connections=None):
+    """
+    Async counterpart of engine.refresh_table, on psycopg 3 connections
+    borrowed from connections (an AsyncConnections; one is opened and closed
+    for this table when None). Specs with a faster sync path are refreshed
+    by engine.refresh_table in a worker thread. Returns the TransferResult.
+    """
+    _require_psycopg()
+    options = options or RefreshOptions()
+    if not streams(spec, source_pool, dest_pool, options):
+        return await asyncio.to_thread(refresh_table, spec, source_pool, dest_pool, options)
+
+    if connections is None:
+        connections = AsyncConnections()
+        try:
+            return await refresh_table_async(spec, source_pool, dest_pool, options, queue_size, connections)
+        finally:
+            await connections.close()
+
+    table_name = spec.name
+    query_pool = dest_pool if spec.source == "dest" else source_pool
+
+    async with run_metrics_async(table_name):
+        try:
+            if await asyncio.to_thread(needs_backfill, spec, dest_pool, options):
+                return await asyncio.to_thread(run_backfill, spec, source_pool, dest_pool, options)
+
+            async with connections.connection(dest_pool) as dest_conn, \
+                    connections.connection(query_pool) as source_conn:
+                async with dest_conn.cursor() as dest_cursor:
+                    # Read the table's watermark: the newest (modified_ts, key) loaded so far
+                    with stage("watermark_read"):
+                        watermark_ts, watermark_key = await read_watermark_async(
+                            dest_cursor, table_name, update_log_table=options.update_log_table)
+
+                    exclusions = {}
+                    if spec.exclusions:
+                        await dest_cursor.execute(EXCLUDED_IDS_QUERY.format(schema="analytical_model"),
+                                                  (list(spec.exclusions),))
+                        exclusions = exclusion_params(spec.exclusions, await dest_cursor.fetchall())
+
+                ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
+
+                # Extract and load with fetch and COPY overlapped
+                params = {**watermark_params(watermark_ts, watermark_key), **key_range_params(), **partition_params(),
+                          **exclusions}
+                result = await stream_delta_async(source_conn, dest_conn, table_name, spec.key, spec.query, params,
+                                                  on_conflict=spec.on_conflict, batch_size=options.batch_size,
+                                                  itersize=options.itersize, queue_size=queue_size)
+
+                if not result.record_count:
+                    await dest_conn.rollback()
+                    print(f"No new or updated records found in {table_name}. No changes made.")
+                    return result
+
+                # Watermark advance, update_log row and the one commit covering them and the load,
+                # in one round trip
+                with stage("commit") as commit_stage:
+                    async with dest_conn.pipeline(), dest_conn.cursor() as dest_cursor:
+                        if result.high_water is not None:
+                            await dest_cursor.execute(
+                                ADVANCE_WATERMARK.format(schema="analytical_model", watermark_table=WATERMARK_TABLE),
+                                (table_name, *result.high_water, datetime.datetime.utcnow().replace(tzinfo=None)))
+                        await dest_cursor.execute(
+                            UPDATE_LOG_INSERT.format(schema="analytical_model",
+                                                     update_log_table=options.update_log_table),
+                            (table_name, ingest_start_ts, datetime.datetime.utcnow().replace(tzinfo=None), "upsert",
+                             result.record_count, result.logged_ids, result.inserted, result.updated,
+                             result.unchanged))
+                        await dest_conn.commit()
+                    commit_stage.rows = result.record_count
+
+            print(f"Upserted {result.record_count} records in {table_name}: {result.inserted} inserted, "
+                  f"{result.updated} updated, {result.unchanged} unchanged")
+            print(f"Update log recorded for {table_name}.")
+            return result
+
+        except Exception as e:
+            print(f"Error refreshing {table_name}:", e)
+            raise
+
+
+async def refresh_tables_async(specs, source_pool, dest_pool, options=None, max_concurrency=4, queue_size=4):
+    """
+    Refreshes every spec on the running event loop, at most max_concurrency
+    at a time; a spec starts once its depends_on tables have finished and
+    is skipped if one of them failed. Returns (results, errors) keyed by
+    table name, like run_dependency_graph.
+    """
+    slots = asyncio.Semaphore(max_concurrency)
+    connections = AsyncConnections()
+    tasks = {}
+
+    async def run(spec):
+        failed = []
+        for dependency in spec.depends_on:
+            try:
+                await asyncio.shield(tasks[dependency])
+            except Exception:
+                failed.append(dependency)
+        if failed:
+            raise RuntimeError(f"Skipped because {', '.join(sorted(failed))} failed")
+        async with slots:
+            return await refresh_table_async(spec, source_pool, dest_pool, options, queue_size, connections)
+
+    for spec in specs:
+        tasks[spec.name] = asyncio.ensure_future(run(spec))
+    try:
+        outcomes = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    finally:
+        await connections.close()
+
+    results, errors = {}, {}
+    for name, outcome in zip(tasks, outcomes):
+        if isinstance(outcome, Exception):
+            errors[name] = outcome
+            print(f"Refresh step {name} did not complete:", outcome)
+        else:
+            results[name] = outcome
+    return results, errors
+
+
+def run_async_refresh(specs, source_pool, dest_pool, options=None, max_concurrency=4, queue_size=4):
+    """
+    Runs refresh_tables_async on a new event loop, for callers without one
+    (a scheduler step or a script). Raises if any table did not complete.
+    """
+    results, errors = asyncio.run(
+        refresh_tables_async(specs, source_pool, dest_pool, options, max_concurrency, queue_size))
+    if errors:
+        raise RuntimeError(f"Async refresh failed for {', '.join(sorted(errors))}")
+    return results
@@ -0,0 +1,226 @@
+"""
+Keyset-chunked, resumable first load of a table.
+
+The source key range is planned up front into chunks of chunk_size keys by
+walking the key column (id > last ORDER BY id LIMIT n). Each chunk is loaded
+and committed on its own together with its checkpoint row, so a crashed
+backfill resumes from the chunks that are still open. Chunks can load in
+parallel on separate pooled connections.
+"""
+import contextvars
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from refresh.exclusions import read_exclusions
+from refresh.id_log import UPDATE_LOG_INSERT
+from refresh.metrics import stage
+from refresh.partitioned import partition_params
+from refresh.statements import execute_prepared
+from refresh.transfer import TransferResult, transfer_delta
+from refresh.watermark import INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, WATERMARK_TABLE, advance_watermark, \
+    watermark_params
+
+BACKFILL_TABLE = "refresh_backfill"
+BACKFILL_CHUNK_TABLE = "refresh_backfill_chunk"
+
+
+def ensure_backfill_store(cursor, schema="analytical_model"):
+    """
+    Creates the backfill plan and chunk checkpoint tables if missing.
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.{BACKFILL_TABLE} (
+            table_name text PRIMARY KEY,
+            chunk_size integer NOT NULL,
+            source_start_ts timestamp NOT NULL,
+            started_at timestamp NOT NULL,
+            finished_at timestamp
+        );
+
+        CREATE TABLE IF NOT EXISTS {schema}.{BACKFILL_CHUNK_TABLE} (
+            table_name text NOT NULL,
+            chunk_no integer NOT NULL,
+            key_low bigint,
+            key_high bigint,
+            record_count integer,
+            finished_at timestamp,
+            PRIMARY KEY (table_name, chunk_no)
+        )
+    ''')
+
+
+def key_range_params(key_low=None, key_high=None, key_ids=None):
+    """
+    Query parameters for the optional key_low < key <= key_high and
+    key = ANY(key_ids) filters every table query carries. None on either side
+    leaves that side open, and None key_ids selects every key; psycopg2
+    inlines the values, so the planner folds the open filters away.
+    """
+    return {"key_low": key_low, "key_high": key_high, "key_ids": key_ids}
+
+
+def backfill_needed(cursor, table_name, schema="analytical_model", update_log_table="update_log"):
+    """
+    True when table_name has an unfinished backfill, or has never been loaded
+    (no watermark and no update_log history).
+    """
+    cursor.execute(f'''
+        SELECT
+            EXISTS (SELECT 1 FROM {schema}.{BACKFILL_TABLE} WHERE table_name = %s AND finished_at IS NULL),
+            EXISTS (SELECT 1 FROM {schema}.{BACKFILL_TABLE} WHERE table_name = %s)
+            OR EXISTS (SELECT 1 FROM {schema}.{WATERMARK_TABLE} WHERE table_name = %s)
+            OR EXISTS (SELECT 1 FROM {schema}.{update_log_table} WHERE "table" = %s)
+    ''', (table_name, table_name, table_name, table_name))
+    unfinished, loaded_before = cursor.fetchone()
+    return unfinished or not loaded_before
+
+
+def plan_backfill(source_conn, dest_conn, spec, chunk_size, schema="analytical_model"):
+    """
+    Walks the source key column in chunk_size steps and records the chunks
+    and the source's current timestamp in one destination transaction.
+    """
+    chunks = []
+    key_low = None
+    with source_conn.cursor() as source_cursor:
+        source_cursor.execute("SELECT LOCALTIMESTAMP")
+        source_start_ts = source_cursor.fetchone()[0]
+
+        while True:
+            source_cursor.execute(f'''
+                SELECT MAX(k) FROM (
+                    SELECT {spec.chunk_column} AS k FROM {spec.chunk_table}
+                    WHERE %(key_low)s IS NULL OR {spec.chunk_column} > %(key_low)s
+                    ORDER BY {spec.chunk_column}
+                    LIMIT %(chunk_size)s
+                ) s
+            ''', {"key_low": key_low, "chunk_size": chunk_size})
+            key_high = source_cursor.fetchone()[0]
+            if key_high is None:
+                break
+            chunks.append((key_low, key_high))
+            key_low = key_high
+    source_conn.commit()
+
+    # Rows with keys above the last chunk arrive after source_start_ts and are
+    # picked up by the first incremental run
+    if not chunks:
+        chunks.append((None, None))
+
+    with dest_conn.cursor() as dest_cursor:
+        dest_cursor.execute(f'''
+            INSERT INTO {schema}.{BACKFILL_TABLE} (table_name, chunk_size, source_start_ts, started_at)
+            VALUES (%s, %s, %s, %s)
+        ''', (spec.name, chunk_size, source_start_ts, datetime.datetime.utcnow().replace(tzinfo=None)))
+        dest_cursor.executemany(f'''
+            INSERT INTO {schema}.{BACKFILL_CHUNK_TABLE} (table_name, chunk_no, key_low, key_high)
+            VALUES (%s, %s, %s, %s)
+        ''', [(spec.name, chunk_no, key_low, key_high) for chunk_no, (key_low, key_high) in enumerate(chunks)])
+    dest_conn.commit()
+
+
+def load_chunk(spec, chunk, source_pool, dest_pool, options, schema="analytical_model"):
+    """
+    Loads one chunk, checkpoints it and logs it to update_log in a single
+    destination transaction. Returns the chunk's TransferResult.
+    """
+    chunk_no, key_low, key_high = chunk
+    query_pool = dest_pool if spec.source == "dest" else source_pool
+
+    with dest_pool.connection() as dest_conn, query_pool.connection() as source_conn:
+        ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
+        with dest_conn.cursor() as dest_cursor:
+            exclusions = read_exclusions(dest_cursor, spec.exclusions, schema)
+        params = {**watermark_params(INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY),
+                  **key_range_params(key_low, key_high), **partition_params(), **exclusions}
+        result = transfer_delta(source_conn, dest_conn, spec.name, spec.key, spec.query, params,
+                                on_conflict=spec.on_conflict, stream=options.stream, batch_size=options.batch_size,
+                                itersize=options.itersize, pipe=options.pipe and spec.pipe,
+                                copy_format=options.copy_format, server_side=options.server_side,
+                                batcher=options.batcher())
+
+        with dest_conn.cursor() as dest_cursor, stage("log_write"):
+            dest_cursor.execute(f'''
+                UPDATE {schema}.{BACKFILL_CHUNK_TABLE}
+                SET record_count = %s, finished_at = %s
+                WHERE table_name = %s AND chunk_no = %s
+            ''', (result.record_count, datetime.datetime.utcnow().replace(tzinfo=None), spec.name, chunk_no))
+
+            if result.record_count:
+                execute_prepared(dest_cursor,
+                                 UPDATE_LOG_INSERT.format(schema=schema, update_log_table=options.update_log_table),
+                                 (spec.name, ingest_start_ts, datetime.datetime.utcnow().replace(tzinfo=None), "upsert",
+                                  result.record_count, result.logged_ids, result.inserted, result.updated,
+                                  result.unchanged))
+        with stage("commit"):
+            dest_conn.commit()
+
+    print(f"Backfilled {spec.name} chunk {chunk_no} ({key_low}, {key_high}]: {result.record_count} records")
+    return result
+
+
+def run_backfill(spec, source_pool, dest_pool, options, schema="analytical_model"):
+    """
+    Backfills spec.name chunk by chunk, resuming an unfinished backfill if
+    there is one. With options.backfill_workers > 1, chunks load in parallel.
+    Once every chunk is in, the watermark is set to the source timestamp
+    captured before planning, so rows changed during the backfill are picked
+    up again by the next incremental run. Returns the combined TransferResult.
+    """
+    with dest_pool.connection() as dest_conn:
+        with dest_conn.cursor() as dest_cursor:
+            dest_cursor.execute(f"SELECT 1 FROM {schema}.{BACKFILL_TABLE} WHERE table_name = %s", (spec.name,))
+            planned = dest_cursor.fetchone() is not None
+        dest_conn.commit()
+
+        if not planned:
+            query_pool = dest_pool if spec.source == "dest" else source_pool
+            with query_pool.connection() as source_conn:
+                plan_backfill(source_conn, dest_conn, spec, options.backfill_chunk_size, schema)
+
+        with dest_conn.cursor() as dest_cursor:
+            dest_cursor.execute(f'''
+                SELECT chunk_no, key_low, key_high FROM {schema}.{BACKFILL_CHUNK_TABLE}
+                WHERE table_name = %s AND finished_at IS NULL
+                ORDER BY chunk_no
+            ''', (spec.name,))
+            open_chunks = dest_cursor.fetchall()
+        dest_conn.commit()
+
+    print(f"Backfilling {spec.name}: {len(open_chunks)} chunks to load"
+          + ("" if not planned else " (resumed)"))
+
+    combined = TransferResult()
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(options.backfill_workers, 1),
+                            thread_name_prefix=f"backfill-{spec.name}") as executor:
+        # Run each chunk in a copy of this context so its stages land in the caller's metrics run
+        futures = [executor.submit(contextvars.copy_context().run, load_chunk, spec, chunk, source_pool, dest_pool,
+                                   options, schema)
+                   for chunk in open_chunks]
+        for future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            combined.record_count += result.record_count
+            combined.add_counts((result.inserted, result.updated, result.unchanged))
+
+    # Finished chunks stay checkpointed; the next run resumes with the rest
+    if errors:
+        raise errors[0]
+
+    with dest_pool.connection() as dest_conn:
+        with dest_conn.cursor() as dest_cursor:
+            dest_cursor.execute(f'''
+                UPDATE {schema}.{BACKFILL_TABLE} SET finished_at = %s
+                WHERE table_name = %s
+                RETURNING source_start_ts
+            ''', (datetime.datetime.utcnow().replace(tzinfo=None), spec.name))
+            source_start_ts = dest_cursor.fetchone()[0]
+            advance_watermark(dest_cursor, spec.name, source_start_ts, INITIAL_WATERMARK_KEY, schema)
+        dest_conn.commit()
+
+    print(f"Backfill of {spec.name} finished: {combined.record_count} records")
+    return combined
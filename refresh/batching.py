@@ -0,0 +1,86 @@
+"""
+Adaptive batch sizing for the streamed load path.
+
+A fixed batch_size is either too small for narrow tables (many round trips
+and commits) or too large for wide ones (driver memory, long lock holds and
+WAL spikes on the destination). AdaptiveBatcher starts from the configured
+batch size and, after every batch, resizes the next one from what it
+measured: the Python memory per row against a memory budget, and the rows
+per second of the destination load and commit against a target per-batch
+latency. The smaller of the two limits wins. Batches grow at most twofold
+per step and shrink straight away.
+"""
+import sys
+
+
+def row_memory(rows, sample_size=100):
+    """
+    Estimated bytes a fetched row tuple holds in Python, averaged over up to
+    sample_size rows spread across the batch.
+    """
+    if not rows:
+        return 0
+    step = max(len(rows) // sample_size, 1)
+    sample = rows[::step][:sample_size]
+    total = 0
+    for row in sample:
+        # The tuple, its values and the list slot pointing at it
+        total += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) + 8
+    return total / len(sample)
+
+
+class AdaptiveBatcher:
+    """
+    Picks the size of the next batch from the ones observed so far. A
+    memory_budget of 0 bytes or a target_seconds of 0 disables that limit.
+    """
+
+    def __init__(self, memory_budget=0, target_seconds=0.0, initial_size=50000, min_size=1000,
+                 max_size=1000000, smoothing=0.5):
+        self.memory_budget = memory_budget
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        # Weight of the newest batch in the running row width and throughput
+        self.smoothing = smoothing
+        self.size = min(max(initial_size, min_size), max_size)
+        self.row_bytes = None
+        self.rows_per_second = None
+        # (rows, seconds) of every batch observed, for reporting
+        self.history = []
+
+    def _smooth(self, current, observed):
+        if current is None:
+            return observed
+        return self.smoothing * observed + (1 - self.smoothing) * current
+
+    def observe(self, rows, row_bytes, seconds):
+        """
+        Records a finished batch of `rows` rows, row_bytes per row in memory,
+        that took `seconds` to load and commit, and resizes the next batch.
+        """
+        self.history.append((rows, seconds))
+        if not rows:
+            return self.size
+        self.row_bytes = self._smooth(self.row_bytes, row_bytes)
+        if seconds > 0:
+            self.rows_per_second = self._smooth(self.rows_per_second, rows / seconds)
+
+        limits = [self.max_size, self.size * 2]
+        if self.memory_budget and self.row_bytes:
+            limits.append(self.memory_budget / self.row_bytes)
+        if self.target_seconds and self.rows_per_second:
+            limits.append(self.target_seconds * self.rows_per_second)
+        self.size = max(int(min(limits)), self.min_size)
+        return self.size
+
+    def summary(self):
+        """
+        One line describing the batches observed, for the refresh log.
+        """
+        if not self.history:
+            return "no batches"
+        sizes = [rows for rows, _ in self.history]
+        slowest = max(seconds for _, seconds in self.history)
+        return (f"{len(sizes)} batches of {min(sizes)}-{max(sizes)} rows, slowest {slowest:.2f}s, "
+                f"~{(self.row_bytes or 0):.0f} bytes per row")
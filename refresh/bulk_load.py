@@ -0,0 +1,197 @@
+"""
+COPY-based bulk loading into analytical_model tables.
+
+Rows are streamed into a temp staging table with COPY FROM STDIN and then
+merged into the target with one set-based INSERT ... SELECT, instead of one
+network round trip per row with executemany.
+"""
+import datetime
+
+from refresh.metrics import stage
+from refresh.statements import statement_text
+
+
+def format_copy_value(value):
+    """
+    Renders a single Python value as a field in COPY text format.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (datetime.date, datetime.time)):
+        text = value.isoformat()
+    else:
+        text = str(value)
+    # Escape the characters COPY text format treats specially
+    return (
+        text.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def format_copy_row(row):
+    """
+    Renders a row tuple as one tab-separated COPY text line.
+    """
+    return "\t".join(format_copy_value(value) for value in row) + "\n"
+
+
+class RowCopyStream:
+    """
+    File-like object that renders rows as COPY text lines on demand, so the
+    payload for a large row list is never built as one big string.
+    rows_read and chars_read count what has been rendered so far.
+    """
+
+    def __init__(self, rows):
+        self._lines = (format_copy_row(row) for row in rows)
+        self._pending = ""
+        self.rows_read = 0
+        self.chars_read = 0
+
+    def read(self, size=-1):
+        parts = [self._pending]
+        length = len(self._pending)
+        while size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            length += len(line)
+            self.rows_read += 1
+            self.chars_read += len(line)
+
+        data = "".join(parts)
+        if size < 0:
+            self._pending = ""
+            return data
+        self._pending = data[size:]
+        return data[:size]
+
+
+def create_staging_table(cursor, table_name, columns, schema="analytical_model"):
+    """
+    Creates an empty temp table shaped like the target columns, plus a
+    _load_seq column that preserves arrival order. Returns its name.
+    """
+    staging_table = f"_stage_{table_name}"
+    cursor.execute(statement_text(staging_table_sql, staging_table, table_name, columns, schema))
+    return staging_table
+
+
+def staging_table_sql(staging_table, table_name, columns, schema="analytical_model"):
+    """
+    The statements create_staging_table runs, for drivers other than psycopg2.
+    """
+    return f'''
+        CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS
+        SELECT {', '.join(columns)} FROM {schema}.{table_name}
+        WITH NO DATA;
+        ALTER TABLE {staging_table} ADD COLUMN _load_seq bigserial
+    '''
+
+
+def copy_rows_to_staging(cursor, staging_table, columns, rows):
+    """
+    Streams Python row tuples into the staging table with COPY FROM STDIN.
+    """
+    stream = RowCopyStream(rows)
+    with stage("load") as load_stage:
+        cursor.copy_expert(f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN", stream)
+        load_stage.rows, load_stage.bytes = stream.rows_read, stream.chars_read
+
+
+def conflict_action(key, columns, target="t"):
+    """
+    The ON CONFLICT action that overwrites every non-key column, guarded so
+    rows whose content is unchanged are skipped instead of rewritten (no new
+    tuple, WAL or index entries). target is the alias of the target table.
+    """
+    other_columns = [col for col in columns if col != key]
+    if not other_columns:
+        return "DO NOTHING"
+    update_clause = ', '.join([f"{col} = EXCLUDED.{col}" for col in other_columns])
+    current = ', '.join([f"{target}.{col}" for col in other_columns])
+    incoming = ', '.join([f"EXCLUDED.{col}" for col in other_columns])
+    return f"DO UPDATE SET {update_clause} WHERE ROW({current}) IS DISTINCT FROM ROW({incoming})"
+
+
+# Turns the RETURNING (xmax = 0) flags of an upsert CTE named written, and
+# its input CTE named candidates, into (inserted, updated, unchanged).
+# xmax is 0 only on tuples the statement inserted rather than updated.
+UPSERT_COUNTS = '''
+    SELECT COUNT(*) FILTER (WHERE inserted),
+           COUNT(*) FILTER (WHERE NOT inserted),
+           (SELECT COUNT(*) FROM candidates) - COUNT(*)
+    FROM written
+'''
+
+
+def merge_staging(cursor, staging_table, table_name, key, columns, on_conflict=True,
+                  schema="analytical_model"):
+    """
+    Moves the staged rows into the target with a single INSERT ... SELECT.
+    Returns (inserted, updated, unchanged) row counts.
+
+    With on_conflict, duplicate keys inside the batch collapse to the last one
+    staged, matching what row-by-row executemany upserts used to leave behind,
+    and existing rows are only rewritten when a column value differs.
+    """
+    # Not prepared: the staging table is new for every load, which invalidates a prepared plan anyway
+    cursor.execute(statement_text(merge_staging_sql, staging_table, table_name, key, columns, on_conflict, schema))
+    if on_conflict:
+        return cursor.fetchone()
+    return cursor.rowcount, 0, 0
+
+
+def merge_staging_sql(staging_table, table_name, key, columns, on_conflict=True, schema="analytical_model"):
+    """
+    The statement merge_staging runs. With on_conflict it returns the
+    (inserted, updated, unchanged) row; otherwise the counts come from rowcount.
+    """
+    column_names = ', '.join(columns)
+
+    if on_conflict:
+        return f'''
+            WITH candidates AS (
+                SELECT DISTINCT ON ({key}) {column_names}
+                FROM {staging_table}
+                ORDER BY {key}, _load_seq DESC
+            ), written AS (
+                INSERT INTO {schema}.{table_name} AS t ({column_names})
+                SELECT {column_names} FROM candidates
+                ON CONFLICT ({key}) {conflict_action(key, columns)}
+                RETURNING (xmax = 0) AS inserted
+            )
+            {UPSERT_COUNTS}
+        '''
+
+    return f'''
+        INSERT INTO {schema}.{table_name} ({column_names})
+        SELECT {column_names}
+        FROM {staging_table}
+        ORDER BY _load_seq
+    '''
+
+
+def copy_upsert(dest_conn, table_name, key, columns, rows, on_conflict=True,
+                schema="analytical_model"):
+    """
+    Bulk loads rows into schema.table_name through a COPY staging table and
+    one set-based upsert. The caller owns the transaction and must commit.
+    Returns (inserted, updated, unchanged) row counts.
+    """
+    with dest_conn.cursor() as cursor:
+        staging_table = create_staging_table(cursor, table_name, columns, schema)
+        copy_rows_to_staging(cursor, staging_table, columns, rows)
+        with stage("merge") as merge_stage:
+            counts = merge_staging(cursor, staging_table, table_name, key, columns,
+                                   on_conflict, schema)
+            merge_stage.rows = len(rows)
+        # Drop now so the same transaction can stage the table again
+        cursor.execute(f"DROP TABLE {staging_table}")
+
+    return counts
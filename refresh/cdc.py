@@ -0,0 +1,523 @@
+"""
+Change capture from a logical replication slot on the source, as an
+alternative to watermark polling.
+
+Polling on COALESCE(update_dt, created_dt) misses hard deletes and scans a
+range of every source table on each run. Here a pgoutput slot streams every
+committed insert, update, delete and truncate on the source tables the
+queries read. Each change is turned into the analytical_model keys it can
+affect, through CDC_SOURCES: the changed row's own key, or a lookup for
+rows joined to it (the versions using a changed cf_modules row, say).
+Changes are collected per source transaction and applied in batches, at
+most max_batch_changes changes or max_latency seconds after the first one:
+the spec's query is re-run for the affected keys only (the key_ids filter),
+its rows are upserted and keys it no longer returns are deleted, and the
+batch's commit LSN is stored in analytical_model.refresh_cdc_state in the
+same destination transaction before the slot is acknowledged. A crash
+replays at most the unacknowledged batch, and re-reading keys is idempotent.
+
+Needs wal_level=logical and a role with REPLICATION on the source; the
+pgoutput plugin is built into Postgres, no extension is needed. Tables are
+first loaded by the polling refresh once the slot exists (run_cdc does
+this when it creates the slot); from then on the slot has every change.
+"""
+import datetime
+import select
+import struct
+import time
+from dataclasses import dataclass
+
+import psycopg2
+from psycopg2.extras import LogicalReplicationConnection
+
+from refresh.backfill import key_range_params
+from refresh.engine import RefreshOptions, refresh_table
+from refresh.exclusions import read_exclusions
+from refresh.id_log import UPDATE_LOG_INSERT, compact_ids, expand_ids
+from refresh.metrics import run_metrics, stage
+from refresh.partitioned import partition_params
+from refresh.rebuild import rebuild_table
+from refresh.statements import execute_prepared
+from refresh.transfer import transfer_delta
+from refresh.validation import CLOSURE_SOURCES, invalidate_valid_id_cache
+from refresh.watermark import INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, advance_watermark, watermark_params
+
+CDC_SLOT = "refresh_cdc"
+CDC_PUBLICATION = "refresh_cdc"
+CDC_STATE_TABLE = "refresh_cdc_state"
+
+
+@dataclass
+class CdcSource:
+    """
+    How changes to one source table reach one analytical_model table.
+    """
+    table: str
+    target: str
+    # Column of the changed row (new and old values) whose values are the target keys
+    column: str = "id"
+    # Query taking %(ids)s, the column values, and returning the target keys instead
+    lookup: str = None
+    # Database the lookup runs on: "source", or "dest" for rows the destination still holds
+    database: str = "source"
+
+
+CDC_SOURCES = [
+    CdcSource("paign_default_campaign", "campaign"),
+    CdcSource("paign_default_tactic", "tactic"),
+    CdcSource("paign_default_offer", "offer"),
+    CdcSource("paign_default_valueamounttype", "offer",
+              lookup="SELECT id FROM paign_default_offer WHERE value_amount_type_id = ANY(%(ids)s::bigint[])"),
+    CdcSource("paign_placement_version", "version"),
+    CdcSource("cf_modules", "version",
+              lookup="SELECT id FROM paign_placement_version WHERE module_id = ANY(%(ids)s::bigint[])"),
+    CdcSource("cf_content_group", "version", lookup='''
+        SELECT v.id FROM paign_placement_version v
+        JOIN cf_modules m ON m.id = v.module_id
+        WHERE m.content_group_id = ANY(%(ids)s::bigint[])
+    '''),
+    CdcSource("cf_vehicle_placement_position", "version", lookup='''
+        SELECT id FROM paign_placement_version WHERE vehicle_placement_position_id = ANY(%(ids)s::bigint[])
+    '''),
+    CdcSource("cf_placement_type", "version", lookup='''
+        SELECT v.id FROM paign_placement_version v
+        JOIN cf_vehicle_placement_position p ON p.id = v.vehicle_placement_position_id
+        WHERE p.placement_type_id = ANY(%(ids)s::bigint[])
+    '''),
+    # No primary key, so it is published with REPLICA IDENTITY FULL and deletes carry the column
+    CdcSource("audience_segment_placement_versions", "version", column="placementversion_id"),
+    CdcSource("paign_module_link_ids_prod", "link"),
+    # Links joined to a changed version now, and the ones stored under it before the change
+    CdcSource("paign_placement_version", "link", lookup='''
+        SELECT l.id FROM paign_module_link_ids_prod l
+        JOIN paign_placement_version v ON v.tactic_id = l.tactic_id AND v.module_id = l.module_id
+        WHERE v.id = ANY(%(ids)s::bigint[])
+    '''),
+    CdcSource("paign_placement_version", "link", database="dest",
+              lookup="SELECT id_link FROM analytical_model.link WHERE id_version = ANY(%(ids)s::bigint[])"),
+]
+
+
+def cdc_tables(sources=None):
+    """
+    The source tables the publication covers, in CDC_SOURCES order.
+    """
+    return list(dict.fromkeys(source.table for source in (sources or CDC_SOURCES)))
+
+
+def cdc_targets(sources=None):
+    """
+    The analytical_model tables change capture keeps up to date.
+    """
+    return {source.target for source in (sources or CDC_SOURCES)}
+
+
+class PgOutputDecoder:
+    """
+    Decodes pgoutput protocol version 1 messages. Relation messages are
+    remembered so row messages can be turned into {column: text value}
+    dicts; TOASTed values left unchanged by an update are omitted.
+    """
+
+    def __init__(self):
+        self.relations = {}
+
+    def decode(self, payload):
+        """
+        Returns ("begin",), ("commit", end_lsn), ("truncate", [table, ...]),
+        (action, table, new row, old row) for I/U/D, or None for messages
+        that need no handling.
+        """
+        kind = payload[:1]
+        if kind == b"B":
+            return ("begin",)
+        if kind == b"C":
+            _, _, end_lsn, _ = struct.unpack_from("!bqqq", payload, 1)
+            return ("commit", end_lsn)
+        if kind == b"R":
+            self._relation(payload)
+            return None
+        if kind == b"T":
+            count, _ = struct.unpack_from("!ib", payload, 1)
+            relids = struct.unpack_from(f"!{count}i", payload, 6)
+            return ("truncate", [self.relations[relid][0] for relid in relids])
+        if kind not in (b"I", b"U", b"D"):
+            # Type, origin and logical decoding messages
+            return None
+
+        relid, = struct.unpack_from("!i", payload, 1)
+        table, columns = self.relations[relid]
+        offset = 5
+        new, old = None, None
+        while offset < len(payload):
+            marker = payload[offset:offset + 1]
+            row, offset = self._tuple(payload, offset + 1, columns)
+            if marker == b"N":
+                new = row
+            else:
+                # K carries the replica identity columns only, O the whole old row
+                old = row
+        return (kind.decode(), table, new, old)
+
+    def _relation(self, payload):
+        relid, = struct.unpack_from("!i", payload, 1)
+        _, offset = self._string(payload, 5)
+        table, offset = self._string(payload, offset)
+        offset += 1  # replica identity setting
+        column_count, = struct.unpack_from("!h", payload, offset)
+        offset += 2
+        columns = []
+        for _ in range(column_count):
+            name, offset = self._string(payload, offset + 1)
+            offset += 8  # type oid and modifier
+            columns.append(name)
+        self.relations[relid] = (table, columns)
+
+    @staticmethod
+    def _string(payload, offset):
+        end = payload.index(b"\0", offset)
+        return payload[offset:end].decode(), end + 1
+
+    @staticmethod
+    def _tuple(payload, offset, columns):
+        column_count, = struct.unpack_from("!h", payload, offset)
+        offset += 2
+        row = {}
+        for index in range(column_count):
+            kind = payload[offset:offset + 1]
+            offset += 1
+            if kind == b"n":
+                row[columns[index]] = None
+            elif kind in (b"t", b"b"):
+                length, = struct.unpack_from("!i", payload, offset)
+                offset += 4
+                row[columns[index]] = payload[offset:offset + length].decode()
+                offset += length
+        return row, offset
+
+
+class ChangeBatch:
+    """
+    Committed changes waiting to be applied: for every CDC_SOURCES entry
+    the changed values of its column, plus truncated tables and the LSN to
+    acknowledge once the batch is stored.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.values = {}
+        self.truncated = set()
+        self.changes = 0
+        self.lsn = None
+        self.first_change_at = None
+
+    def add(self, table, new, old):
+        for row in (new, old):
+            for source in self.sources:
+                if source.table == table and row and row.get(source.column) is not None:
+                    self.values.setdefault((source.table, source.column), set()).add(int(row[source.column]))
+        self.changes += 1
+        if self.first_change_at is None:
+            self.first_change_at = time.monotonic()
+
+    def truncate(self, tables):
+        self.truncated.update(tables)
+        self.changes += 1
+        if self.first_change_at is None:
+            self.first_change_at = time.monotonic()
+
+    def ready(self, max_batch_changes, max_latency):
+        if not self.changes:
+            return False
+        return self.changes >= max_batch_changes or time.monotonic() - self.first_change_at >= max_latency
+
+
+def ensure_cdc_store(cursor, schema="analytical_model"):
+    """
+    Creates the table holding each slot's last applied LSN if missing.
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.{CDC_STATE_TABLE} (
+            slot_name text PRIMARY KEY,
+            applied_lsn pg_lsn NOT NULL,
+            applied_at timestamp NOT NULL,
+            changes bigint NOT NULL DEFAULT 0
+        )
+    ''')
+
+
+def ensure_cdc_source(source_conn, slot_name=CDC_SLOT, publication=CDC_PUBLICATION, sources=None):
+    """
+    Creates the publication over the CDC source tables and the pgoutput slot
+    on the source if they are missing; tables without a primary key get
+    REPLICA IDENTITY FULL so their updates and deletes are published with
+    every column. Returns True when the slot was created, meaning the
+    targets need one polling refresh to catch up to it.
+    """
+    tables = cdc_tables(sources)
+    with source_conn.cursor() as cursor:
+        cursor.execute("SHOW wal_level")
+        if cursor.fetchone()[0] != "logical":
+            raise RuntimeError("Change capture needs wal_level = logical on the source")
+
+        for table in tables:
+            cursor.execute('''
+                SELECT c.relreplident, EXISTS (SELECT 1 FROM pg_index i WHERE i.indrelid = c.oid AND i.indisprimary)
+                FROM pg_class c WHERE c.oid = %s::regclass
+            ''', (table,))
+            replica_identity, has_primary_key = cursor.fetchone()
+            if not has_primary_key and replica_identity != "f":
+                cursor.execute(f"ALTER TABLE {table} REPLICA IDENTITY FULL")
+
+        cursor.execute("SELECT 1 FROM pg_publication WHERE pubname = %s", (publication,))
+        if cursor.fetchone() is None:
+            cursor.execute(f"CREATE PUBLICATION {publication} FOR TABLE {', '.join(tables)}")
+    source_conn.commit()
+
+    # A logical slot cannot be created in a transaction that has written
+    with source_conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s", (slot_name,))
+        created = cursor.fetchone() is None
+        if created:
+            cursor.execute("SELECT pg_create_logical_replication_slot(%s, 'pgoutput')", (slot_name,))
+    source_conn.commit()
+    return created
+
+
+def drop_cdc_source(source_conn, slot_name=CDC_SLOT, publication=CDC_PUBLICATION):
+    """
+    Drops the slot and publication, so the source stops retaining WAL for
+    them. Switch the tables back to polling first.
+    """
+    with source_conn.cursor() as cursor:
+        cursor.execute('''
+            SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots WHERE slot_name = %s
+        ''', (slot_name,))
+        cursor.execute(f"DROP PUBLICATION IF EXISTS {publication}")
+    source_conn.commit()
+
+
+def read_applied_lsn(cursor, slot_name=CDC_SLOT, schema="analytical_model"):
+    """
+    The commit LSN of the last batch applied from slot_name, as text, or None.
+    """
+    cursor.execute(f"SELECT applied_lsn::text FROM {schema}.{CDC_STATE_TABLE} WHERE slot_name = %s", (slot_name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def changed_keys(batch, source_conn, dest_conn):
+    """
+    Maps a batch's changed values to {target table: set of keys}.
+    """
+    keys = {}
+    for source in batch.sources:
+        values = batch.values.get((source.table, source.column))
+        if not values:
+            continue
+        if source.lookup is None:
+            keys.setdefault(source.target, set()).update(values)
+            continue
+        conn = dest_conn if source.database == "dest" else source_conn
+        with conn.cursor() as cursor:
+            cursor.execute(source.lookup, {"ids": sorted(values)})
+            keys.setdefault(source.target, set()).update(row[0] for row in cursor.fetchall())
+    return keys
+
+
+def apply_table_changes(spec, keys, source_conn, dest_conn, options, schema="analytical_model"):
+    """
+    Re-reads spec's rows for keys from the source, upserts them and deletes
+    the keys the query no longer returns, in the caller's destination
+    transaction. Returns (TransferResult, keys deleted).
+    """
+    keys = sorted(keys)
+    with dest_conn.cursor() as dest_cursor:
+        params = {**watermark_params(INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY), **key_range_params(key_ids=keys),
+                  **partition_params(), **read_exclusions(dest_cursor, spec.exclusions, schema)}
+
+        # Plain-INSERT tables have no key to upsert on, so their changed keys are replaced
+        if not spec.on_conflict:
+            with stage("delete"):
+                dest_cursor.execute(f"DELETE FROM {schema}.{spec.name} WHERE {spec.key} = ANY(%s::bigint[])", (keys,))
+
+        result = transfer_delta(source_conn, dest_conn, spec.name, spec.key, spec.query, params,
+                                on_conflict=spec.on_conflict, pipe=options.pipe and spec.pipe,
+                                copy_format=options.copy_format)
+        deleted = sorted(set(keys) - set(expand_ids(result.logged_ids)))
+
+        with stage("delete") as delete_stage:
+            if spec.on_conflict and deleted:
+                dest_cursor.execute(f"DELETE FROM {schema}.{spec.name} WHERE {spec.key} = ANY(%s::bigint[])",
+                                    (deleted,))
+            delete_stage.rows = len(deleted)
+
+        with stage("log_write"):
+            now = datetime.datetime.utcnow().replace(tzinfo=None)
+            log_insert = UPDATE_LOG_INSERT.format(schema=schema, update_log_table=options.update_log_table)
+            if result.record_count:
+                if result.high_water is not None:
+                    advance_watermark(dest_cursor, spec.name, *result.high_water, schema=schema)
+                execute_prepared(dest_cursor, log_insert,
+                                 (spec.name, now, now, "upsert", result.record_count, result.logged_ids,
+                                  result.inserted, result.updated, result.unchanged))
+            if deleted:
+                # Logged like upserts, so the incremental cleanse re-validates rows under deleted keys
+                execute_prepared(dest_cursor, log_insert,
+                                 (spec.name, now, now, "cdc_delete", len(deleted), compact_ids(deleted), 0, 0, 0))
+                # Rebuild rather than patch the cached closure for removed tactics and versions
+                if spec.name in CLOSURE_SOURCES:
+                    invalidate_valid_id_cache(dest_cursor, schema)
+    return result, deleted
+
+
+def apply_changes(batch, specs, source_pool, dest_pool, options=None, slot_name=CDC_SLOT, schema="analytical_model"):
+    """
+    Applies a batch to every affected spec and stores its LSN, in one
+    destination transaction. Targets of a truncated source table are
+    rebuilt from scratch first. Returns {table: (rows upserted, keys deleted)}.
+    """
+    options = options or RefreshOptions()
+    specs_by_name = {spec.name: spec for spec in specs}
+    summary = {}
+
+    with run_metrics("cdc"):
+        rebuilt = {source.target for source in batch.sources if source.table in batch.truncated}
+        for spec in specs:
+            if spec.name in rebuilt:
+                extracted, loaded = rebuild_table(spec, source_pool, dest_pool, options, schema)
+                summary[spec.name] = (loaded, 0)
+
+        with dest_pool.connection() as dest_conn, source_pool.connection() as source_conn:
+            with stage("lookup"):
+                keys = changed_keys(batch, source_conn, dest_conn)
+            # Specs are in dependency order, and lookups on the destination saw it before any change
+            for name, spec in specs_by_name.items():
+                if name in keys and name not in rebuilt:
+                    result, deleted = apply_table_changes(spec, keys[name], source_conn, dest_conn, options, schema)
+                    summary[name] = (result.record_count, len(deleted))
+            source_conn.commit()
+
+            with dest_conn.cursor() as dest_cursor, stage("commit") as commit_stage:
+                dest_cursor.execute(f'''
+                    INSERT INTO {schema}.{CDC_STATE_TABLE} AS s (slot_name, applied_lsn, applied_at, changes)
+                    VALUES (%s, %s::pg_lsn, %s, %s)
+                    ON CONFLICT (slot_name) DO UPDATE SET
+                        applied_lsn = EXCLUDED.applied_lsn,
+                        applied_at = EXCLUDED.applied_at,
+                        changes = s.changes + EXCLUDED.changes
+                ''', (slot_name, format_lsn(batch.lsn), datetime.datetime.utcnow().replace(tzinfo=None),
+                      batch.changes))
+                dest_conn.commit()
+                commit_stage.rows = batch.changes
+    return summary
+
+
+def format_lsn(lsn):
+    """
+    Renders an integer LSN the way Postgres prints pg_lsn values.
+    """
+    return f"{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}"
+
+
+def consume_changes(specs, source_pool, dest_pool, options=None, slot_name=CDC_SLOT, publication=CDC_PUBLICATION,
+                    max_batch_changes=10000, max_latency=1.0, run_seconds=None, stop_event=None,
+                    schema="analytical_model", sources=None):
+    """
+    Streams the slot and applies its changes in batches until run_seconds
+    have passed or stop_event is set, then applies what is left of the
+    committed changes. Returns {"batches", "changes", "lsn"}.
+    """
+    options = options or RefreshOptions()
+    sources = [source for source in (sources or CDC_SOURCES) if source.target in {spec.name for spec in specs}]
+    specs = [spec for spec in specs if spec.name in cdc_targets(sources)]
+
+    with dest_pool.connection() as dest_conn:
+        with dest_conn.cursor() as dest_cursor:
+            ensure_cdc_store(dest_cursor, schema)
+            start_lsn = read_applied_lsn(dest_cursor, slot_name, schema)
+        dest_conn.commit()
+
+    replication_conn = psycopg2.connect(connection_factory=LogicalReplicationConnection, **source_pool.conn_info)
+    totals = {"batches": 0, "changes": 0, "lsn": start_lsn}
+    deadline = time.monotonic() + run_seconds if run_seconds else None
+    try:
+        cursor = replication_conn.cursor()
+        cursor.start_replication(slot_name=slot_name, decode=False, start_lsn=start_lsn or 0,
+                                 options={"proto_version": "1", "publication_names": publication})
+        decoder = PgOutputDecoder()
+        batch = ChangeBatch(sources)
+        transaction = []
+
+        def flush():
+            nonlocal batch
+            summary = apply_changes(batch, specs, source_pool, dest_pool, options, slot_name, schema)
+            cursor.send_feedback(flush_lsn=batch.lsn)
+            totals["batches"] += 1
+            totals["changes"] += batch.changes
+            totals["lsn"] = format_lsn(batch.lsn)
+            print(f"Applied {batch.changes} changes up to {totals['lsn']}: "
+                  + ", ".join(f"{name} {upserted} upserted / {deleted} deleted"
+                              for name, (upserted, deleted) in summary.items()))
+            batch = ChangeBatch(sources)
+
+        while not (stop_event is not None and stop_event.is_set()) and \
+                (deadline is None or time.monotonic() < deadline):
+            message = cursor.read_message()
+            if message is None:
+                if batch.ready(max_batch_changes, max_latency):
+                    flush()
+                    continue
+                timeout = max_latency
+                if batch.first_change_at is not None:
+                    timeout = max(max_latency - (time.monotonic() - batch.first_change_at), 0)
+                select.select([cursor], [], [], timeout)
+                continue
+
+            event = decoder.decode(message.payload)
+            if event is None:
+                pass
+            elif event[0] == "begin":
+                transaction = []
+            elif event[0] == "commit":
+                # Only whole source transactions reach a batch
+                for change in transaction:
+                    if change[0] == "truncate":
+                        batch.truncate(change[1])
+                    else:
+                        batch.add(*change[1:])
+                transaction = []
+                if batch.changes:
+                    batch.lsn = event[1]
+                else:
+                    # Nothing we track changed; let the slot release the WAL
+                    cursor.send_feedback(flush_lsn=event[1])
+            else:
+                transaction.append(event)
+
+            if batch.ready(max_batch_changes, max_latency):
+                flush()
+
+        if batch.changes:
+            flush()
+    finally:
+        replication_conn.close()
+    return totals
+
+
+def run_cdc(specs, source_pool, dest_pool, options=None, slot_name=CDC_SLOT, publication=CDC_PUBLICATION,
+            run_seconds=300, max_latency=1.0, max_batch_changes=10000, stop_event=None):
+    """
+    Sets up the slot if needed, catching the CDC targets up with one polling
+    refresh when it is new, then consumes changes for run_seconds.
+    """
+    options = options or RefreshOptions()
+    with source_pool.connection() as source_conn:
+        created = ensure_cdc_source(source_conn, slot_name, publication)
+    if created:
+        print(f"Created replication slot {slot_name}; catching up by polling once")
+        for spec in specs:
+            if spec.name in cdc_targets():
+                refresh_table(spec, source_pool, dest_pool, options)
+    return consume_changes(specs, source_pool, dest_pool, options, slot_name, publication, max_batch_changes,
+                           max_latency, run_seconds, stop_event)
@@ -0,0 +1,86 @@
+"""
+Direct source-to-destination COPY transfer.
+
+COPY (source_query) TO STDOUT on the source connection is fed through an OS
+pipe straight into COPY ... FROM STDIN on the destination staging table, so
+rows are never decoded into Python objects.
+"""
+import os
+import threading
+
+from psycopg2.extensions import encodings
+
+from refresh.metrics import stage
+
+
+class CountingReader:
+    """
+    Wraps a file-like COPY source and counts the bytes read through it.
+    """
+
+    def __init__(self, reader):
+        self._reader = reader
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._reader.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def inline_query(source_conn, source_query, params):
+    """
+    Binds params client-side (COPY takes no parameters) and strips the
+    trailing semicolon so the query can be wrapped. Wrappers close the
+    parenthesis on a new line in case the query ends in a -- comment.
+    """
+    with source_conn.cursor() as cursor:
+        query = cursor.mogrify(source_query, params).decode(encodings[source_conn.encoding])
+    return query.strip().rstrip(";")
+
+
+def describe_query(source_conn, query):
+    """
+    Returns the output column names of a query without running it in full.
+    """
+    with source_conn.cursor() as cursor:
+        cursor.execute(f"SELECT * FROM ({query}\n) AS q LIMIT 0")
+        return [desc[0] for desc in cursor.description]
+
+
+def pipe_copy(source_conn, dest_cursor, staging_table, columns, query, copy_format="text"):
+    """
+    Streams COPY output of query on the source into staging_table on the
+    destination. A background thread writes the source side of the pipe
+    while the calling thread feeds the destination, so source execution and
+    fetch overlap the load and are timed as part of it.
+    """
+    read_fd, write_fd = os.pipe()
+    producer_errors = []
+
+    def produce():
+        try:
+            with os.fdopen(write_fd, "wb") as writer, source_conn.cursor() as cursor:
+                cursor.copy_expert(f"COPY ({query}\n) TO STDOUT WITH (FORMAT {copy_format})", writer)
+        except Exception as e:
+            producer_errors.append(e)
+
+    producer = threading.Thread(target=produce, name=f"copy-out-{staging_table}", daemon=True)
+    producer.start()
+    try:
+        with os.fdopen(read_fd, "rb") as pipe_reader, stage("load") as load_stage:
+            reader = CountingReader(pipe_reader)
+            try:
+                dest_cursor.copy_expert(
+                    f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT {copy_format})",
+                    reader,
+                )
+            finally:
+                load_stage.bytes = reader.bytes_read
+    finally:
+        producer.join()
+
+    # A source failure closes the pipe early, which the destination sees as a
+    # clean end of data, so the producer's error has to be raised here
+    if producer_errors:
+        raise producer_errors[0]
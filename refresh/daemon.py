@@ -0,0 +1,213 @@
+"""
+Long-running refresh: polls each table spec on its own interval instead of
+refreshing everything once per notebook run.
+
+The connection pools stay open between polls, and the valid-ID closure
+cache and cleanse checkpoint stay current, so each poll only pays for its
+own delta: a watermark read, the delta query and the load, logged exactly
+as a notebook run logs it (refresh_table). A table whose delta comes back
+empty waits backoff times longer before its next poll, up to max_interval,
+and drops back to its base interval as soon as rows arrive; a failed poll
+backs off the same way. Rows loaded since the last cleanse are cleansed
+incrementally every cleanse_interval seconds, between loads.
+
+Run it from the notebook (daemon_mode) or standalone:
+
+    python -m refresh.daemon --source-dsn postgresql://source/db --dsn postgresql://dest/db
+"""
+import argparse
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from psycopg2.extensions import parse_dsn
+
+from refresh.engine import RefreshOptions, ensure_refresh_stores, refresh_table
+from refresh.metrics import run_metrics, stage
+from refresh.pool import ConnectionPool
+from refresh.tables import TABLE_SPECS
+from refresh.validation import run_cleanse
+
+
+@dataclass
+class TableSchedule:
+    """
+    When a spec is next polled, and how far its interval has backed off.
+    """
+    spec: object
+    interval: float
+    max_interval: float
+    backoff: float = 2.0
+    wait: float = 0.0
+    next_run: float = 0.0
+    polls: int = 0
+    empty_polls: int = 0
+    failures: int = 0
+    rows: int = 0
+
+    def record(self, rows, failed=False):
+        """
+        Schedules the next poll after one that loaded rows (None when it failed).
+        """
+        self.polls += 1
+        if failed:
+            self.failures += 1
+        elif rows:
+            self.rows += rows
+        else:
+            self.empty_polls += 1
+        if rows:
+            self.wait = self.interval
+        else:
+            self.wait = min(max(self.wait, self.interval) * self.backoff, self.max_interval)
+        self.next_run = time.monotonic() + self.wait
+
+
+class RefreshDaemon:
+    """
+    Polls every spec on its schedule with up to max_workers loads at a time.
+    A spec waits for the specs it depends on when they are polling too, the
+    same ordering the notebook's dependency graph gives a full run.
+    """
+
+    def __init__(self, specs, source_pool, dest_pool, options=None, intervals=None, default_interval=60.0,
+                 max_interval=900.0, backoff=2.0, cleanse_interval=300.0, max_workers=4):
+        self.source_pool = source_pool
+        self.dest_pool = dest_pool
+        self.options = options or RefreshOptions()
+        self.cleanse_interval = cleanse_interval
+        self.max_workers = max_workers
+        intervals = intervals or {}
+        self.schedules = {spec.name: TableSchedule(spec, intervals.get(spec.name, default_interval),
+                                                   max(max_interval, intervals.get(spec.name, default_interval)),
+                                                   backoff)
+                          for spec in specs}
+        self.rows_since_cleanse = 0
+        self.last_cleanse = time.monotonic()
+
+    def _waiting(self, running):
+        """
+        Specs not loading right now whose dependencies are not loading either.
+        """
+        busy = set(running.values())
+        return [schedule for name, schedule in self.schedules.items()
+                if name not in busy and not busy.intersection(schedule.spec.depends_on)]
+
+    def _cleanse(self):
+        with run_metrics("cleanse"), self.dest_pool.connection() as dest_conn:
+            with dest_conn.cursor() as dest_cursor:
+                mode, deleted = run_cleanse(dest_cursor, update_log_table=self.options.update_log_table)
+            with stage("commit"):
+                dest_conn.commit()
+        removed = ", ".join(f"{table} {count}" for table, count in deleted.items() if count)
+        print(f"Cleansed {self.rows_since_cleanse} loaded rows ({mode}): {removed or 'nothing removed'}")
+        self.rows_since_cleanse = 0
+        self.last_cleanse = time.monotonic()
+
+    def run(self, run_seconds=None, stop_event=None):
+        """
+        Polls until run_seconds have passed or stop_event is set, letting
+        running loads finish, then cleanses what they loaded. Returns
+        {table: TableSchedule}.
+        """
+        stop_event = stop_event or threading.Event()
+        deadline = time.monotonic() + run_seconds if run_seconds else None
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="daemon") as executor:
+            while True:
+                stopping = stop_event.is_set() or (deadline is not None and time.monotonic() >= deadline)
+                if stopping and not running:
+                    break
+
+                # Cleanse between loads, so it never re-validates a half-loaded delta. Once it is due
+                # no new polls start, so busy tables cannot keep putting it off
+                cleanse_due = self.rows_since_cleanse and \
+                    (stopping or time.monotonic() - self.last_cleanse >= self.cleanse_interval)
+                if cleanse_due and not running:
+                    try:
+                        self._cleanse()
+                    except Exception as e:
+                        print("Error during cleanup:", e)
+                        self.last_cleanse = time.monotonic()
+                    continue
+
+                # Start due polls in spec order, so a spec due with its dependency waits for it
+                for schedule in self._waiting(running) if not (stopping or cleanse_due) else ():
+                    if schedule.next_run <= time.monotonic() and len(running) < self.max_workers and \
+                            not set(running.values()).intersection(schedule.spec.depends_on):
+                        future = executor.submit(refresh_table, schedule.spec, self.source_pool, self.dest_pool,
+                                                 self.options)
+                        running[future] = schedule.spec.name
+
+                # Sleep until a load finishes, the next poll is due or it is time to stop. Polls already
+                # due are held back by busy workers or a loading dependency, so only a finished load frees them
+                now = time.monotonic()
+                wake = [schedule.next_run for schedule in self._waiting(running)]
+                if self.rows_since_cleanse:
+                    wake.append(self.last_cleanse + self.cleanse_interval)
+                if deadline is not None:
+                    wake.append(deadline)
+                timeout = min([moment - now for moment in wake if moment > now and not stopping], default=1.0)
+                if running:
+                    done, _ = wait(running, timeout=min(timeout, 1.0), return_when=FIRST_COMPLETED)
+                else:
+                    done = ()
+                    stop_event.wait(min(timeout, 1.0))
+
+                for future in done:
+                    schedule = self.schedules[running.pop(future)]
+                    try:
+                        rows = future.result().record_count
+                    except Exception:
+                        # refresh_table has printed the error; retry after backing off
+                        schedule.record(None, failed=True)
+                        continue
+                    schedule.record(rows)
+                    self.rows_since_cleanse += rows
+
+        for name, schedule in self.schedules.items():
+            print(f"{name}: {schedule.polls} polls, {schedule.empty_polls} empty, {schedule.failures} failed, "
+                  f"{schedule.rows} rows loaded")
+        return self.schedules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--source-dsn", required=True)
+    parser.add_argument("--dsn", required=True, help="Destination Postgres holding analytical_model")
+    parser.add_argument("--tables", nargs="+", help="Specs to poll; all of TABLE_SPECS by default")
+    parser.add_argument("--interval", type=float, default=60.0, help="Base seconds between polls of a table")
+    parser.add_argument("--max-interval", type=float, default=900.0, help="Longest back-off between polls")
+    parser.add_argument("--cleanse-interval", type=float, default=300.0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--run-seconds", type=float, help="Stop after this long; runs until SIGTERM by default")
+    args = parser.parse_args()
+
+    specs = [spec for spec in TABLE_SPECS if not args.tables or spec.name in args.tables]
+    source_pool = ConnectionPool(parse_dsn(args.source_dsn), maxconn=args.workers, name="source")
+    dest_pool = ConnectionPool(parse_dsn(args.dsn), maxconn=args.workers + 1, name="dest")
+    options = RefreshOptions()
+    with dest_pool.connection() as setup_conn:
+        ensure_refresh_stores(setup_conn.cursor(), options.update_log_table)
+        setup_conn.commit()
+
+    # Finish the loads in flight and cleanse them on SIGTERM or Ctrl-C
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+
+    daemon = RefreshDaemon(specs, source_pool, dest_pool, options, default_interval=args.interval,
+                           max_interval=args.max_interval, cleanse_interval=args.cleanse_interval,
+                           max_workers=args.workers)
+    daemon.run(args.run_seconds, stop_event)
+    source_pool.report()
+    dest_pool.report()
+    source_pool.closeall()
+    dest_pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
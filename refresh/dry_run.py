@@ -0,0 +1,235 @@
+"""
+Dry-run planner for the refresh.
+
+For every table spec it resolves what the next run would use (backfill or
+incremental, watermark, exclusions) and explains the source query inside a
+read-only transaction. With analyze, EXPLAIN (ANALYZE, BUFFERS) runs the
+query, so the delta row count is exact; without it, the count is the
+planner's estimate and the query is not run, for sources too slow to read
+twice. The cleanse run_cleanse would pick, full or incremental from the
+checkpoint, has its deletes explained the same way inside a destination
+transaction that is rolled back, so nothing is ever committed on either
+database.
+
+Every plan is appended to <plan_dir>/<name>.jsonl and compared with the
+previous run's, so regressions show up as warnings: scans or joins that
+changed since last time, and Seq Scans applying the watermark predicate on
+COALESCE(update_dt, created_dt).
+"""
+import datetime
+import json
+import os
+
+from refresh.backfill import key_range_params
+from refresh.copy_pipe import inline_query
+from refresh.engine import RefreshOptions, needs_backfill
+from refresh.exclusions import read_exclusions
+from refresh.partitioned import partition_params
+from refresh.validation import CLEANSE_TARGETS, build_valid_id_closure, invalid_records_delete_sql, next_cleanse, \
+    prepare_touched_scopes, touched_records_delete_sql
+from refresh.watermark import INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, read_watermark, watermark_params
+
+# Columns whose appearance in a Seq Scan filter means the watermark predicate found no index
+WATERMARK_COLUMNS = ("update_dt", "created_dt", "modified_ts")
+
+
+def explain(cursor, query, analyze=True):
+    """
+    Returns the JSON plan of query; with analyze it is executed, with
+    actual row counts, timings and buffer usage.
+    """
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+    cursor.execute(f"EXPLAIN ({options}) {query}")
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def plan_nodes(node):
+    """
+    Yields a plan node and all nodes below it, depth first.
+    """
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def plan_shape(plan):
+    """
+    The plan as one line per node (type, relation, index), for comparing
+    plans across runs without the row counts and costs that always vary.
+    """
+    shape = []
+    for node in plan_nodes(plan["Plan"]):
+        line = node["Node Type"]
+        if node.get("Index Name"):
+            line += f" using {node['Index Name']}"
+        if node.get("Relation Name"):
+            line += f" on {node['Relation Name']}"
+        shape.append(line)
+    return shape
+
+
+def plan_warnings(plan, previous_shape=None):
+    """
+    Seq Scans filtering on a watermark column, and nodes added or removed
+    since previous_shape.
+    """
+    warnings = []
+    for node in plan_nodes(plan["Plan"]):
+        node_filter = node.get("Filter", "")
+        if node["Node Type"] == "Seq Scan" and any(column in node_filter for column in WATERMARK_COLUMNS):
+            warnings.append(f"Seq Scan on {node.get('Relation Name')} applies the watermark filter: {node_filter}")
+
+    if previous_shape is not None:
+        shape = plan_shape(plan)
+        added = [line for line in shape if line not in previous_shape]
+        removed = [line for line in previous_shape if line not in shape]
+        if added or removed:
+            warnings.append("Plan changed since the last dry run: "
+                            + ", ".join([f"+{line}" for line in added] + [f"-{line}" for line in removed]))
+    return warnings
+
+
+def plan_summary(plan):
+    """
+    Row counts, timing and buffer usage of the plan's top node.
+    """
+    top = plan["Plan"]
+    return {
+        "estimated_rows": top.get("Plan Rows"),
+        "actual_rows": top["Actual Rows"] * top.get("Actual Loops", 1) if "Actual Rows" in top else None,
+        "execution_ms": plan.get("Execution Time"),
+        "shared_hit_blocks": top.get("Shared Hit Blocks"),
+        "shared_read_blocks": top.get("Shared Read Blocks"),
+    }
+
+
+def save_plan(plan_dir, name, record):
+    """
+    Appends record to <plan_dir>/<name>.jsonl and returns the previous
+    record saved for name, or None.
+    """
+    os.makedirs(plan_dir, exist_ok=True)
+    path = os.path.join(plan_dir, f"{name}.jsonl")
+    previous = None
+    if os.path.exists(path):
+        with open(path) as plan_file:
+            lines = [line for line in plan_file if line.strip()]
+        if lines:
+            previous = json.loads(lines[-1])
+    with open(path, "a") as plan_file:
+        plan_file.write(json.dumps(record, default=str) + "\n")
+    return previous
+
+
+def _report(name, plan, plan_dir, details):
+    previous = save_plan(plan_dir, name, {
+        "name": name,
+        "captured_at": datetime.datetime.utcnow().replace(tzinfo=None).isoformat(),
+        **details,
+        "shape": plan_shape(plan),
+        "plan": plan,
+    })
+    return {"name": name, **details, **plan_summary(plan),
+            "warnings": plan_warnings(plan, previous["shape"] if previous else None)}
+
+
+def dry_run_table(spec, source_pool, dest_pool, options=None, plan_dir="dry_run_plans", analyze=True):
+    """
+    Explains spec's source query with the parameters the next refresh would
+    use and returns its report dict. Partitioned tables are explained as one
+    unpartitioned query.
+    """
+    options = options or RefreshOptions()
+    query_pool = dest_pool if spec.source == "dest" else source_pool
+
+    # A table due for a backfill reads everything, chunk by chunk
+    backfill = needs_backfill(spec, dest_pool, options)
+    with dest_pool.connection() as dest_conn:
+        with dest_conn.cursor() as dest_cursor:
+            if backfill:
+                watermark_ts, watermark_key = INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY
+            else:
+                watermark_ts, watermark_key = read_watermark(dest_cursor, spec.name,
+                                                             update_log_table=options.update_log_table)
+            exclusions = read_exclusions(dest_cursor, spec.exclusions)
+        dest_conn.rollback()
+
+    params = {**watermark_params(watermark_ts, watermark_key), **key_range_params(), **partition_params(),
+              **exclusions}
+    with query_pool.connection() as source_conn:
+        try:
+            with source_conn.cursor() as source_cursor:
+                source_cursor.execute("SET TRANSACTION READ ONLY")
+                plan = explain(source_cursor, inline_query(source_conn, spec.query, params), analyze)
+        finally:
+            source_conn.rollback()
+
+    return _report(spec.name, plan, plan_dir, {
+        "mode": "backfill" if backfill else "incremental",
+        "watermark": [watermark_ts, watermark_key],
+    })
+
+
+def dry_run_cleanse(dest_pool, plan_dir="dry_run_plans", analyze=True, update_log_table="update_log", full=False):
+    """
+    Explains the deletes of the cleanse run_cleanse would run now, full or
+    incremental, inside a transaction that is rolled back, including the
+    closure cache update or temp scopes they depend on. With analyze the
+    deletes run and lock their rows until the rollback. Returns one report
+    dict per table; none when an incremental cleanse has nothing to do.
+    """
+    reports = []
+    with dest_pool.connection() as dest_conn:
+        try:
+            with dest_conn.cursor() as dest_cursor:
+                mode, since, until, _ = next_cleanse(dest_cursor, full, update_log_table=update_log_table)
+                if since is None:
+                    closure_counts = build_valid_id_closure(dest_cursor, update_log_table=update_log_table)
+                    for table, (_, closure_table) in CLEANSE_TARGETS.items():
+                        if not closure_counts.get(closure_table):
+                            continue
+                        plan = explain(dest_cursor, invalid_records_delete_sql(table), analyze)
+                        reports.append(_report(f"cleanse_{table}", plan, plan_dir, {"mode": "cleanse"}))
+                elif since == until:
+                    print(f"cleanse: incremental, nothing logged since {since}")
+                else:
+                    for table in prepare_touched_scopes(dest_cursor, since, until,
+                                                        update_log_table=update_log_table):
+                        plan = explain(dest_cursor, touched_records_delete_sql(table), analyze)
+                        reports.append(_report(f"cleanse_incremental_{table}", plan, plan_dir, {
+                            "mode": "incremental cleanse",
+                            "watermark": [since, until],
+                        }))
+        finally:
+            dest_conn.rollback()
+    return reports
+
+
+def dry_run_refresh(specs, source_pool, dest_pool, options=None, plan_dir="dry_run_plans", analyze=True,
+                    full_cleanse=False):
+    """
+    Dry-runs every spec and the cleanse (full when full_cleanse is set, as
+    in run_cleanse), prints a report and returns the report dicts. Nothing
+    is modified.
+    """
+    options = options or RefreshOptions()
+    reports = [dry_run_table(spec, source_pool, dest_pool, options, plan_dir, analyze) for spec in specs]
+    reports += dry_run_cleanse(dest_pool, plan_dir, analyze, options.update_log_table, full_cleanse)
+
+    for report in reports:
+        rows = report["actual_rows"] if report["actual_rows"] is not None else f"~{report['estimated_rows']}"
+        line = f"{report['name']}: {report['mode']}"
+        if "watermark" in report:
+            line += f" from {report['watermark'][0]} / {report['watermark'][1]}"
+        line += f", {rows} rows"
+        if report["execution_ms"] is not None:
+            line += (f", {report['execution_ms']:.1f} ms, buffers hit {report['shared_hit_blocks']}"
+                     f" read {report['shared_read_blocks']}")
+        print(line)
+        for warning in report["warnings"]:
+            print(f"  ! {warning}")
+    print(f"Plans saved to {plan_dir}")
+    return reports
@@ -0,0 +1,218 @@
+"""
+Generic refresh engine: runs one table spec through watermark read,
+extract, bulk load, watermark advance and update_log entry.
+
+Each refresh is one metrics run named after the table, with the stages
+watermark_read, source_execute, fetch, load, merge (or insert_select),
+log_write and commit; see refresh/metrics.py.
+"""
+import datetime
+import functools
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+
+from refresh.backfill import backfill_needed, ensure_backfill_store, key_range_params, run_backfill
+from refresh.batching import AdaptiveBatcher
+from refresh.exclusions import ensure_exclusion_store, read_exclusions
+from refresh.id_log import UPDATE_LOG_INSERT
+from refresh.metrics import run_metrics, stage
+from refresh.partitioned import partition_params, partitioned_delta, slice_count
+from refresh.statements import execute_prepared
+from refresh.transfer import transfer_delta
+from refresh.watermark import advance_watermark, ensure_watermark_store, read_watermark, watermark_params
+
+
+@dataclass
+class TableSpec:
+    """
+    One analytical_model table and the incremental source query that feeds it.
+    """
+    name: str
+    # Conflict key of the destination table; the query must return it first
+    key: str
+    query: str
+    # Pool the query runs on: "source", or "dest" for tables fed from the destination DB
+    source: str = "source"
+    # False loads with a plain INSERT, for tables without a unique key
+    on_conflict: bool = True
+    # The query only projects and renames columns, so COPY output can be piped as is
+    pipe: bool = False
+    # Tables that must finish refreshing before this one starts
+    depends_on: tuple = ()
+    # Source table and key column the first-load backfill walks in chunks; None disables it
+    chunk_table: str = None
+    chunk_column: str = "id"
+    # refresh_exclusion datasets the query filters out, as %(excluded_<dataset>_ids)s
+    exclusions: tuple = ()
+    # False for queries that number rows across the whole delta, which parallel slices would split
+    partitionable: bool = True
+
+
+@dataclass
+class RefreshOptions:
+    """
+    Extraction and logging settings shared by every table.
+    """
+    stream: bool = True
+    itersize: int = 10000
+    batch_size: int = 50000
+    # Resize streamed batches from their measured row width and load time, committing each
+    # one: bytes of Python rows per batch and seconds per batch load; 0 turns a limit off
+    batch_memory_budget: int = 0
+    batch_target_seconds: float = 0.0
+    min_batch_size: int = 1000
+    max_batch_size: int = 1000000
+    # Allow piped COPY for specs marked pipe
+    pipe: bool = True
+    copy_format: str = "text"
+    # Move the delta with one server-side INSERT ... SELECT when source and destination are the same database
+    server_side: bool = True
+    # First loads go through the chunked backfill; 0 loads them in one transaction
+    backfill_chunk_size: int = 50000
+    backfill_workers: int = 1
+    # {table name: slices} for tables whose extraction runs as parallel hash partitions
+    partitions: dict = field(default_factory=dict)
+    update_log_table: str = "update_log"
+
+    def batcher(self):
+        """
+        A new AdaptiveBatcher for one streamed transfer, or None when both
+        limits are off and batches keep batch_size rows.
+        """
+        if not (self.batch_memory_budget or self.batch_target_seconds):
+            return None
+        return AdaptiveBatcher(self.batch_memory_budget, self.batch_target_seconds, self.batch_size,
+                               self.min_batch_size, self.max_batch_size)
+
+
+def ensure_update_log_counts(cursor, update_log_table="update_log"):
+    """
+    Adds the inserted/updated/unchanged count columns to update_log if missing.
+    "count" keeps meaning rows extracted from the source.
+    """
+    cursor.execute(f'''
+        ALTER TABLE analytical_model.{update_log_table}
+            ADD COLUMN IF NOT EXISTS inserted_count integer,
+            ADD COLUMN IF NOT EXISTS updated_count integer,
+            ADD COLUMN IF NOT EXISTS unchanged_count integer
+    ''')
+
+
+def ensure_refresh_stores(cursor, update_log_table="update_log"):
+    """
+    Creates or upgrades everything refresh_table keeps on the destination:
+    the watermark, backfill and exclusion tables and the update_log count
+    columns. The caller commits.
+    """
+    ensure_watermark_store(cursor)
+    ensure_update_log_counts(cursor, update_log_table)
+    ensure_backfill_store(cursor)
+    ensure_exclusion_store(cursor)
+
+
+def needs_backfill(spec, dest_pool, options):
+    """
+    True when spec.name goes through the chunked backfill instead of an
+    incremental run.
+    """
+    if not (spec.chunk_table and options.backfill_chunk_size):
+        return False
+    with dest_pool.connection() as dest_conn:
+        return backfill_needed(dest_conn.cursor(), spec.name, update_log_table=options.update_log_table)
+
+
+def refresh_table(spec, source_pool, dest_pool, options=None):
+    """
+    Refreshes analytical_model.{spec.name} from spec.query and logs the run.
+    A table that was never loaded, or whose backfill was interrupted, is
+    backfilled in key chunks instead. Returns the TransferResult.
+    """
+    options = options or RefreshOptions()
+    table_name = spec.name
+    query_pool = dest_pool if spec.source == "dest" else source_pool
+
+    with run_metrics(table_name):
+        try:
+            return _refresh_table(spec, source_pool, dest_pool, options, query_pool)
+        except Exception as e:
+            print(f"Error refreshing {table_name}:", e)
+            # Re-raise so the scheduler holds back steps that depend on this table
+            raise
+
+
+def _refresh_table(spec, source_pool, dest_pool, options, query_pool):
+    table_name = spec.name
+
+    # Decide on a backfill before holding any connections, since chunks borrow their own
+    if needs_backfill(spec, dest_pool, options):
+        return run_backfill(spec, source_pool, dest_pool, options)
+
+    # Borrow pooled connections to the destination and the spec's source;
+    # partitioned extraction borrows one source connection per slice instead
+    partitions = slice_count(spec, options.partitions)
+    source_connection = nullcontext() if partitions > 1 else query_pool.connection()
+    with dest_pool.connection() as dest_conn, source_connection as source_conn:
+        dest_cursor = dest_conn.cursor()
+
+        # Read the table's watermark: the newest (modified_ts, key) loaded so far
+        with stage("watermark_read"):
+            watermark_ts, watermark_key = read_watermark(dest_cursor, table_name,
+                                                         update_log_table=options.update_log_table)
+
+        # Record the new start timestamp
+        ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
+
+        # Extract the delta and bulk load it through a COPY staging table
+        params = {**watermark_params(watermark_ts, watermark_key), **key_range_params(), **partition_params(),
+                  **read_exclusions(dest_cursor, spec.exclusions)}
+        if partitions > 1:
+            result = partitioned_delta(query_pool, dest_conn, table_name, spec.key, spec.query, params,
+                                       partitions, on_conflict=spec.on_conflict, pipe=options.pipe and spec.pipe,
+                                       batch_size=options.batch_size, itersize=options.itersize)
+        else:
+            batcher = options.batcher()
+            result = transfer_delta(source_conn, dest_conn, table_name, spec.key, spec.query, params,
+                                    on_conflict=spec.on_conflict,
+                                    stream=options.stream, batch_size=options.batch_size, itersize=options.itersize,
+                                    pipe=options.pipe and spec.pipe, copy_format=options.copy_format,
+                                    server_side=options.server_side, batcher=batcher)
+            if batcher is not None and batcher.history:
+                print(f"Loaded {table_name} in {batcher.summary()}")
+
+        if not result.record_count:
+            print(f"No new or updated records found in {table_name}. No changes made.")
+        else:
+            # Advance the watermark in the same transaction as the load
+            if result.high_water is not None:
+                advance_watermark(dest_cursor, table_name, *result.high_water)
+
+            # Record end timestamp
+            ingest_end_ts = datetime.datetime.utcnow().replace(tzinfo=None)
+
+            # Log ingestion including the range-compressed IDs and what the upsert did. The log row
+            # commits with the load: the cleanse finds touched rows only through update_log
+            with stage("log_write"):
+                log_insert = UPDATE_LOG_INSERT.format(schema="analytical_model",
+                                                      update_log_table=options.update_log_table)
+                execute_prepared(dest_cursor, log_insert,
+                                 (table_name, ingest_start_ts, ingest_end_ts, "upsert", result.record_count,
+                                  result.logged_ids, result.inserted, result.updated, result.unchanged))
+            with stage("commit") as commit_stage:
+                dest_conn.commit()
+                commit_stage.rows = result.record_count
+
+            print(f"Upserted {result.record_count} records in {table_name}: {result.inserted} inserted, "
+                  f"{result.updated} updated, {result.unchanged} unchanged")
+            print(f"Update log recorded for {table_name}.")
+
+        dest_cursor.close()
+    return result
+
+
+def table_refresh_tasks(specs, source_pool, dest_pool, options=None):
+    """
+    Returns (tasks, dependencies) for run_dependency_graph, one task per spec.
+    """
+    tasks = {spec.name: functools.partial(refresh_table, spec, source_pool, dest_pool, options) for spec in specs}
+    dependencies = {spec.name: list(spec.depends_on) for spec in specs if spec.depends_on}
+    return tasks, dependencies
@@ -0,0 +1,94 @@
+"""
+Configurable ID exclusions for the source queries.
+
+Excluded IDs live in analytical_model.refresh_exclusion, one row per
+(dataset, excluded_id), e.g. dataset "tactic" for tactic IDs the model must
+never contain. A spec lists the datasets its query filters on; the engine
+reads them before extracting and passes each as the bigint array parameter
+%(excluded_<dataset>_ids)s. The source lives in another database, so the
+query applies it as <> ALL(...) inside its first CTE, before any joins;
+Postgres hashes the array, so the check stays cheap as the list grows.
+"""
+import datetime
+
+EXCLUSION_TABLE = "refresh_exclusion"
+
+# Seeded when the store is first created: the tactics the version query used
+# to exclude with a hardcoded NOT IN list (1259 through 1286)
+DEFAULT_EXCLUSIONS = {
+    "tactic": tuple(range(1259, 1287)),
+}
+
+# Formatted with schema; takes the list of datasets
+EXCLUDED_IDS_QUERY = '''
+    SELECT dataset, array_agg(excluded_id ORDER BY excluded_id)
+    FROM {schema}.refresh_exclusion
+    WHERE dataset = ANY(%s)
+    GROUP BY dataset
+'''
+
+
+def ensure_exclusion_store(cursor, schema="analytical_model"):
+    """
+    Creates the exclusion table if it does not exist yet and seeds it with
+    DEFAULT_EXCLUSIONS. Existing tables are left alone, so removed
+    exclusions stay removed.
+    """
+    cursor.execute("SELECT to_regclass(%s)", (f"{schema}.{EXCLUSION_TABLE}",))
+    if cursor.fetchone()[0] is not None:
+        return
+
+    cursor.execute(f'''
+        CREATE TABLE {schema}.{EXCLUSION_TABLE} (
+            dataset text NOT NULL,
+            excluded_id bigint NOT NULL,
+            reason text,
+            added_at timestamp NOT NULL,
+            PRIMARY KEY (dataset, excluded_id)
+        )
+    ''')
+    for dataset, ids in DEFAULT_EXCLUSIONS.items():
+        add_exclusions(cursor, dataset, ids, "seeded from the version query's NOT IN list", schema)
+
+
+def add_exclusions(cursor, dataset, ids, reason=None, schema="analytical_model"):
+    """
+    Excludes ids of dataset from every query that filters on it, from the
+    next refresh on. Rows already loaded are not removed.
+    """
+    added_at = datetime.datetime.utcnow().replace(tzinfo=None)
+    cursor.executemany(f'''
+        INSERT INTO {schema}.{EXCLUSION_TABLE} (dataset, excluded_id, reason, added_at)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (dataset, excluded_id) DO NOTHING
+    ''', [(dataset, excluded_id, reason, added_at) for excluded_id in ids])
+
+
+def remove_exclusions(cursor, dataset, ids, schema="analytical_model"):
+    """
+    Lets ids of dataset through again. Rows skipped while they were excluded
+    only come back once they change at the source, or with a reload.
+    """
+    cursor.execute(f'''
+        DELETE FROM {schema}.{EXCLUSION_TABLE}
+        WHERE dataset = %s AND excluded_id = ANY(%s)
+    ''', (dataset, list(ids)))
+
+
+def exclusion_params(datasets, rows):
+    """
+    Query parameters for the given datasets from EXCLUDED_IDS_QUERY rows;
+    datasets without exclusions get an empty array.
+    """
+    excluded = dict(rows)
+    return {f"excluded_{dataset}_ids": list(excluded.get(dataset) or []) for dataset in datasets}
+
+
+def read_exclusions(cursor, datasets, schema="analytical_model"):
+    """
+    Returns the %(excluded_<dataset>_ids)s parameters for datasets.
+    """
+    if not datasets:
+        return {}
+    cursor.execute(EXCLUDED_IDS_QUERY.format(schema=schema), (list(datasets),))
+    return exclusion_params(datasets, cursor.fetchall())
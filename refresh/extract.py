@@ -0,0 +1,47 @@
+"""
+Source-side extraction helpers.
+"""
+from itertools import islice
+
+from refresh.metrics import stage
+
+
+def fetch_all(source_conn, query, params=None):
+    """
+    Runs the query on a regular client-side cursor and returns
+    (columns, rows) with the whole result held in memory.
+    """
+    with source_conn.cursor() as cursor:
+        with stage("source_execute"):
+            cursor.execute(query, params)
+        with stage("fetch") as fetch_stage:
+            rows = cursor.fetchall()
+            fetch_stage.rows = len(rows)
+        columns = [desc[0] for desc in cursor.description]
+    return columns, rows
+
+
+def stream_batches(source_conn, query, params=None, batch_size=50000, itersize=10000,
+                   cursor_name="refresh_stream", batcher=None):
+    """
+    Runs the query on a named (server-side) cursor and yields
+    (columns, rows) batches of at most batch_size rows, or of batcher.size
+    rows as it stands when each batch is read.
+
+    Rows come over the wire itersize at a time, so peak memory is bounded by
+    the batch size no matter how large the delta is. Only the time spent
+    reading a batch counts as fetch, not the time the caller holds it.
+    """
+    with source_conn.cursor(name=cursor_name) as cursor:
+        cursor.itersize = itersize
+        with stage("source_execute"):
+            cursor.execute(query, params)
+
+        rows = iter(cursor)
+        while True:
+            with stage("fetch") as fetch_stage:
+                batch = list(islice(rows, batcher.size if batcher is not None else batch_size))
+                fetch_stage.rows = len(batch)
+            if not batch:
+                break
+            yield [desc[0] for desc in cursor.description], batch
@@ -0,0 +1,119 @@
+"""
+Compact ID lists for update_log.ids.
+
+A run's IDs are stored sorted and range-compressed: "1:500,502,510:512"
+covers 1..500, 502 and 510..512. The old ", "-joined lists are valid in
+this format too (every entry is a one-ID run), so existing log rows are
+read the same way.
+"""
+
+# Expands every logged upsert, and every key deleted by change capture, into
+# one row per ID. Entries are either "id" or "low:high"; surrounding
+# whitespace from the old format is ignored.
+LOGGED_IDS_QUERY = '''
+    SELECT l."table" AS table_name, l.ingest_start_ts, l.ingest_end_ts, g.id
+    FROM {schema}.{update_log_table} l
+    CROSS JOIN LATERAL unnest(string_to_array(l.ids, ',')) AS x(run)
+    CROSS JOIN LATERAL generate_series(
+        split_part(trim(x.run), ':', 1)::bigint,
+        COALESCE(NULLIF(split_part(trim(x.run), ':', 2), ''), split_part(trim(x.run), ':', 1))::bigint
+    ) AS g(id)
+    WHERE l."type" IN ('upsert', 'cdc_delete') AND trim(x.run) <> ''
+'''
+
+# One update_log row per load, formatted with schema and update_log_table
+UPDATE_LOG_INSERT = '''
+    INSERT INTO {schema}.{update_log_table}
+        ("table", ingest_start_ts, ingest_end_ts, "type", "count", ids,
+         inserted_count, updated_count, unchanged_count)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+'''
+
+
+def compact_ids(ids):
+    """
+    Returns the range-compressed string for an iterable of integer IDs.
+    Duplicates are dropped and order is not kept.
+    """
+    return format_runs(id_runs(ids))
+
+
+def id_runs(ids):
+    """
+    Returns the sorted (low, high) runs of consecutive IDs in an iterable of
+    integer IDs, so a batch's IDs can be dropped once it is loaded.
+    """
+    runs = []
+    for value in sorted(set(ids)):
+        if runs and value == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], value)
+        else:
+            runs.append((value, value))
+    return runs
+
+
+def merge_runs(*run_lists):
+    """
+    Merges (low, high) run lists into one sorted list, joining runs that
+    overlap or touch.
+    """
+    merged = []
+    for low, high in sorted(run for runs in run_lists for run in runs):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def format_runs(runs):
+    """
+    Renders sorted, non-touching (low, high) runs as an update_log.ids string.
+    """
+    return ",".join(str(low) if low == high else f"{low}:{high}" for low, high in runs)
+
+
+def expand_ids(logged_ids):
+    """
+    Returns the sorted list of IDs in an update_log.ids value.
+    """
+    ids = []
+    for run in (logged_ids or "").split(","):
+        run = run.strip()
+        if not run:
+            continue
+        low, _, high = run.partition(":")
+        ids.extend(range(int(low), int(high or low) + 1))
+    return sorted(ids)
+
+
+def compact_ids_sql(relation, column):
+    """
+    Query returning the compact ID string for an integer column, built
+    server-side with gaps-and-islands so the IDs never reach Python.
+    """
+    return f'''
+        SELECT COALESCE(string_agg(CASE WHEN low = high THEN low::text ELSE low || ':' || high END, ','
+                                   ORDER BY low), '')
+        FROM (
+            SELECT MIN(id) AS low, MAX(id) AS high
+            FROM (
+                SELECT id, id - ROW_NUMBER() OVER (ORDER BY id) AS run
+                FROM (SELECT DISTINCT {column}::bigint AS id FROM {relation} WHERE {column} IS NOT NULL) d
+            ) numbered
+            GROUP BY run
+        ) runs
+    '''
+
+
+def read_logged_ids(cursor, table_name, ingest_start_ts, schema="analytical_model", update_log_table="update_log"):
+    """
+    Returns the sorted IDs touched by the run of table_name that started at
+    ingest_start_ts.
+    """
+    cursor.execute(f'''
+        SELECT DISTINCT id FROM ({LOGGED_IDS_QUERY.format(schema=schema, update_log_table=update_log_table)}) r
+        WHERE r.table_name = %s AND r.ingest_start_ts = %s
+        ORDER BY id
+    ''', (table_name, ingest_start_ts))
+    return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,219 @@
+"""
+Per-stage timing, row and byte counts for refresh runs.
+
+A run is opened with run_metrics(name); while it is active, stage(name)
+blocks anywhere below it (engine, extract, bulk load, cleanse) add their
+duration, rows and bytes to it. The active run is held in a context
+variable, so helpers record into it without taking a metrics argument, and
+code running outside a run records nothing. When the run ends it is handed
+to every registered exporter.
+"""
+import datetime
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+METRICS_TABLE = "refresh_metrics"
+
+_current_run = ContextVar("refresh_run_metrics", default=None)
+
+# Callables taking a finished RunMetrics; see add_exporter
+EXPORTERS = []
+
+
+class StageMetrics:
+    """
+    Totals for one stage name within a run; repeated stages accumulate.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def as_dict(self):
+        return {"stage": self.name, "seconds": round(self.seconds, 4), "calls": self.calls,
+                "rows": self.rows, "bytes": self.bytes}
+
+
+class RunMetrics:
+    """
+    Stages of one refresh run, in the order they first ran.
+    """
+
+    def __init__(self, name):
+        self.run_id = str(uuid.uuid4())
+        self.name = name
+        self.started_at = datetime.datetime.utcnow().replace(tzinfo=None)
+        self.seconds = 0.0
+        self.status = "ok"
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage_name, seconds=0.0, rows=0, byte_count=0, calls=0):
+        with self._lock:
+            stage_metrics = self.stages.setdefault(stage_name, StageMetrics(stage_name))
+            stage_metrics.seconds += seconds
+            stage_metrics.calls += calls
+            stage_metrics.rows += rows
+            stage_metrics.bytes += byte_count
+
+    def as_dict(self):
+        return {
+            "run_id": self.run_id,
+            "name": self.name,
+            "started_at": self.started_at.isoformat(),
+            "seconds": round(self.seconds, 4),
+            "status": self.status,
+            "stages": [stage_metrics.as_dict() for stage_metrics in self.stages.values()],
+        }
+
+
+class _StageCounter:
+    """
+    Handed out by stage() so the block can report rows and bytes.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.bytes = 0
+
+
+@contextmanager
+def run_metrics(name, export_on_exit=True):
+    """
+    Opens a run for the duration of the with block and exports it at the
+    end, also when the block raises. With export_on_exit False the caller
+    passes the run to export() itself.
+    """
+    run = RunMetrics(name)
+    token = _current_run.set(run)
+    started = time.perf_counter()
+    try:
+        yield run
+    except Exception:
+        run.status = "error"
+        raise
+    finally:
+        run.seconds = time.perf_counter() - started
+        _current_run.reset(token)
+        if export_on_exit:
+            export(run)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the with block as stage `name` of the active run. The yielded
+    counter's rows and bytes are added to the stage.
+    """
+    counter = _StageCounter()
+    started = time.perf_counter()
+    try:
+        yield counter
+    finally:
+        run = _current_run.get()
+        if run is not None:
+            run.add(name, time.perf_counter() - started, counter.rows, counter.bytes, calls=1)
+
+
+def current_run():
+    """
+    The active RunMetrics, or None outside a run.
+    """
+    return _current_run.get()
+
+
+def add_exporter(exporter):
+    """
+    Registers a callable that receives every finished RunMetrics.
+    """
+    EXPORTERS.append(exporter)
+    return exporter
+
+
+def clear_exporters():
+    """
+    Unregisters every exporter, e.g. before a notebook cell registers them again.
+    """
+    EXPORTERS.clear()
+
+
+def export(run):
+    # A broken exporter must never fail the refresh it is reporting on
+    for exporter in list(EXPORTERS):
+        try:
+            exporter(run)
+        except Exception as e:
+            print(f"Metrics exporter {exporter!r} failed:", e)
+
+
+class JsonLinesExporter:
+    """
+    Writes one JSON line per run to a file, or prints it when path is None.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, run):
+        line = json.dumps(run.as_dict())
+        with self._lock:
+            if self.path is None:
+                print(line)
+            else:
+                with open(self.path, "a") as metrics_file:
+                    metrics_file.write(line + "\n")
+
+
+def ensure_metrics_store(cursor, schema="analytical_model"):
+    """
+    Creates the per-stage metrics table if it does not exist yet.
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.{METRICS_TABLE} (
+            run_id uuid NOT NULL,
+            name text NOT NULL,
+            started_at timestamp NOT NULL,
+            run_seconds double precision NOT NULL,
+            status text NOT NULL,
+            stage text NOT NULL,
+            stage_seconds double precision NOT NULL,
+            calls integer NOT NULL,
+            rows bigint NOT NULL,
+            bytes bigint NOT NULL,
+            PRIMARY KEY (run_id, stage)
+        )
+    ''')
+
+
+class MetricsTableExporter:
+    """
+    Stores each run as one row per stage in analytical_model.refresh_metrics,
+    on its own pooled connection so it never joins the refresh transaction.
+    """
+
+    def __init__(self, pool, schema="analytical_model"):
+        self.pool = pool
+        self.schema = schema
+
+    def __call__(self, run):
+        rows = [(run.run_id, run.name, run.started_at, run.seconds, run.status, stage_metrics.name,
+                 stage_metrics.seconds, stage_metrics.calls, stage_metrics.rows, stage_metrics.bytes)
+                for stage_metrics in run.stages.values()]
+        if not rows:
+            return
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.executemany(f'''
+                    INSERT INTO {self.schema}.{METRICS_TABLE}
+                        (run_id, name, started_at, run_seconds, status, stage, stage_seconds, calls, rows, bytes)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ''', rows)
+            conn.commit()
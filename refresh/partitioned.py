@@ -0,0 +1,177 @@
+"""
+Hash-partitioned parallel extraction.
+
+The source query runs as partition_count disjoint slices, each on its own
+pooled source connection, so a large table is read by several backends at
+once. Every query carries an optional
+mod(<partition expression>, partition_count) = partition_no filter for this.
+All slices feed one COPY FROM STDIN into a single staging table on the
+destination, so the merge, counts, ID log and watermark are the same as
+for the single-stream path.
+"""
+import queue
+import threading
+
+from psycopg2.extensions import encodings
+
+from refresh.bulk_load import create_staging_table, format_copy_row
+from refresh.copy_pipe import describe_query, inline_query
+from refresh.extract import stream_batches
+from refresh.metrics import stage
+from refresh.transfer import merge_staged_delta
+
+# Bytes a producer buffers before handing them to the loader
+FLUSH_BYTES = 1 << 16
+
+
+def partition_params(partition_no=None, partition_count=None):
+    """
+    Query parameters for the optional partition filter every table query
+    carries. None leaves the query unpartitioned.
+    """
+    return {"partition_no": partition_no, "partition_count": partition_count}
+
+
+def slice_count(spec, partitions):
+    """
+    Number of slices to extract spec in, from a {table name: slices}
+    mapping. Raises ValueError for specs marked partitionable=False.
+    """
+    count = partitions.get(spec.name, 1)
+    if count > 1 and not spec.partitionable:
+        raise ValueError(f"{spec.name} cannot be extracted in parallel slices: its query numbers rows "
+                         f"across the whole delta")
+    return count
+
+
+class QueueCopyStream:
+    """
+    File-like reader for COPY FROM STDIN fed by several producer threads.
+    Producers put whole COPY text rows, so their output interleaves only at
+    row boundaries. read() returns b"" once every producer has finished.
+    """
+
+    def __init__(self, producers, maxsize=64):
+        self._queue = queue.Queue(maxsize)
+        self._producers = producers
+        self._pending = b""
+        self.bytes_read = 0
+
+    def put(self, data):
+        self._queue.put(data)
+
+    def producer_done(self):
+        self._queue.put(None)
+
+    def drain(self):
+        """
+        Discards queued data until every producer has finished, so none of
+        them stays blocked on a full queue after the loader gave up.
+        """
+        while self._producers:
+            if self._queue.get() is None:
+                self._producers -= 1
+
+    def read(self, size=-1):
+        parts = [self._pending]
+        length = len(self._pending)
+        while self._producers and (size < 0 or length < size):
+            data = self._queue.get()
+            if data is None:
+                self._producers -= 1
+                continue
+            parts.append(data)
+            length += len(data)
+            self.bytes_read += len(data)
+
+        data = b"".join(parts)
+        if size < 0:
+            self._pending = b""
+            return data
+        self._pending = data[size:]
+        return data[:size]
+
+
+class _BufferedWriter:
+    """
+    Write target for copy_expert that batches rows before queueing them.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._parts = []
+        self._size = 0
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self._stream.put(b"".join(self._parts))
+            self._parts, self._size = [], 0
+
+
+def partitioned_delta(source_pool, dest_conn, table_name, key, source_query, params, partitions,
+                      on_conflict=True, pipe=False, batch_size=50000, itersize=10000):
+    """
+    Extracts the delta as `partitions` parallel slices and loads them into
+    one staging table. With pipe, slices are read with COPY TO STDOUT in text
+    format; otherwise rows are streamed through named cursors and rendered
+    as COPY text here. Producer threads do not record stages; the slices'
+    source time is part of the load. The caller owns the destination
+    transaction and must commit. Returns a TransferResult.
+    """
+    with source_pool.connection() as source_conn:
+        columns = describe_query(source_conn, inline_query(source_conn, source_query, params))
+
+    stream = QueueCopyStream(partitions)
+    producer_errors = []
+    encoding = encodings[dest_conn.encoding]
+
+    def produce(partition_no):
+        try:
+            slice_params = {**params, **partition_params(partition_no, partitions)}
+            writer = _BufferedWriter(stream)
+            with source_pool.connection() as source_conn:
+                if pipe:
+                    query = inline_query(source_conn, source_query, slice_params)
+                    with source_conn.cursor() as cursor:
+                        cursor.copy_expert(f"COPY ({query}\n) TO STDOUT WITH (FORMAT text)", writer)
+                else:
+                    for _, rows in stream_batches(source_conn, source_query, slice_params, batch_size, itersize,
+                                                  cursor_name=f"refresh_{table_name}_{partition_no}"):
+                        for row in rows:
+                            writer.write(format_copy_row(row).encode(encoding))
+            writer.flush()
+        except Exception as e:
+            producer_errors.append(e)
+        finally:
+            stream.producer_done()
+
+    producers = [threading.Thread(target=produce, args=(partition_no,), daemon=True,
+                                  name=f"extract-{table_name}-{partition_no}")
+                 for partition_no in range(partitions)]
+    for producer in producers:
+        producer.start()
+
+    try:
+        with dest_conn.cursor() as dest_cursor:
+            staging_table = create_staging_table(dest_cursor, table_name, columns)
+            with stage("load") as load_stage:
+                dest_cursor.copy_expert(f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN", stream)
+                load_stage.bytes = stream.bytes_read
+
+            # A failed slice just ends early, so check before merging partial data
+            for producer in producers:
+                producer.join()
+            if producer_errors:
+                raise producer_errors[0]
+
+            return merge_staged_delta(dest_cursor, staging_table, table_name, key, columns, on_conflict)
+    finally:
+        stream.drain()
+        for producer in producers:
+            producer.join()
@@ -0,0 +1,125 @@
+"""
+Pooled database connections shared by the refresh steps and validation.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class _CountingPool(ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that counts the connections it opens.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.opened = 0
+        super().__init__(*args, **kwargs)
+
+    def _connect(self, key=None):
+        self.opened += 1
+        return super()._connect(key)
+
+
+class ConnectionPool:
+    """
+    ThreadedConnectionPool wrapper that waits for a free connection instead of
+    raising PoolError, and keeps checkout and wait-time counters for sizing.
+
+    minconn defaults to maxconn: psycopg2 closes a returned connection
+    whenever minconn are already idle, so a smaller minconn makes concurrent
+    refreshes reconnect (and lose their prepared statements) on the next
+    checkout. "connections_opened" in stats() shows that churn.
+    """
+
+    def __init__(self, conn_info, minconn=None, maxconn=4, name=None):
+        self.name = name or conn_info.get("dbname", "database")
+        self.conn_info = dict(conn_info)
+        self.maxconn = maxconn
+        self._pool = _CountingPool(maxconn if minconn is None else minconn, maxconn, **conn_info)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.in_use = 0
+        self.peak_in_use = 0
+        # Connections opened outside the psycopg2 pool on its settings (the async engine's)
+        self.opened_outside = 0
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection for the duration of the with block. Anything left
+        uncommitted is rolled back when the connection goes back to the pool.
+        """
+        self.acquire_slot()
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self.release_slot()
+            raise
+
+        try:
+            yield conn
+        finally:
+            # putconn rolls back open transactions and discards broken connections
+            self._pool.putconn(conn, close=bool(conn.closed))
+            self.release_slot()
+
+    def acquire_slot(self):
+        """
+        Waits for one of the maxconn slots and counts the checkout. Callers
+        holding connections of their own (the async engine) take a slot per
+        connection, so they share the pool's limit and counters.
+        """
+        started = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - started
+
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def release_slot(self):
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    def count_opened(self):
+        """
+        Counts a connection opened outside the psycopg2 pool.
+        """
+        with self._lock:
+            self.opened_outside += 1
+
+    def stats(self):
+        """
+        Returns the pool counters as a dict.
+        """
+        with self._lock:
+            return {
+                "pool": self.name,
+                "maxconn": self.maxconn,
+                "checkouts": self.checkouts,
+                "total_wait_s": round(self.total_wait, 4),
+                "avg_wait_s": round(self.total_wait / self.checkouts, 4) if self.checkouts else 0.0,
+                "max_wait_s": round(self.max_wait, 4),
+                "peak_in_use": self.peak_in_use,
+                "connections_opened": self._pool.opened + self.opened_outside,
+            }
+
+    def report(self):
+        stats = self.stats()
+        print(f"Pool {stats['pool']}: {stats['checkouts']} checkouts, "
+              f"peak {stats['peak_in_use']}/{stats['maxconn']} in use, "
+              f"{stats['connections_opened']} connections opened, "
+              f"wait total {stats['total_wait_s']}s avg {stats['avg_wait_s']}s max {stats['max_wait_s']}s")
+
+    def closeall(self):
+        self._pool.closeall()
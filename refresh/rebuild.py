@@ -0,0 +1,312 @@
+"""
+Full rebuild of an analytical_model table through a shadow-table swap.
+
+Resetting update_log to reload a table upserts every row into the live,
+indexed target and leaves the invalid ones for the cleanse to delete. A
+rebuild instead loads the whole source query straight into a fresh shadow
+table with no indexes, deletes the rows the cleanse would delete and the
+superseded duplicates, builds the live table's indexes on it, analyzes it
+and swaps it in by rename, all in one destination transaction. Readers keep using the old table until the
+swap, which holds an exclusive lock only for the drop and renames; if the
+lock cannot be had within lock_timeout the swap is retried, and a failed
+rebuild leaves the live table untouched.
+
+The shadow table copies the live table's columns, defaults, checks,
+identity, privileges and serial sequence ownership. Tables referenced by
+foreign keys or views cannot be dropped, so their rebuild fails and rolls
+back.
+"""
+import datetime
+import re
+import time
+
+import psycopg2.errors
+
+from refresh.backfill import BACKFILL_TABLE, key_range_params
+from refresh.bulk_load import copy_rows_to_staging
+from refresh.copy_pipe import describe_query, inline_query, pipe_copy
+from refresh.engine import RefreshOptions
+from refresh.exclusions import read_exclusions
+from refresh.extract import stream_batches
+from refresh.id_log import UPDATE_LOG_INSERT, compact_ids_sql
+from refresh.metrics import run_metrics, stage
+from refresh.partitioned import partition_params
+from refresh.statements import execute_prepared
+from refresh.transfer import newest_mark_sql, same_database
+from refresh.validation import CLEANSE_TARGETS, CLOSURE_SOURCES, build_valid_id_closure, closure_cache_table, \
+    invalidate_valid_id_cache
+from refresh.watermark import INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, advance_watermark, watermark_params
+
+SHADOW_SUFFIX = "_rebuild"
+
+# Row filter applied to the filled shadow table, on alias s: the cleanse's rule
+# for each CLEANSE_TARGETS table. The cached tactic and version levels describe
+# the table being replaced, so tactic rows are checked against the campaign
+# level and version rows against the tactic level.
+REBUILD_FILTERS = {
+    table: (closure_table, f'''
+        s.{column} IS NULL OR EXISTS (
+            SELECT 1 FROM {{closure}} v WHERE v.{column} = s.{column}
+        )
+    ''')
+    for table, (column, closure_table) in CLEANSE_TARGETS.items()
+}
+REBUILD_FILTERS["tactic"] = ("valid_campaign", '''
+    s.id_tactic IS NULL OR EXISTS (
+        SELECT 1 FROM {closure} v WHERE v.id_campaign = s.id_campaign
+    )
+''')
+REBUILD_FILTERS["version"] = ("valid_tactic", '''
+    s.id_version IS NULL OR EXISTS (
+        SELECT 1 FROM {closure} v WHERE v.id_tactic = s.id_tactic
+    )
+''')
+
+
+def live_indexes(cursor, table_name, schema="analytical_model"):
+    """
+    Returns (index name, definition, constraint type or None) for every
+    index on schema.table_name; constraint type is "p" or "u" for indexes
+    backing a primary key or unique constraint.
+    """
+    cursor.execute('''
+        SELECT i.relname, pg_get_indexdef(i.oid), c.contype
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        LEFT JOIN pg_constraint c ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+        WHERE x.indrelid = %s::regclass
+        ORDER BY i.relname
+    ''', (f"{schema}.{table_name}",))
+    return cursor.fetchall()
+
+
+def create_shadow_table(cursor, table_name, schema="analytical_model"):
+    """
+    Creates the empty, unindexed shadow of schema.table_name with the same
+    columns, defaults, checks and privileges. Returns its name.
+    """
+    shadow_table = f"{table_name}{SHADOW_SUFFIX}"
+    cursor.execute(f'''
+        CREATE TABLE {schema}.{shadow_table}
+            (LIKE {schema}.{table_name} INCLUDING ALL EXCLUDING INDEXES)
+    ''')
+
+    # Readers keep their grants after the swap
+    cursor.execute('''
+        SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END,
+               a.privilege_type, a.is_grantable
+        FROM pg_class c
+        CROSS JOIN LATERAL aclexplode(c.relacl) a
+        LEFT JOIN pg_roles r ON r.oid = a.grantee
+        WHERE c.oid = %s::regclass AND a.grantee <> c.relowner
+    ''', (f"{schema}.{table_name}",))
+    for grantee, privilege, grantable in cursor.fetchall():
+        cursor.execute(f"GRANT {privilege} ON {schema}.{shadow_table} TO {grantee}"
+                       + (" WITH GRANT OPTION" if grantable else ""))
+    return shadow_table
+
+
+def build_shadow_indexes(cursor, table_name, shadow_table, indexes, schema="analytical_model"):
+    """
+    Builds the live table's indexes and key constraints on the filled shadow
+    table under temporary names. Returns {temporary name: live name}.
+    """
+    renames = {}
+    for index_no, (index_name, definition, constraint_type) in enumerate(indexes):
+        temp_name = f"{shadow_table}_idx{index_no}"
+        cursor.execute(re.sub(r" INDEX \S+ ON (ONLY )?\S+ ", f" INDEX {temp_name} ON {schema}.{shadow_table} ",
+                              definition, count=1))
+        if constraint_type == "p":
+            cursor.execute(f"ALTER TABLE {schema}.{shadow_table} ADD CONSTRAINT {temp_name} "
+                           f"PRIMARY KEY USING INDEX {temp_name}")
+        elif constraint_type == "u":
+            cursor.execute(f"ALTER TABLE {schema}.{shadow_table} ADD CONSTRAINT {temp_name} "
+                           f"UNIQUE USING INDEX {temp_name}")
+        renames[temp_name] = index_name
+    return renames
+
+
+def swap_shadow_table(cursor, table_name, shadow_table, index_renames, schema="analytical_model",
+                      lock_timeout="5s", lock_attempts=5):
+    """
+    Replaces schema.table_name with the shadow table in the caller's
+    transaction. Waits at most lock_timeout for readers to let go of the old
+    table, so new readers are never queued for long, and retries from a
+    savepoint up to lock_attempts times.
+    """
+    # Serial columns keep their sequence, which would otherwise go with the old table
+    cursor.execute('''
+        SELECT a.attname, pg_get_serial_sequence(%s, a.attname)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped AND a.attidentity = ''
+    ''', (f"{schema}.{table_name}", f"{schema}.{table_name}"))
+    owned_sequences = [(column, sequence) for column, sequence in cursor.fetchall() if sequence]
+
+    cursor.execute("SAVEPOINT rebuild_swap")
+    for attempt in range(1, lock_attempts + 1):
+        try:
+            cursor.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            cursor.execute(f"LOCK TABLE {schema}.{table_name} IN ACCESS EXCLUSIVE MODE")
+            break
+        except psycopg2.errors.LockNotAvailable as e:
+            if attempt == lock_attempts:
+                raise
+            cursor.execute("ROLLBACK TO SAVEPOINT rebuild_swap")
+            print(f"Waiting for readers of {table_name} to swap in the rebuild (attempt {attempt}):",
+                  str(e).strip())
+            time.sleep(attempt)
+    cursor.execute("SET LOCAL lock_timeout = 0")
+
+    for column, sequence in owned_sequences:
+        cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {schema}.{shadow_table}.{column}")
+    cursor.execute(f"DROP TABLE {schema}.{table_name}")
+    cursor.execute(f"ALTER TABLE {schema}.{shadow_table} RENAME TO {table_name}")
+    # Renaming an index renames the constraint it backs
+    for temp_name, index_name in index_renames.items():
+        cursor.execute(f"ALTER INDEX {schema}.{temp_name} RENAME TO {index_name}")
+    cursor.execute("RELEASE SAVEPOINT rebuild_swap")
+
+
+def load_full_source(source_conn, dest_conn, dest_cursor, spec, options, params, relation):
+    """
+    Loads the whole source query into relation on the destination, through
+    whichever path transfer_delta would pick, in source order. Returns
+    (rows loaded, columns).
+    """
+    query = inline_query(source_conn, spec.query, params)
+    columns = describe_query(source_conn, query)
+    column_names = ", ".join(columns)
+
+    if options.server_side and same_database(source_conn, dest_conn):
+        with stage("insert_select") as insert_stage:
+            dest_cursor.execute(f'''
+                INSERT INTO {relation} ({column_names})
+                SELECT {column_names} FROM ({query}
+                ) AS q
+            ''')
+            insert_stage.rows = dest_cursor.rowcount
+    elif options.pipe and spec.pipe:
+        pipe_copy(source_conn, dest_cursor, relation, columns, query, options.copy_format)
+    else:
+        for _, rows in stream_batches(source_conn, spec.query, params, options.batch_size, options.itersize,
+                                      cursor_name=f"rebuild_{spec.name}"):
+            copy_rows_to_staging(dest_cursor, relation, columns, rows)
+    source_conn.commit()
+
+    dest_cursor.execute(f"SELECT COUNT(*) FROM {relation}")
+    return dest_cursor.fetchone()[0], columns
+
+
+def rebuild_table(spec, source_pool, dest_pool, options=None, schema="analytical_model",
+                  lock_timeout="5s", lock_attempts=5):
+    """
+    Rebuilds analytical_model.{spec.name} from the full source query and
+    swaps it in, with the watermark, update_log row ("rebuild") and any
+    unfinished backfill settled in the same transaction. Rows the cleanse
+    would delete never reach the live table. Returns (rows extracted, rows loaded).
+    """
+    options = options or RefreshOptions()
+    table_name = spec.name
+    query_pool = dest_pool if spec.source == "dest" else source_pool
+
+    with run_metrics(table_name):
+        try:
+            # Bring the closure cache up to date in its own short transaction
+            closure_counts = {}
+            if table_name in REBUILD_FILTERS:
+                with dest_pool.connection() as dest_conn:
+                    with dest_conn.cursor() as dest_cursor:
+                        closure_counts = build_valid_id_closure(dest_cursor, schema, options.update_log_table)
+                    dest_conn.commit()
+
+            with dest_pool.connection() as dest_conn, query_pool.connection() as source_conn:
+                dest_cursor = dest_conn.cursor()
+                ingest_start_ts = datetime.datetime.utcnow().replace(tzinfo=None)
+
+                # Load everything straight into the unindexed shadow
+                params = {**watermark_params(INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY), **key_range_params(),
+                          **partition_params(), **read_exclusions(dest_cursor, spec.exclusions, schema)}
+                indexes = live_indexes(dest_cursor, table_name, schema)
+                shadow_table = create_shadow_table(dest_cursor, table_name, schema)
+                shadow = f"{schema}.{shadow_table}"
+                extracted, columns = load_full_source(source_conn, dest_conn, dest_cursor, spec, options, params,
+                                                      shadow)
+                high_water = None
+                if "modified_ts" in columns:
+                    dest_cursor.execute(newest_mark_sql(shadow, columns[0]))
+                    high_water = dest_cursor.fetchone()
+
+                # Drop invalid rows and collapse duplicates to the last loaded; a table
+                # filled in one transaction since its creation is in load order by ctid
+                prunes = []
+                if table_name in REBUILD_FILTERS:
+                    closure_table, row_filter = REBUILD_FILTERS[table_name]
+                    # An empty closure leaves the table alone, as in the cleanse
+                    if closure_counts.get(closure_table):
+                        valid_rows = row_filter.format(closure=closure_cache_table(closure_table, schema))
+                        prunes.append(f"DELETE FROM {shadow} s WHERE ({valid_rows}) IS NOT TRUE")
+                if spec.on_conflict:
+                    prunes.append(f"DELETE FROM {shadow} s USING {shadow} d "
+                                  f"WHERE d.{spec.key} = s.{spec.key} AND d.ctid > s.ctid")
+                loaded = extracted
+                if prunes:
+                    with stage("filter") as filter_stage:
+                        for prune in prunes:
+                            dest_cursor.execute(prune)
+                            loaded -= dest_cursor.rowcount
+                        filter_stage.rows = extracted - loaded
+
+                with stage("index_build"):
+                    index_renames = build_shadow_indexes(dest_cursor, table_name, shadow_table, indexes, schema)
+                    # Identity sequences start over in the shadow; move them past the loaded keys
+                    dest_cursor.execute(f'''
+                        SELECT a.attname FROM pg_attribute a
+                        WHERE a.attrelid = %s::regclass AND a.attidentity <> ''
+                    ''', (shadow,))
+                    for (column,) in dest_cursor.fetchall():
+                        dest_cursor.execute(f'''
+                            SELECT setval(pg_get_serial_sequence(%s, %s), MAX({column}))
+                            FROM {shadow} HAVING MAX({column}) IS NOT NULL
+                        ''', (shadow, column))
+                with stage("analyze"):
+                    dest_cursor.execute(f"ANALYZE {shadow}")
+
+                dest_cursor.execute(compact_ids_sql(shadow, columns[0]))
+                logged_ids = dest_cursor.fetchone()[0]
+
+                with stage("swap"):
+                    swap_shadow_table(dest_cursor, table_name, shadow_table, index_renames, schema,
+                                      lock_timeout, lock_attempts)
+
+                with stage("log_write"):
+                    if high_water is not None:
+                        advance_watermark(dest_cursor, table_name, *high_water, schema=schema)
+                    # The rebuild supersedes an interrupted first load
+                    dest_cursor.execute(f'''
+                        UPDATE {schema}.{BACKFILL_TABLE} SET finished_at = %s
+                        WHERE table_name = %s AND finished_at IS NULL
+                    ''', (datetime.datetime.utcnow().replace(tzinfo=None), table_name))
+                    # Rows under a replaced tactic or version are only re-validated by a full
+                    # cleanse, and the closure cache no longer matches the table
+                    if table_name in CLOSURE_SOURCES:
+                        invalidate_valid_id_cache(dest_cursor, schema)
+                        dest_cursor.execute("SELECT to_regclass(%s)", (f"{schema}.cleanse_state",))
+                        if dest_cursor.fetchone()[0] is not None:
+                            dest_cursor.execute(f"UPDATE {schema}.cleanse_state SET cleansed_through = NULL")
+                    log_insert = UPDATE_LOG_INSERT.format(schema=schema, update_log_table=options.update_log_table)
+                    execute_prepared(dest_cursor, log_insert,
+                                     (table_name, ingest_start_ts, datetime.datetime.utcnow().replace(tzinfo=None),
+                                      "rebuild", extracted, logged_ids, loaded, 0, 0))
+
+                with stage("commit") as commit_stage:
+                    dest_conn.commit()
+                    commit_stage.rows = loaded
+                dest_cursor.close()
+
+            print(f"Rebuilt {table_name}: {loaded} of {extracted} extracted records loaded, "
+                  f"{extracted - loaded} invalid or duplicate records skipped")
+            return extracted, loaded
+
+        except Exception as e:
+            print(f"Error rebuilding {table_name}:", e)
+            raise
@@ -0,0 +1,72 @@
+"""
+Dependency-aware concurrent runner for the per-table refresh steps.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def _check_graph(tasks, dependencies):
+    """
+    Raises ValueError for unknown dependencies or cycles.
+    """
+    for name, deps in dependencies.items():
+        missing = [dep for dep in deps if dep not in tasks]
+        if name not in tasks or missing:
+            raise ValueError(f"Unknown refresh step in dependencies of {name}: {missing or name}")
+
+    remaining = {name: set(dependencies.get(name, ())) for name in tasks}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"Dependency cycle between refresh steps: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+def run_dependency_graph(tasks, dependencies=None, max_workers=4):
+    """
+    Runs the callables in tasks ({name: callable}) on a thread pool of at most
+    max_workers threads. A step starts as soon as every step listed for it in
+    dependencies ({name: [names]}) has finished.
+
+    If a step raises, the steps that depend on it are skipped. Returns
+    (results, errors), both dicts keyed by step name.
+    """
+    dependencies = {name: set(deps) for name, deps in (dependencies or {}).items()}
+    _check_graph(tasks, dependencies)
+
+    results, errors = {}, {}
+    pending = {name: set(dependencies.get(name, ())) for name in tasks}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="refresh") as executor:
+        while pending or running:
+            # Skip anything that depends on a failed or skipped step
+            for name, deps in list(pending.items()):
+                failed = deps & errors.keys()
+                if failed:
+                    errors[name] = RuntimeError(f"Skipped because {', '.join(sorted(failed))} failed")
+                    del pending[name]
+
+            # Start every step whose dependencies have all finished
+            for name, deps in list(pending.items()):
+                if not deps - results.keys():
+                    running[executor.submit(tasks[name])] = name
+                    del pending[name]
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    errors[name] = e
+
+    for name, error in errors.items():
+        print(f"Refresh step {name} did not complete:", error)
+
+    return results, errors
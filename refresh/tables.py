@@ -0,0 +1,191 @@
+"""
+Table specs for the analytical_model refresh.
+
+Each spec names a destination table, its key and the incremental source
+query; refresh.engine runs every spec the same way. Source queries return
+the key first and a modified_ts column, and take these parameters:
+
+- (modified_ts, key) > (%(watermark_ts)s, %(watermark_key)s)
+- key_low < key <= key_high, either side None for open (backfill chunks)
+- key = ANY(key_ids), None for all keys (change capture re-reads, see refresh/cdc.py)
+- mod(key, partition_count) = partition_no, None for all rows (parallel slices;
+  specs marked partitionable=False ignore them)
+- excluded_<dataset>_ids, for each dataset in the spec's exclusions
+  (see refresh/exclusions.py)
+
+chunk_table/chunk_column name the source key the backfill walks in chunks.
+"""
+from refresh.engine import TableSpec
+
+# analytical_model.campaign from paign_default_campaign
+CAMPAIGN_QUERY = '''
+    SELECT CAST(id as int8) AS id_campaign, 
+        name AS campaign_name, 
+        audience AS audience_desc, 
+        '' AS primary_objective, 
+        current_status as status, 
+        planned_start_dt as planned_start_dte, 
+        planned_end_dt as planned_end_dte, 
+        actual_start_dt as actual_start_dte, 
+        actual_end_dt as actual_end_dte, 
+        CASE WHEN update_dt IS NULL THEN created_dt ELSE update_dt END as modified_ts
+    FROM paign_default_campaign 
+    WHERE (COALESCE(update_dt, created_dt), id) > (%(watermark_ts)s, %(watermark_key)s)
+      AND (%(key_low)s IS NULL OR id > %(key_low)s) AND (%(key_high)s IS NULL OR id <= %(key_high)s)
+      AND (%(key_ids)s::bigint[] IS NULL OR id = ANY(%(key_ids)s::bigint[]))
+      AND (%(partition_count)s IS NULL OR mod(abs(CAST(id as int8)), %(partition_count)s) = %(partition_no)s)
+'''
+
+# analytical_model.tactic from paign_default_tactic
+TACTIC_QUERY = '''
+    SELECT 
+    t.id AS id_tactic,
+    t.campaign_id AS id_campaign,
+    case when audience_criteria is null then 'Members with upcoming arrivals at the ' || brand_name else audience_criteria end as audience_desc, --was for lpa, cleanup
+    name AS tactic_name,
+    '' AS tactic_objective,
+    cast(actual_start_dt as date) AS tactic_start_dte,
+    cast(actual_end_dt as date) AS tactic_end_dte, 
+    'In-Market' as tactic_status, -- double check this with Kyle, WF status needs to be reflected in CP
+    tactic_type AS tactic_channel,
+    'Batch' AS tactic_setup_type, --verify that this metadata is being collected
+    'Marketing' AS tactic_type, --verify that this metadata is being collected
+    'PCM' AS tactic_publisher, --verify that this metadata is being collected
+    cast(planned_start_dt as date) AS planned_start_dte,
+    cast(planned_end_dt as date) AS planned_end_dte,
+    COALESCE(update_dt, created_dt) as modified_ts
+    FROM paign_default_tactic t  
+    WHERE (COALESCE(update_dt, created_dt), t.id) > (%(watermark_ts)s, %(watermark_key)s)
+      AND (%(key_low)s IS NULL OR t.id > %(key_low)s) AND (%(key_high)s IS NULL OR t.id <= %(key_high)s)
+      AND (%(key_ids)s::bigint[] IS NULL OR t.id = ANY(%(key_ids)s::bigint[]))
+      AND (%(partition_count)s IS NULL OR mod(abs(t.id), %(partition_count)s) = %(partition_no)s)
+'''
+
+# analytical_model.version from paign_placement_version and its content/placement lookups
+VERSION_QUERY = '''
+    WITH ppv_data AS (
+        SELECT 
+            ppv.id AS id_version,
+            ppv.tactic_id AS id_tactic,
+            ppv.module_id,
+            ppv.vehicle_placement_position_id,
+            COALESCE(ppv.language, 'English Global Default') AS language_desc,
+            ppv.audience_segment AS audience_segment_desc,
+            ppv.name AS version_name,
+            ppv.start_date AS planned_start_dte,
+            ppv.end_date AS planned_end_dte,
+            ppv.actual_start_dt AS actual_start_dte,
+            ppv.actual_end_dt AS actual_end_dte,
+            COALESCE(ppv.update_dt, ppv.created_dt) AS modified_ts
+        FROM paign_placement_version ppv 
+        left join paign_default_tactic t 
+        ON ppv.tactic_id = t.id
+        WHERE (COALESCE(ppv.update_dt, ppv.created_dt), ppv.id) > (%(watermark_ts)s, %(watermark_key)s)
+          AND (%(key_low)s IS NULL OR ppv.id > %(key_low)s) AND (%(key_high)s IS NULL OR ppv.id <= %(key_high)s)
+          AND (%(key_ids)s::bigint[] IS NULL OR ppv.id = ANY(%(key_ids)s::bigint[]))
+          -- The old outer WHERE ... NOT IN list dropped excluded and NULL tactics before
+          -- ROW_NUMBER as well (WHERE runs before window functions); here it also runs before
+          -- the joins fan out
+          AND ppv.tactic_id IS NOT NULL
+          AND ppv.tactic_id <> ALL(%(excluded_tactic_ids)s::bigint[])
+    )
+    SELECT DISTINCT ON (ppv_data.id_version)
+        ppv_data.id_version,
+        ppv_data.id_tactic,
+        ccg.id AS id_content_group,
+        ccg.offer_id AS id_offer,
+        ppv_data.language_desc,
+        ppv_data.audience_segment_desc,
+        ppv_data.version_name,
+        ppv_data.planned_start_dte,
+        ppv_data.planned_end_dte,
+        ppv_data.actual_start_dte,
+        ppv_data.actual_end_dte,
+        ROW_NUMBER() OVER (PARTITION BY aspv.audiencesegment_id
+                           ORDER BY cvpp.placement_type_row, ppv_data.id_version) AS position_row,
+        ROW_NUMBER() OVER (PARTITION BY aspv.audiencesegment_id
+                           ORDER BY cvpp.placement_type_column, ppv_data.id_version) AS position_column,
+        pt.placement_type_name AS placement_type,
+        ppv_data.modified_ts
+    FROM ppv_data
+    LEFT JOIN cf_modules cm ON ppv_data.module_id = cm.id
+    LEFT JOIN cf_content_group ccg ON cm.content_group_id = ccg.id
+    LEFT JOIN audience_segment_placement_versions aspv ON ppv_data.id_version = aspv.placementversion_id
+    LEFT JOIN cf_vehicle_placement_position cvpp ON ppv_data.vehicle_placement_position_id = cvpp.id
+    LEFT JOIN cf_placement_type pt ON cvpp.placement_type_id = pt.id
+    -- A version in several audience segments keeps the row of its lowest segment, so every
+    -- load picks the same one
+    ORDER BY ppv_data.id_version, aspv.audiencesegment_id NULLS LAST;
+'''
+
+# analytical_model.offer from paign_default_offer
+OFFER_QUERY = '''
+    SELECT DISTINCT
+    o.id AS id_offer,
+    o.name || '-' || o.description AS offer_name,
+    o.offer_type,
+    '' AS hurdle_value,
+    '' AS hurdle_type,
+    '' AS promo_code,
+    value_amount AS award_value,
+    value_amount_type AS award_type,
+    o.current_status AS status,
+    CAST(o.actual_start_dt AS DATE) AS offer_start_dte,
+    CAST(o.actual_end_dt AS DATE) AS offer_end_dte, 
+    CASE WHEN o.update_dt IS NULL THEN o.created_dt ELSE o.update_dt END AS modified_ts
+    FROM paign_default_offer o 
+    LEFT JOIN paign_default_valueamounttype vat ON o.value_amount_type_id = vat.id
+    WHERE (COALESCE(o.update_dt, o.created_dt), o.id) > (%(watermark_ts)s, %(watermark_key)s)
+      AND (%(key_low)s IS NULL OR o.id > %(key_low)s) AND (%(key_high)s IS NULL OR o.id <= %(key_high)s)
+      AND (%(key_ids)s::bigint[] IS NULL OR o.id = ANY(%(key_ids)s::bigint[]))
+      AND (%(partition_count)s IS NULL OR mod(abs(o.id), %(partition_count)s) = %(partition_no)s)
+'''
+
+# analytical_model.link from paign_module_link_ids_prod
+LINK_QUERY = '''
+    SELECT DISTINCT
+    l.id AS id_link,
+    v.id AS id_version,
+    split_part(l."original_url", '/', 1) AS domain,
+    l.original_url AS base_url,
+    l.final_url,
+    l.linked_text AS cta_text,
+    l.bit_type_name AS link_type,
+    l.created_ts AS modified_ts
+    FROM paign_module_link_ids_prod l
+    JOIN paign_placement_version v
+    ON v.tactic_id = l.tactic_id AND l.module_id = v.module_id
+    WHERE outdated_flag IS false AND (l.created_ts, l.id) > (%(watermark_ts)s, %(watermark_key)s)
+      AND (%(key_low)s IS NULL OR l.id > %(key_low)s) AND (%(key_high)s IS NULL OR l.id <= %(key_high)s)
+      AND (%(key_ids)s::bigint[] IS NULL OR l.id = ANY(%(key_ids)s::bigint[]))
+      AND (%(partition_count)s IS NULL OR mod(abs(l.id), %(partition_count)s) = %(partition_no)s);
+'''
+
+# analytical_model.treatment from public.treatment_placement_versions on the destination DB
+TREATMENT_QUERY = '''
+    SELECT DISTINCT
+        id,
+        treatment_id as id_treatment,
+        pv_id as id_version,
+        created_at as modified_ts
+    FROM public.treatment_placement_versions
+    WHERE (created_at, id) > (%(watermark_ts)s, %(watermark_key)s)
+      AND (%(key_low)s IS NULL OR id > %(key_low)s) AND (%(key_high)s IS NULL OR id <= %(key_high)s)
+      AND (%(key_ids)s::bigint[] IS NULL OR id = ANY(%(key_ids)s::bigint[]))
+      AND (%(partition_count)s IS NULL OR mod(abs(id), %(partition_count)s) = %(partition_no)s);
+'''
+
+TABLE_SPECS = [
+    TableSpec("campaign", "id_campaign", CAMPAIGN_QUERY, pipe=True, chunk_table="paign_default_campaign"),
+    TableSpec("tactic", "id_tactic", TACTIC_QUERY, pipe=True, chunk_table="paign_default_tactic"),
+    # Backfill chunks number positions per chunk, the same as incremental runs do per delta.
+    # Positions are numbered per audience segment across the delta, which hash slices would split
+    TableSpec("version", "id_version", VERSION_QUERY, depends_on=("tactic",), chunk_table="paign_placement_version",
+              exclusions=("tactic",), partitionable=False),
+    TableSpec("offer", "id_offer", OFFER_QUERY, pipe=True, chunk_table="paign_default_offer"),
+    # Loaded with a plain INSERT, no ON CONFLICT
+    TableSpec("link", "id_link", LINK_QUERY, on_conflict=False, pipe=True, chunk_table="paign_module_link_ids_prod"),
+    # Fed from public.treatment_placement_versions on the destination DB
+    TableSpec("treatment", "id_treatment", TREATMENT_QUERY, source="dest", on_conflict=False,
+              chunk_table="public.treatment_placement_versions"),
+]
@@ -0,0 +1,225 @@
+"""
+Moves a table's delta from the source query into analytical_model.
+"""
+import time
+from dataclasses import dataclass
+
+from refresh.batching import row_memory
+from refresh.bulk_load import UPSERT_COUNTS, conflict_action, copy_upsert, create_staging_table, merge_staging
+from refresh.copy_pipe import describe_query, inline_query, pipe_copy
+from refresh.extract import fetch_all, stream_batches
+from refresh.id_log import compact_ids_sql, format_runs, id_runs, merge_runs
+from refresh.metrics import current_run, stage
+from refresh.watermark import high_water_mark
+
+
+@dataclass
+class TransferResult:
+    """
+    Outcome of one table transfer.
+    """
+    # Number of source rows loaded
+    record_count: int = 0
+    # row[0] of the loaded rows, range-compressed for update_log.ids
+    logged_ids: str = ""
+    # Newest (modified_ts, key) loaded, the table's next watermark
+    high_water: tuple = None
+    # What the upsert did with the loaded rows; unchanged rows were skipped
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+    def add_counts(self, counts):
+        inserted, updated, unchanged = counts
+        self.inserted += inserted
+        self.updated += updated
+        self.unchanged += unchanged
+
+    def add_high_water(self, mark):
+        if mark is not None and (self.high_water is None or mark > self.high_water):
+            self.high_water = mark
+
+
+def transfer_delta(source_conn, dest_conn, table_name, key, source_query, params=None,
+                   on_conflict=True, stream=False, batch_size=50000, itersize=10000,
+                   pipe=False, copy_format="text", server_side=False, batcher=None):
+    """
+    Extracts the delta and bulk loads it into analytical_model.{table_name}.
+    The caller owns the destination transaction and must commit.
+    Returns a TransferResult.
+
+    With server_side, and source and destination being the same database,
+    the delta is moved by one INSERT ... SELECT on the server. Otherwise,
+    with pipe, the source COPY output is piped straight into the staging
+    table. With stream, rows are read through a server-side cursor and loaded
+    in batches of batch_size. Otherwise the whole delta is fetched at once.
+
+    With a batcher (refresh/batching.py), streamed batches are sized by it
+    and, for upserted tables, each one is committed as soon as it is loaded,
+    so locks and WAL are bounded per batch. The caller still commits the
+    watermark at the end; a run that fails part way re-reads the committed
+    batches next time, and the upsert leaves them unchanged. Plain-INSERT
+    tables would duplicate them, so they stay in the caller's transaction.
+    """
+    if server_side and same_database(source_conn, dest_conn):
+        return insert_select_delta(dest_conn, table_name, key, source_query, params, on_conflict)
+
+    if pipe:
+        return pipe_delta(source_conn, dest_conn, table_name, key, source_query, params,
+                          on_conflict, copy_format)
+
+    if stream:
+        batches = stream_batches(source_conn, source_query, params, batch_size, itersize,
+                                 cursor_name=f"refresh_{table_name}", batcher=batcher)
+    else:
+        batcher = None
+        columns, rows = fetch_all(source_conn, source_query, params)
+        batches = [(columns, rows)] if rows else []
+
+    # Each batch's IDs are compacted into runs as it loads, so memory follows the runs, not the delta
+    result = TransferResult()
+    loaded_runs = []
+    for columns, rows in batches:
+        started = time.perf_counter()
+        result.add_counts(copy_upsert(dest_conn, table_name, key, columns, rows, on_conflict=on_conflict))
+        if batcher is not None and on_conflict:
+            with stage("commit"):
+                dest_conn.commit()
+        if batcher is not None:
+            batcher.observe(len(rows), row_memory(rows), time.perf_counter() - started)
+        result.record_count += len(rows)
+        loaded_runs = merge_runs(loaded_runs, id_runs(row[0] for row in rows))
+        result.add_high_water(high_water_mark(rows, columns))
+
+    result.logged_ids = format_runs(loaded_runs)
+    return result
+
+
+def pipe_delta(source_conn, dest_conn, table_name, key, source_query, params=None,
+               on_conflict=True, copy_format="text"):
+    """
+    Loads the delta with COPY TO STDOUT -> COPY FROM STDIN and no Python rows.
+    Only the row count, the compact ID list for the update log and the
+    high-water mark are read back, from the staging table on the destination.
+
+    copy_format="binary" skips text parsing on both ends, but needs every
+    source column type to match the target column type exactly.
+    """
+    query = inline_query(source_conn, source_query, params)
+    columns = describe_query(source_conn, query)
+
+    with dest_conn.cursor() as dest_cursor:
+        staging_table = create_staging_table(dest_cursor, table_name, columns)
+        pipe_copy(source_conn, dest_cursor, staging_table, columns, query, copy_format)
+        return merge_staged_delta(dest_cursor, staging_table, table_name, key, columns, on_conflict)
+
+
+def merge_staged_delta(dest_cursor, staging_table, table_name, key, columns, on_conflict=True):
+    """
+    Reads the row count, compact ID list and high-water mark of a filled
+    staging table, merges it into the target and drops it.
+    Returns a TransferResult.
+    """
+    result = TransferResult()
+    dest_cursor.execute(f"SELECT COUNT(*) FROM {staging_table}")
+    result.record_count = dest_cursor.fetchone()[0]
+
+    # COPY streams fed the staging table without counting rows, so credit them to the load here
+    run = current_run()
+    if run is not None:
+        run.add("load", rows=result.record_count)
+
+    if result.record_count:
+        dest_cursor.execute(compact_ids_sql(staging_table, columns[0]))
+        result.logged_ids = dest_cursor.fetchone()[0]
+        dest_cursor.execute(newest_mark_sql(staging_table, columns[0]))
+        mark = dest_cursor.fetchone()
+        result.add_high_water(tuple(mark) if mark else None)
+        with stage("merge") as merge_stage:
+            result.add_counts(merge_staging(dest_cursor, staging_table, table_name, key, columns, on_conflict))
+            merge_stage.rows = result.record_count
+    dest_cursor.execute(f"DROP TABLE {staging_table}")
+
+    return result
+
+
+def newest_mark_sql(relation, key_column):
+    """
+    Selects the newest (modified_ts, key) of relation, the next watermark.
+    """
+    return f'''
+        SELECT modified_ts, {key_column} FROM {relation}
+        WHERE modified_ts IS NOT NULL AND {key_column} IS NOT NULL
+        ORDER BY 1 DESC, 2 DESC
+        LIMIT 1
+    '''
+
+
+def same_database(source_conn, dest_conn):
+    """
+    True when both connections point at the same host, port and database.
+    """
+    if source_conn is dest_conn:
+        return True
+    source, dest = source_conn.get_dsn_parameters(), dest_conn.get_dsn_parameters()
+    return all(source.get(name) == dest.get(name) for name in ("host", "port", "dbname"))
+
+
+def insert_select_delta(dest_conn, table_name, key, source_query, params=None, on_conflict=True):
+    """
+    Runs the source query and the upsert as a single INSERT ... SELECT on the
+    destination, for sources living in the same database. No rows leave the
+    server; the counts, compact IDs and high-water mark come back from the
+    same statement, which is timed as the insert_select stage.
+
+    With on_conflict, duplicate keys collapse to the newest modified_ts.
+    """
+    query = inline_query(dest_conn, source_query, params)
+    columns = describe_query(dest_conn, query)
+    column_names = ', '.join(columns)
+    has_modified_ts = "modified_ts" in columns
+
+    if on_conflict:
+        newest_first = f"{key}, modified_ts DESC NULLS LAST" if has_modified_ts else key
+        candidates = f"SELECT DISTINCT ON ({key}) {column_names} FROM delta ORDER BY {newest_first}"
+        conflict_clause = f"ON CONFLICT ({key}) {conflict_action(key, columns)}"
+    else:
+        candidates = f"SELECT {column_names} FROM delta"
+        conflict_clause = ""
+
+    # The watermark covers every candidate row, including the unchanged ones
+    newest = newest_mark_sql("candidates", columns[0]) if has_modified_ts else "SELECT NULL::timestamp, NULL::bigint"
+
+    result = TransferResult()
+    with dest_conn.cursor() as dest_cursor, stage("insert_select") as insert_stage:
+        dest_cursor.execute(f'''
+            WITH delta AS (
+                SELECT {column_names} FROM ({query}
+                ) AS q
+            ), candidates AS (
+                {candidates}
+            ), written AS (
+                INSERT INTO analytical_model.{table_name} AS t ({column_names})
+                SELECT {column_names} FROM candidates
+                {conflict_clause}
+                RETURNING (xmax = 0) AS inserted
+            ), counts AS (
+                {UPSERT_COUNTS}
+            ), newest AS (
+                {newest}
+            )
+            SELECT
+                (SELECT COUNT(*) FROM delta),
+                ({compact_ids_sql("candidates", columns[0])}),
+                newest.*,
+                counts.*
+            FROM counts LEFT JOIN newest ON true
+        ''')
+        row = dest_cursor.fetchone()
+        insert_stage.rows = row[0]
+
+    result.record_count, result.logged_ids, newest_ts, newest_id = row[:4]
+    result.add_counts(row[4:])
+    if newest_ts is not None:
+        result.add_high_water((newest_ts, newest_id))
+    return result
@@ -0,0 +1,607 @@
+"""
+Server-side valid-ID closure and set-based cleanse of analytical_model.
+
+The campaign -> tactic -> version -> offer closure is kept in persistent
+cached_valid_* tables on the destination and invalid rows are removed with
+anti-joins, so no ID lists travel to Python and back as giant NOT IN literals.
+The cache is keyed by the validated campaign list and the tactic and version
+watermarks and newest update_log entries: it is reused as is while they are
+unchanged, patched from the tactic and version IDs logged in update_log when
+only the watermarks or log moved, and rebuilt when the validated list changed.
+
+The incremental cleanse only re-validates rows recorded in update_log since
+the last cleanse, plus the rows that depend on them, and falls back to a full
+cleanse whenever validated_campaigns_02282025 has changed.
+"""
+import datetime
+import json
+
+from refresh.id_log import LOGGED_IDS_QUERY
+from refresh.metrics import stage
+from refresh.watermark import WATERMARK_TABLE
+
+VALIDATED_CAMPAIGNS_TABLE = "validated_campaigns_02282025"
+
+# Table to cleanse: (column checked, closure table holding the valid values).
+# Each closure table has a single column named like the checked column.
+CLEANSE_TARGETS = {
+    "campaign": ("id_campaign", "valid_campaign"),
+    "link": ("id_version", "valid_version"),
+    "offer": ("id_offer", "valid_offer"),
+    "tactic": ("id_tactic", "valid_tactic"),
+    "version": ("id_version", "valid_version"),
+    "treatment": ("id_version", "valid_version"),
+}
+
+# Valid IDs of each closure level, each level joining the cached level above it
+CLOSURE_QUERIES = {
+    "valid_campaign": '''
+        SELECT DISTINCT id_campaign
+        FROM {schema}.{validated}
+        WHERE id_campaign IS NOT NULL
+    ''',
+    "valid_tactic": '''
+        SELECT t.id_tactic, t.id_campaign
+        FROM {schema}.tactic t
+        JOIN {schema}.cached_valid_campaign c ON c.id_campaign = t.id_campaign
+    ''',
+    "valid_version": '''
+        SELECT v.id_version, v.id_tactic, v.id_offer
+        FROM {schema}.version v
+        JOIN {schema}.cached_valid_tactic t ON t.id_tactic = v.id_tactic
+    ''',
+    "valid_offer": '''
+        SELECT DISTINCT v.id_offer
+        FROM {schema}.cached_valid_version v
+        WHERE v.id_offer IS NOT NULL
+    ''',
+}
+
+CLOSURE_KEYS = {
+    "valid_campaign": "id_campaign",
+    "valid_tactic": "id_tactic",
+    "valid_version": "id_version",
+    "valid_offer": "id_offer",
+}
+
+# Persistent table caching each closure level, and its columns
+CLOSURE_CACHE_TABLES = {
+    "valid_campaign": ("cached_valid_campaign", "id_campaign bigint PRIMARY KEY"),
+    "valid_tactic": ("cached_valid_tactic", "id_tactic bigint PRIMARY KEY, id_campaign bigint"),
+    "valid_version": ("cached_valid_version", "id_version bigint PRIMARY KEY, id_tactic bigint, id_offer bigint"),
+    "valid_offer": ("cached_valid_offer", "id_offer bigint PRIMARY KEY"),
+}
+
+# Tables whose refreshes invalidate parts of the cache, via their watermarks and logged IDs
+CLOSURE_SOURCES = ("tactic", "version")
+
+# Offers that dropped out of the cached valid_offer level and are still to be re-validated
+# by an incremental cleanse; a version moving to another offer logs only the version
+DISPLACED_OFFER_TABLE = "displaced_offer"
+
+
+def ensure_valid_id_cache(cursor, schema="analytical_model"):
+    """
+    Creates the closure cache tables and their single-row state if missing.
+    """
+    for cache_table, columns in CLOSURE_CACHE_TABLES.values():
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{cache_table} ({columns})")
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS cached_valid_version_id_tactic_idx ON {schema}.cached_valid_version (id_tactic);
+        CREATE INDEX IF NOT EXISTS cached_valid_version_id_offer_idx ON {schema}.cached_valid_version (id_offer);
+
+        CREATE TABLE IF NOT EXISTS {schema}.{DISPLACED_OFFER_TABLE} (id_offer bigint PRIMARY KEY);
+
+        CREATE TABLE IF NOT EXISTS {schema}.valid_id_cache_state (
+            id int PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            validated_campaigns_md5 text NOT NULL,
+            source_watermarks text NOT NULL,
+            logged_through timestamp NOT NULL,
+            closure_counts text NOT NULL,
+            refresh_mode text NOT NULL,
+            updated_at timestamp NOT NULL
+        )
+    ''')
+
+
+def closure_cache_table(closure_table, schema="analytical_model"):
+    """
+    Qualified name of the persistent table caching closure_table.
+    """
+    return f"{schema}.{CLOSURE_CACHE_TABLES[closure_table][0]}"
+
+
+def _source_watermarks(cursor, schema, update_log_table="update_log"):
+    """
+    The closure sources' watermarks and newest update_log entries. A load can
+    change rows without moving a watermark (change capture re-reading a
+    version whose content group moved), but it is always logged.
+    """
+    cursor.execute(f'''
+        SELECT concat_ws(';',
+            (SELECT string_agg(table_name || '=' || watermark_ts || '/' || watermark_key, ',' ORDER BY table_name)
+             FROM {schema}.{WATERMARK_TABLE}
+             WHERE table_name = ANY(%(sources)s)),
+            (SELECT string_agg("table" || '@' || logged_through, ',' ORDER BY "table")
+             FROM (
+                 SELECT "table", MAX(ingest_end_ts) AS logged_through
+                 FROM {schema}.{update_log_table}
+                 WHERE "table" = ANY(%(sources)s)
+                 GROUP BY "table"
+             ) l))
+    ''', {"sources": list(CLOSURE_SOURCES)})
+    return cursor.fetchone()[0] or ""
+
+
+def _rebuild_valid_id_cache(cursor, schema):
+    """
+    Recomputes every cache level from the live tables. Returns {closure table: rows}.
+    """
+    _materialize_temp(cursor, "closure_offers",
+                      f"SELECT id_offer AS id FROM {closure_cache_table('valid_offer', schema)}", "id")
+    cursor.execute(f"TRUNCATE {', '.join(closure_cache_table(name, schema) for name in CLOSURE_CACHE_TABLES)}")
+    counts = {}
+    for closure_table, query in CLOSURE_QUERIES.items():
+        cursor.execute(f'''
+            INSERT INTO {closure_cache_table(closure_table, schema)}
+            {query.format(schema=schema, validated=VALIDATED_CAMPAIGNS_TABLE)}
+        ''')
+        counts[closure_table] = cursor.rowcount
+        # The next level's join and the cleanse anti-joins need fresh statistics
+        cursor.execute(f"ANALYZE {closure_cache_table(closure_table, schema)}")
+    _record_displaced_offers(cursor, schema)
+    return counts
+
+
+def _record_displaced_offers(cursor, schema):
+    """
+    Adds the offers of temp table closure_offers that are no longer in the
+    cached valid_offer level to DISPLACED_OFFER_TABLE.
+    """
+    cursor.execute(f'''
+        INSERT INTO {schema}.{DISPLACED_OFFER_TABLE} (id_offer)
+        SELECT s.id FROM closure_offers s
+        WHERE NOT EXISTS (SELECT 1 FROM {closure_cache_table("valid_offer", schema)} o WHERE o.id_offer = s.id)
+        ON CONFLICT DO NOTHING
+    ''')
+
+
+def _patch_valid_id_cache(cursor, counts, since, until, schema, update_log_table):
+    """
+    Re-derives the cache rows of tactics and versions logged in (since, until]
+    and of everything below them. Returns the updated {closure table: rows}.
+    """
+    counts = dict(counts)
+
+    def replace(closure_table, scope_join):
+        # Drop the scoped rows, then insert whatever of the scope is still valid
+        cache_table = closure_cache_table(closure_table, schema)
+        key = CLOSURE_KEYS[closure_table]
+        cursor.execute(f"DELETE FROM {cache_table} c USING {scope_join} WHERE c.{key} = s.id")
+        counts[closure_table] -= cursor.rowcount
+        cursor.execute(f'''
+            INSERT INTO {cache_table}
+            SELECT q.* FROM ({CLOSURE_QUERIES[closure_table].format(schema=schema, validated=VALIDATED_CAMPAIGNS_TABLE)}
+            ) q
+            JOIN {scope_join} ON s.id = q.{key}
+        ''')
+        counts[closure_table] += cursor.rowcount
+
+    _materialize_temp(cursor, "closure_touched", f'''
+        SELECT DISTINCT table_name, id
+        FROM ({LOGGED_IDS_QUERY.format(schema=schema, update_log_table=update_log_table)}) r
+        WHERE r.table_name = ANY(%s) AND r.ingest_end_ts > %s AND r.ingest_end_ts <= %s
+    ''', "table_name, id", (list(CLOSURE_SOURCES), since, until))
+
+    replace("valid_tactic", "(SELECT id FROM closure_touched WHERE table_name = 'tactic') s")
+
+    # Versions logged themselves, or under a logged tactic before or after the change
+    _materialize_temp(cursor, "closure_versions", f'''
+        SELECT id FROM closure_touched WHERE table_name = 'version'
+        UNION
+        SELECT v.id_version FROM {schema}.version v
+        JOIN closure_touched s ON s.table_name = 'tactic' AND s.id = v.id_tactic
+        UNION
+        SELECT c.id_version FROM {closure_cache_table("valid_version", schema)} c
+        JOIN closure_touched s ON s.table_name = 'tactic' AND s.id = c.id_tactic
+    ''', "id")
+
+    # Offers those versions pointed at before the change, or point at now
+    _materialize_temp(cursor, "closure_offers", f'''
+        SELECT c.id_offer AS id FROM {closure_cache_table("valid_version", schema)} c
+        JOIN closure_versions s ON s.id = c.id_version
+        WHERE c.id_offer IS NOT NULL
+        UNION
+        SELECT v.id_offer FROM {schema}.version v
+        JOIN closure_versions s ON s.id = v.id_version
+        WHERE v.id_offer IS NOT NULL
+    ''', "id")
+
+    replace("valid_version", "closure_versions s")
+    replace("valid_offer", "closure_offers s")
+    _record_displaced_offers(cursor, schema)
+    return counts
+
+
+def refresh_valid_id_cache(cursor, schema="analytical_model", update_log_table="update_log"):
+    """
+    Brings the closure cache up to date in the caller's transaction and
+    returns (mode, {closure table: rows}); mode is "cached", "incremental"
+    or "full".
+    """
+    ensure_valid_id_cache(cursor, schema)
+    fingerprint = validated_campaigns_fingerprint(cursor, schema)
+    watermarks = _source_watermarks(cursor, schema, update_log_table)
+
+    # Lock the state row so concurrent readers don't patch the cache twice
+    cursor.execute(f'''
+        SELECT validated_campaigns_md5, source_watermarks, logged_through, closure_counts
+        FROM {schema}.valid_id_cache_state WHERE id = 1
+        FOR UPDATE
+    ''')
+    state = cursor.fetchone()
+    if state is not None and state[0] == fingerprint and state[1] == watermarks:
+        return "cached", json.loads(state[3])
+
+    # Everything logged up to now is covered by this refresh
+    cursor.execute(f"SELECT MAX(ingest_end_ts) FROM {schema}.{update_log_table}")
+    log_high = cursor.fetchone()[0] or datetime.datetime(2000, 1, 1)
+
+    if state is None or state[0] != fingerprint:
+        mode = "full"
+        counts = _rebuild_valid_id_cache(cursor, schema)
+    else:
+        mode = "incremental"
+        counts = _patch_valid_id_cache(cursor, json.loads(state[3]), state[2], log_high, schema, update_log_table)
+
+    cursor.execute(f'''
+        INSERT INTO {schema}.valid_id_cache_state
+            (id, validated_campaigns_md5, source_watermarks, logged_through, closure_counts, refresh_mode, updated_at)
+        VALUES (1, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (id) DO UPDATE SET
+            validated_campaigns_md5 = EXCLUDED.validated_campaigns_md5,
+            source_watermarks = EXCLUDED.source_watermarks,
+            logged_through = EXCLUDED.logged_through,
+            closure_counts = EXCLUDED.closure_counts,
+            refresh_mode = EXCLUDED.refresh_mode,
+            updated_at = EXCLUDED.updated_at
+    ''', (fingerprint, watermarks, log_high, json.dumps(counts), mode, datetime.datetime.utcnow().replace(tzinfo=None)))
+    return mode, counts
+
+
+def invalidate_valid_id_cache(cursor, schema="analytical_model"):
+    """
+    Forces the next refresh_valid_id_cache to rebuild, for changes to tactic
+    or version that bypass update_log.
+    """
+    ensure_valid_id_cache(cursor, schema)
+    cursor.execute(f"DELETE FROM {schema}.valid_id_cache_state")
+
+
+def build_valid_id_closure(cursor, schema="analytical_model", update_log_table="update_log"):
+    """
+    Brings the persistent closure cache up to date (see refresh_valid_id_cache)
+    and returns {closure table: row count}. Read the IDs from
+    closure_cache_table(closure table).
+    """
+    mode, counts = refresh_valid_id_cache(cursor, schema, update_log_table)
+    print(f"Valid ID closure: {mode} ({', '.join(f'{name} {count}' for name, count in counts.items())})")
+    return counts
+
+
+def _materialize_temp(cursor, temp_table, query, key=None, params=None):
+    """
+    Replaces temp_table (dropped on commit) with the result of query, indexes
+    it on key and analyzes it. Returns the row count.
+    """
+    cursor.execute(f"DROP TABLE IF EXISTS pg_temp.{temp_table}")
+    cursor.execute(f"CREATE TEMP TABLE {temp_table} ON COMMIT DROP AS {query}", params)
+    count = cursor.rowcount
+    if key:
+        cursor.execute(f"ALTER TABLE {temp_table} ADD PRIMARY KEY ({key})")
+    # Temp tables are never auto-analyzed; the planner needs real row counts
+    # to pick a hash anti-join over the large targets
+    cursor.execute(f"ANALYZE {temp_table}")
+    return count
+
+
+def delete_invalid_records(cursor, closure_counts, schema="analytical_model"):
+    """
+    Deletes rows whose checked column has no match in its closure table.
+    Tables whose closure is empty are left alone, as are NULL values, the
+    same as the old NOT IN filter. Returns {table: rows deleted}.
+    """
+    deleted = {}
+    for table, (column, closure_table) in CLEANSE_TARGETS.items():
+        if not closure_counts.get(closure_table):
+            continue
+        cursor.execute(invalid_records_delete_sql(table, schema))
+        deleted[table] = cursor.rowcount
+    return deleted
+
+
+def invalid_records_delete_sql(table, schema="analytical_model"):
+    """
+    The full cleanse's anti-join DELETE for one CLEANSE_TARGETS table.
+    """
+    column, closure_table = CLEANSE_TARGETS[table]
+    return f'''
+        DELETE FROM {schema}.{table} t
+        WHERE t.{column} IS NOT NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM {closure_cache_table(closure_table, schema)} v
+              WHERE v.{column} = t.{column}
+          )
+    '''
+
+
+# Column of each table holding the ID its refresh logs in update_log.ids
+LOGGED_ID_COLUMNS = {
+    "campaign": "id_campaign",
+    "tactic": "id_tactic",
+    "version": "id_version",
+    "offer": "id_offer",
+    "link": "id_link",
+    "treatment": "id",
+}
+
+# Rows each table re-validates in an incremental cleanse, as logged IDs. Versions
+# of a touched tactic, and links, treatments and offers of a touched version are
+# pulled in as dependents, and so are the offers closure cache patches displaced.
+# Built in this order, so later scopes can use earlier ones.
+INCREMENTAL_SCOPES = {
+    "campaign": "SELECT id FROM touched_ids WHERE table_name = 'campaign'",
+    "tactic": "SELECT id FROM touched_ids WHERE table_name = 'tactic'",
+    "version": '''
+        SELECT id FROM touched_ids WHERE table_name = 'version'
+        UNION
+        SELECT v.id_version FROM {schema}.version v
+        JOIN touched_ids s ON s.table_name = 'tactic' AND s.id = v.id_tactic
+    ''',
+    "offer": '''
+        SELECT id FROM touched_ids WHERE table_name = 'offer'
+        UNION
+        SELECT v.id_offer FROM {schema}.version v
+        JOIN scope_version s ON s.id = v.id_version
+        WHERE v.id_offer IS NOT NULL
+        UNION
+        SELECT id_offer FROM {schema}.{displaced}
+    ''',
+    "link": '''
+        SELECT id FROM touched_ids WHERE table_name = 'link'
+        UNION
+        SELECT l.id_link FROM {schema}.link l
+        JOIN scope_version s ON s.id = l.id_version
+    ''',
+    "treatment": '''
+        SELECT id FROM touched_ids WHERE table_name = 'treatment'
+        UNION
+        SELECT tr.id FROM {schema}.treatment tr
+        JOIN scope_version s ON s.id = tr.id_version
+    ''',
+}
+
+# Whether row x of each table is valid, evaluated against the live tables.
+# Equivalent to membership in the closure cached by build_valid_id_closure.
+VALID_ROW_CHECKS = {
+    "campaign": "EXISTS (SELECT 1 FROM valid_campaign c WHERE c.id_campaign = x.id_campaign)",
+    "link": '''EXISTS (
+        SELECT 1 FROM {schema}.version v
+        JOIN {schema}.tactic t ON t.id_tactic = v.id_tactic
+        JOIN valid_campaign c ON c.id_campaign = t.id_campaign
+        WHERE v.id_version = x.id_version
+    )''',
+    "offer": '''EXISTS (
+        SELECT 1 FROM {schema}.version v
+        JOIN {schema}.tactic t ON t.id_tactic = v.id_tactic
+        JOIN valid_campaign c ON c.id_campaign = t.id_campaign
+        WHERE v.id_offer = x.id_offer
+    )''',
+    "tactic": "EXISTS (SELECT 1 FROM valid_campaign c WHERE c.id_campaign = x.id_campaign)",
+    "version": '''EXISTS (
+        SELECT 1 FROM {schema}.tactic t
+        JOIN valid_campaign c ON c.id_campaign = t.id_campaign
+        WHERE t.id_tactic = x.id_tactic
+    )''',
+    "treatment": '''EXISTS (
+        SELECT 1 FROM {schema}.version v
+        JOIN {schema}.tactic t ON t.id_tactic = v.id_tactic
+        JOIN valid_campaign c ON c.id_campaign = t.id_campaign
+        WHERE v.id_version = x.id_version
+    )''',
+}
+
+# Whether each closure is non-empty, without building it
+CLOSURE_NOT_EMPTY = {
+    "valid_campaign": "SELECT EXISTS (SELECT 1 FROM valid_campaign)",
+    "valid_tactic": '''
+        SELECT EXISTS (
+            SELECT 1 FROM {schema}.tactic t
+            JOIN valid_campaign c ON c.id_campaign = t.id_campaign
+        )
+    ''',
+    "valid_version": '''
+        SELECT EXISTS (
+            SELECT 1 FROM {schema}.version v
+            JOIN {schema}.tactic t ON t.id_tactic = v.id_tactic
+            JOIN valid_campaign c ON c.id_campaign = t.id_campaign
+        )
+    ''',
+    "valid_offer": '''
+        SELECT EXISTS (
+            SELECT 1 FROM {schema}.version v
+            JOIN {schema}.tactic t ON t.id_tactic = v.id_tactic
+            JOIN valid_campaign c ON c.id_campaign = t.id_campaign
+            WHERE v.id_offer IS NOT NULL
+        )
+    ''',
+}
+
+# Lookups the incremental scopes and checks rely on to stay proportional to the change
+CLEANSE_SUPPORT_INDEXES = {
+    "version_id_tactic_idx": ("version", "id_tactic"),
+    "version_id_offer_idx": ("version", "id_offer"),
+    "link_id_version_idx": ("link", "id_version"),
+    "treatment_id_version_idx": ("treatment", "id_version"),
+    "treatment_id_idx": ("treatment", "id"),
+    "update_log_ingest_end_ts_idx": ("update_log", "ingest_end_ts"),
+}
+
+
+def ensure_cleanse_state(cursor, schema="analytical_model"):
+    """
+    Creates the single-row cleanse checkpoint table and the supporting indexes
+    if they do not exist yet.
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.cleanse_state (
+            id int PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            cleansed_through timestamp,
+            validated_campaigns_md5 text,
+            cleanse_mode text,
+            updated_at timestamp
+        )
+    ''')
+    # Only touch tables that are missing an index, CREATE INDEX locks out writers
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = %s", (schema,))
+    existing = {row[0] for row in cursor.fetchall()}
+    for index_name, (table, column) in CLEANSE_SUPPORT_INDEXES.items():
+        if index_name not in existing:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {schema}.{table} ({column})")
+
+
+def validated_campaigns_fingerprint(cursor, schema="analytical_model"):
+    """
+    Returns an md5 over the distinct validated campaign IDs, used to tell
+    whether the validated list changed since the last cleanse.
+    """
+    cursor.execute(f'''
+        SELECT md5(COALESCE(string_agg(id_campaign::text, ',' ORDER BY id_campaign), ''))
+        FROM (SELECT DISTINCT id_campaign FROM {schema}.{VALIDATED_CAMPAIGNS_TABLE}) c
+    ''')
+    return cursor.fetchone()[0]
+
+
+def prepare_touched_scopes(cursor, since, until, schema="analytical_model", update_log_table="update_log"):
+    """
+    Materializes the temp tables an incremental cleanse of the refreshes
+    logged in (since, until] works from: valid_campaign, touched_ids and a
+    scope_<table> of logged IDs per table. Returns the CLEANSE_TARGETS
+    tables to re-validate, leaving out those whose closure is empty.
+
+    The closure cache is brought up to date first, so the offers that
+    touched versions moved away from are in DISPLACED_OFFER_TABLE.
+    """
+    build_valid_id_closure(cursor, schema, update_log_table)
+    _materialize_temp(cursor, "valid_campaign",
+                      CLOSURE_QUERIES["valid_campaign"].format(schema=schema, validated=VALIDATED_CAMPAIGNS_TABLE),
+                      CLOSURE_KEYS["valid_campaign"])
+
+    # Expand the logged ID runs of each upsert server-side
+    _materialize_temp(cursor, "touched_ids", f'''
+        SELECT DISTINCT table_name, id
+        FROM ({LOGGED_IDS_QUERY.format(schema=schema, update_log_table=update_log_table)}) r
+        WHERE r.ingest_end_ts > %s AND r.ingest_end_ts <= %s
+    ''', "table_name, id", (since, until))
+
+    for table, query in INCREMENTAL_SCOPES.items():
+        _materialize_temp(cursor, f"scope_{table}",
+                          f"SELECT DISTINCT id FROM ({query.format(schema=schema, displaced=DISPLACED_OFFER_TABLE)}) s",
+                          "id")
+
+    # Keep the full cleanse's rule of leaving a table alone when its closure is empty
+    not_empty = {}
+    for closure_table, query in CLOSURE_NOT_EMPTY.items():
+        cursor.execute(query.format(schema=schema))
+        not_empty[closure_table] = cursor.fetchone()[0]
+    return [table for table, (_, closure_table) in CLEANSE_TARGETS.items() if not_empty[closure_table]]
+
+
+def touched_records_delete_sql(table, schema="analytical_model"):
+    """
+    The incremental cleanse's DELETE for one CLEANSE_TARGETS table, over the
+    temp tables of prepare_touched_scopes.
+    """
+    column, _ = CLEANSE_TARGETS[table]
+    return f'''
+        DELETE FROM {schema}.{table} x
+        USING scope_{table} s
+        WHERE x.{LOGGED_ID_COLUMNS[table]} = s.id
+          AND x.{column} IS NOT NULL
+          AND NOT {VALID_ROW_CHECKS[table].format(schema=schema)}
+    '''
+
+
+def delete_invalid_touched(cursor, since, until, schema="analytical_model", update_log_table="update_log"):
+    """
+    Re-validates only the rows upserted by refreshes logged in
+    (since, until] and their dependents, and forgets the displaced offers
+    it re-validated. Returns {table: rows deleted}.
+    """
+    deleted = {}
+    for table in prepare_touched_scopes(cursor, since, until, schema, update_log_table):
+        cursor.execute(touched_records_delete_sql(table, schema))
+        deleted[table] = cursor.rowcount
+    cursor.execute(f"DELETE FROM {schema}.{DISPLACED_OFFER_TABLE} d USING scope_offer s WHERE d.id_offer = s.id")
+    return deleted
+
+
+def next_cleanse(cursor, full=False, schema="analytical_model", update_log_table="update_log"):
+    """
+    Decides what run_cleanse would do now, without changing anything.
+    Returns (mode, since, until, validated campaigns fingerprint): a full
+    cleanse has since None; an incremental one re-validates the refreshes
+    logged in (since, until], none when the two are equal. until is the
+    next checkpoint either way.
+    """
+    fingerprint = validated_campaigns_fingerprint(cursor, schema)
+    state = None
+    cursor.execute("SELECT to_regclass(%s)", (f"{schema}.cleanse_state",))
+    if cursor.fetchone()[0] is not None:
+        cursor.execute(f"SELECT cleansed_through, validated_campaigns_md5 FROM {schema}.cleanse_state WHERE id = 1")
+        state = cursor.fetchone()
+
+    # Everything logged up to now is covered by this cleanse
+    cursor.execute(f"SELECT MAX(ingest_end_ts) FROM {schema}.{update_log_table}")
+    log_high = cursor.fetchone()[0]
+
+    if full or state is None or state[0] is None or state[1] != fingerprint:
+        return "full", None, log_high or datetime.datetime(2000, 1, 1), fingerprint
+    if log_high is None or log_high <= state[0]:
+        return "incremental", state[0], state[0], fingerprint
+    return "incremental", state[0], log_high, fingerprint
+
+
+def run_cleanse(cursor, full=False, schema="analytical_model", update_log_table="update_log"):
+    """
+    Cleanses analytical_model and advances the cleanse checkpoint in the same
+    transaction; the caller commits. Runs incrementally unless full is set,
+    there is no checkpoint yet, or the validated campaign list changed.
+    Returns (mode, {table: rows deleted}).
+    """
+    ensure_cleanse_state(cursor, schema)
+    ensure_valid_id_cache(cursor, schema)
+    mode, since, until, fingerprint = next_cleanse(cursor, full, schema, update_log_table)
+
+    with stage("cleanse") as cleanse_stage:
+        if since is None:
+            closure_counts = build_valid_id_closure(cursor, schema, update_log_table)
+            deleted = delete_invalid_records(cursor, closure_counts, schema)
+            cursor.execute(f"DELETE FROM {schema}.{DISPLACED_OFFER_TABLE}")
+        elif since == until:
+            deleted = {}
+        else:
+            deleted = delete_invalid_touched(cursor, since, until, schema, update_log_table)
+        cleanse_stage.rows = sum(deleted.values())
+
+    cursor.execute(f'''
+        INSERT INTO {schema}.cleanse_state (id, cleansed_through, validated_campaigns_md5, cleanse_mode, updated_at)
+        VALUES (1, %s, %s, %s, %s)
+        ON CONFLICT (id) DO UPDATE SET
+            cleansed_through = EXCLUDED.cleansed_through,
+            validated_campaigns_md5 = EXCLUDED.validated_campaigns_md5,
+            cleanse_mode = EXCLUDED.cleanse_mode,
+            updated_at = EXCLUDED.updated_at
+    ''', (until, fingerprint, mode, datetime.datetime.utcnow().replace(tzinfo=None)))
+
+    return mode, deleted
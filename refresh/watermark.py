@@ -0,0 +1,98 @@
+"""
+Per-table watermark store for incremental extraction.
+
+Each table keeps one row in analytical_model.refresh_watermark holding the
+newest (modified_ts, key) pair it has loaded. Source queries select rows with
+(modified_ts, key) > (watermark_ts, watermark_key), so rows sharing the
+watermark timestamp are not dropped, and reads are a primary-key lookup
+instead of a MAX() scan over update_log.
+"""
+import datetime
+
+from refresh.statements import execute_prepared
+
+WATERMARK_TABLE = "refresh_watermark"
+
+# Starting point for a table that has never been loaded
+INITIAL_WATERMARK_TS = datetime.datetime(2000, 1, 1)
+INITIAL_WATERMARK_KEY = -9223372036854775808
+
+# Statement templates, formatted with schema, watermark_table and update_log_table
+STORED_WATERMARK_QUERY = '''
+    SELECT watermark_ts, watermark_key FROM {schema}.{watermark_table}
+    WHERE table_name = %s
+'''
+
+SEED_WATERMARK_QUERY = '''
+    SELECT MAX(ingest_start_ts) FROM {schema}.{update_log_table}
+    WHERE "table" = %s
+'''
+
+ADVANCE_WATERMARK = '''
+    INSERT INTO {schema}.{watermark_table} AS w (table_name, watermark_ts, watermark_key, updated_at)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (table_name) DO UPDATE SET
+        watermark_ts = EXCLUDED.watermark_ts,
+        watermark_key = EXCLUDED.watermark_key,
+        updated_at = EXCLUDED.updated_at
+    WHERE (w.watermark_ts, w.watermark_key) < (EXCLUDED.watermark_ts, EXCLUDED.watermark_key)
+'''
+
+
+def ensure_watermark_store(cursor, schema="analytical_model"):
+    """
+    Creates the watermark table if it does not exist yet.
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.{WATERMARK_TABLE} (
+            table_name text PRIMARY KEY,
+            watermark_ts timestamp NOT NULL,
+            watermark_key bigint NOT NULL,
+            updated_at timestamp NOT NULL
+        )
+    ''')
+
+
+def read_watermark(cursor, table_name, schema="analytical_model", update_log_table="update_log"):
+    """
+    Returns (watermark_ts, watermark_key) for table_name.
+
+    A table with no stored watermark is seeded once from the last
+    ingest_start_ts in update_log, so switching over does not reload
+    everything; with no history either, it starts from 2000-01-01.
+    """
+    execute_prepared(cursor, STORED_WATERMARK_QUERY.format(schema=schema, watermark_table=WATERMARK_TABLE),
+                     (table_name,))
+    row = cursor.fetchone()
+    if row is not None:
+        return row[0], row[1]
+
+    cursor.execute(SEED_WATERMARK_QUERY.format(schema=schema, update_log_table=update_log_table), (table_name,))
+    last_ingest_start_ts = cursor.fetchone()[0]
+    return last_ingest_start_ts or INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY
+
+
+def advance_watermark(cursor, table_name, watermark_ts, watermark_key, schema="analytical_model"):
+    """
+    Moves the table's watermark forward to (watermark_ts, watermark_key) in
+    the caller's transaction, so it commits atomically with the load. Never
+    moves a watermark backwards.
+    """
+    execute_prepared(cursor, ADVANCE_WATERMARK.format(schema=schema, watermark_table=WATERMARK_TABLE),
+                     (table_name, watermark_ts, watermark_key, datetime.datetime.utcnow().replace(tzinfo=None)))
+
+
+def watermark_params(watermark_ts, watermark_key):
+    """
+    Query parameters for the (modified_ts, key) > (watermark) filter.
+    """
+    return {"watermark_ts": watermark_ts, "watermark_key": watermark_key}
+
+
+def high_water_mark(rows, columns, watermark_column="modified_ts"):
+    """
+    Returns the largest (watermark_column, row[0]) pair in rows, or None.
+    """
+    ts_index = columns.index(watermark_column)
+    marks = [(row[ts_index], row[0]) for row in rows if row[ts_index] is not None and row[0] is not None]
+    return max(marks) if marks else None
@@ -0,0 +1,55 @@
+"""
+Fixtures for the tests that run against the Postgres in REFRESH_TEST_DSN.
+
+The synthetic fixtures drop and recreate analytical_model, bench_source and
+public.treatment_placement_versions there, so REFRESH_TEST_DSN must point
+at a throwaway database. Tests using them are skipped when it is not set.
+"""
+import os
+
+import pytest
+
+SYNTHETIC_VERSIONS = 2000
+
+
+@pytest.fixture
+def test_dsn():
+    dsn = os.environ.get("REFRESH_TEST_DSN")
+    if not dsn:
+        pytest.skip("REFRESH_TEST_DSN is not set")
+    pytest.importorskip("psycopg2")
+    return dsn
+
+
+@pytest.fixture
+def synthetic(test_dsn):
+    """
+    Builds the synthetic source and destination schemas in the test
+    database and yields (source pool, destination pool, connection). The
+    source is the same database, as with a single --dsn in the benchmarks.
+    """
+    import psycopg2
+
+    from benchmarks.bench_refresh import bench_pool
+    from benchmarks.synthetic import create_destination, create_source, drop_all
+    from refresh.engine import ensure_refresh_stores
+
+    conn = psycopg2.connect(test_dsn)
+    with conn.cursor() as cursor:
+        create_source(cursor, SYNTHETIC_VERSIONS)
+        create_destination(cursor, SYNTHETIC_VERSIONS)
+        ensure_refresh_stores(cursor)
+    conn.commit()
+
+    source_pool = bench_pool(test_dsn, "source")
+    dest_pool = bench_pool(test_dsn, "dest")
+    try:
+        yield source_pool, dest_pool, conn
+    finally:
+        source_pool.closeall()
+        dest_pool.closeall()
+        conn.rollback()
+        with conn.cursor() as cursor:
+            drop_all(cursor, cursor)
+        conn.commit()
+        conn.close()
@@ -0,0 +1,78 @@
+"""
+The chunked first load against the synthetic schemas: a backfill that fails
+part way resumes with the chunks that are still open and ends with what a
+single pass would have loaded.
+
+Runs against the Postgres in REFRESH_TEST_DSN (see conftest.py).
+"""
+import pytest
+
+import refresh.backfill
+from refresh.backfill import key_range_params
+from refresh.engine import RefreshOptions, refresh_table
+from refresh.partitioned import partition_params
+from refresh.tables import TABLE_SPECS
+from refresh.watermark import INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, watermark_params
+
+SPECS = {spec.name: spec for spec in TABLE_SPECS}
+
+
+def chunk_states(cursor, table_name):
+    cursor.execute('''
+        SELECT chunk_no, finished_at IS NOT NULL FROM analytical_model.refresh_backfill_chunk
+        WHERE table_name = %s ORDER BY chunk_no
+    ''', (table_name,))
+    return dict(cursor.fetchall())
+
+
+def test_backfill_resumes_after_failed_chunk(synthetic, monkeypatch):
+    source_pool, dest_pool, conn = synthetic
+    spec = SPECS["version"]
+    options = RefreshOptions(backfill_chunk_size=300)
+    load_chunk = refresh.backfill.load_chunk
+    loaded = []
+    failing = {3}
+
+    def recording_load_chunk(spec, chunk, *args, **kwargs):
+        if chunk[0] in failing:
+            raise RuntimeError(f"chunk {chunk[0]} interrupted")
+        loaded.append(chunk[0])
+        return load_chunk(spec, chunk, *args, **kwargs)
+
+    monkeypatch.setattr(refresh.backfill, "load_chunk", recording_load_chunk)
+    with pytest.raises(RuntimeError):
+        refresh_table(spec, source_pool, dest_pool, options)
+
+    with conn.cursor() as cursor:
+        states = chunk_states(cursor, spec.name)
+        cursor.execute("SELECT finished_at FROM analytical_model.refresh_backfill WHERE table_name = %s",
+                       (spec.name,))
+        assert cursor.fetchone() == (None,)
+        cursor.execute("SELECT COUNT(*) FROM analytical_model.refresh_watermark WHERE table_name = %s",
+                       (spec.name,))
+        assert cursor.fetchone()[0] == 0
+    conn.commit()
+    assert len(states) > 4
+    assert not states[3]
+    assert [chunk_no for chunk_no, finished in states.items() if finished] == loaded
+
+    loaded.clear()
+    failing.clear()
+    refresh_table(spec, source_pool, dest_pool, options)
+    assert loaded == [chunk_no for chunk_no, finished in states.items() if not finished]
+
+    with source_pool.connection() as source_conn, source_conn.cursor() as source_cursor:
+        source_cursor.execute(spec.query, {**watermark_params(INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY),
+                                           **key_range_params(), **partition_params(), "excluded_tactic_ids": []})
+        source_keys = sorted(row[0] for row in source_cursor.fetchall())
+        source_conn.commit()
+    with conn.cursor() as cursor:
+        assert set(chunk_states(cursor, spec.name).values()) == {True}
+        cursor.execute("SELECT id_version FROM analytical_model.version ORDER BY id_version")
+        assert [row[0] for row in cursor.fetchall()] == source_keys
+        cursor.execute("SELECT SUM(count) FROM analytical_model.update_log WHERE \"table\" = %s", (spec.name,))
+        assert cursor.fetchone()[0] == len(source_keys)
+        cursor.execute("SELECT COUNT(*) FROM analytical_model.refresh_watermark WHERE table_name = %s",
+                       (spec.name,))
+        assert cursor.fetchone()[0] == 1
+    conn.rollback()
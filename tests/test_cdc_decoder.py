@@ -0,0 +1,135 @@
+"""
+PgOutputDecoder against hand-built pgoutput protocol version 1 messages.
+"""
+import struct
+
+import pytest
+
+from refresh.cdc import PgOutputDecoder
+
+
+def string(text):
+    return text.encode() + b"\0"
+
+
+def relation(relid, table, columns, schema="public"):
+    payload = b"R" + struct.pack("!i", relid) + string(schema) + string(table) + b"d" + struct.pack("!h", len(columns))
+    for index, name in enumerate(columns):
+        # Key flag, name, type oid (int8) and type modifier
+        payload += struct.pack("!b", 1 if index == 0 else 0) + string(name) + struct.pack("!ii", 20, -1)
+    return payload
+
+
+def tuple_data(*values):
+    """
+    None is a null column, ... an unchanged TOASTed one, anything else a text value.
+    """
+    payload = struct.pack("!h", len(values))
+    for value in values:
+        if value is None:
+            payload += b"n"
+        elif value is ...:
+            payload += b"u"
+        else:
+            data = str(value).encode()
+            payload += b"t" + struct.pack("!i", len(data)) + data
+    return payload
+
+
+@pytest.fixture
+def decoder():
+    decoder = PgOutputDecoder()
+    assert decoder.decode(relation(16401, "paign_placement_version", ["id", "tactic_id", "name"])) is None
+    assert decoder.decode(relation(16402, "cf_modules", ["id", "content_group_id"])) is None
+    return decoder
+
+
+def test_relation(decoder):
+    assert decoder.relations == {
+        16401: ("paign_placement_version", ["id", "tactic_id", "name"]),
+        16402: ("cf_modules", ["id", "content_group_id"]),
+    }
+
+
+def test_relation_replaces_an_earlier_one(decoder):
+    # Sent again after an ALTER TABLE, before the next row of that relation
+    decoder.decode(relation(16402, "cf_modules", ["id", "content_group_id", "name"]))
+    message = b"I" + struct.pack("!i", 16402) + b"N" + tuple_data(3, 4, "hero")
+    assert decoder.decode(message) == ("I", "cf_modules", {"id": "3", "content_group_id": "4", "name": "hero"}, None)
+
+
+def test_begin_and_commit(decoder):
+    begin = b"B" + struct.pack("!qqi", 0x16B3748, 0, 731)
+    assert decoder.decode(begin) == ("begin",)
+    commit = b"C" + struct.pack("!bqqq", 0, 0x16B3748, 0x16B3780, 0)
+    assert decoder.decode(commit) == ("commit", 0x16B3780)
+
+
+def test_insert(decoder):
+    message = b"I" + struct.pack("!i", 16401) + b"N" + tuple_data(7, 12, "Spring banner")
+    assert decoder.decode(message) == ("I", "paign_placement_version",
+                                       {"id": "7", "tactic_id": "12", "name": "Spring banner"}, None)
+
+
+def test_insert_null_and_utf8(decoder):
+    message = b"I" + struct.pack("!i", 16401) + b"N" + tuple_data(8, None, "Café — été")
+    assert decoder.decode(message) == ("I", "paign_placement_version",
+                                       {"id": "8", "tactic_id": None, "name": "Café — été"}, None)
+
+
+def test_update_without_old_row(decoder):
+    message = b"U" + struct.pack("!i", 16401) + b"N" + tuple_data(7, 12, "Renamed")
+    assert decoder.decode(message) == ("U", "paign_placement_version",
+                                       {"id": "7", "tactic_id": "12", "name": "Renamed"}, None)
+
+
+def test_update_with_key(decoder):
+    # The replica identity changed: K carries the old key columns, the rest are null
+    message = (b"U" + struct.pack("!i", 16401) + b"K" + tuple_data(7, None, None)
+               + b"N" + tuple_data(70, 12, "Renamed"))
+    assert decoder.decode(message) == ("U", "paign_placement_version",
+                                       {"id": "70", "tactic_id": "12", "name": "Renamed"},
+                                       {"id": "7", "tactic_id": None, "name": None})
+
+
+def test_update_with_old_row(decoder):
+    # REPLICA IDENTITY FULL sends the whole old row
+    message = (b"U" + struct.pack("!i", 16402) + b"O" + tuple_data(3, 4)
+               + b"N" + tuple_data(3, 5))
+    assert decoder.decode(message) == ("U", "cf_modules", {"id": "3", "content_group_id": "5"},
+                                       {"id": "3", "content_group_id": "4"})
+
+
+def test_update_unchanged_toast(decoder):
+    message = b"U" + struct.pack("!i", 16401) + b"N" + tuple_data(7, 13, ...)
+    assert decoder.decode(message) == ("U", "paign_placement_version", {"id": "7", "tactic_id": "13"}, None)
+
+
+def test_delete_with_key(decoder):
+    message = b"D" + struct.pack("!i", 16401) + b"K" + tuple_data(7, None, None)
+    assert decoder.decode(message) == ("D", "paign_placement_version", None,
+                                       {"id": "7", "tactic_id": None, "name": None})
+
+
+def test_delete_with_old_row(decoder):
+    message = b"D" + struct.pack("!i", 16402) + b"O" + tuple_data(3, 4)
+    assert decoder.decode(message) == ("D", "cf_modules", None, {"id": "3", "content_group_id": "4"})
+
+
+def test_truncate(decoder):
+    message = b"T" + struct.pack("!ib", 2, 1) + struct.pack("!ii", 16402, 16401)
+    assert decoder.decode(message) == ("truncate", ["cf_modules", "paign_placement_version"])
+
+
+def test_truncate_one_relation(decoder):
+    message = b"T" + struct.pack("!ib", 1, 0) + struct.pack("!i", 16401)
+    assert decoder.decode(message) == ("truncate", ["paign_placement_version"])
+
+
+@pytest.mark.parametrize("message", [
+    b"Y" + struct.pack("!i", 25) + string("public") + string("text"),
+    b"O" + struct.pack("!q", 0) + string("origin"),
+    b"M" + struct.pack("!bq", 1, 0) + string("prefix") + struct.pack("!i", 0),
+])
+def test_other_messages_are_ignored(decoder, message):
+    assert decoder.decode(message) is None
@@ -0,0 +1,84 @@
+"""
+The incremental cleanse against the synthetic schemas: after a refresh it
+leaves the model exactly as a full cleanse would, including an offer
+orphaned by its only valid version moving to another offer.
+
+Runs against the Postgres in REFRESH_TEST_DSN (see conftest.py).
+"""
+import pytest
+
+from benchmarks.synthetic import SOURCE_SCHEMA, touch_source
+from refresh.engine import RefreshOptions, refresh_table
+from refresh.tables import TABLE_SPECS
+from refresh.validation import CLEANSE_TARGETS, build_valid_id_closure, run_cleanse
+
+
+def refresh_all(source_pool, dest_pool):
+    for spec in TABLE_SPECS:
+        refresh_table(spec, source_pool, dest_pool, RefreshOptions())
+
+
+def snapshot(cursor):
+    tables = {}
+    for table in CLEANSE_TARGETS:
+        cursor.execute(f"SELECT * FROM analytical_model.{table}")
+        tables[table] = sorted(cursor.fetchall(), key=repr)
+    return tables
+
+
+def move_version_to_new_offer(cursor, id_version, id_offer):
+    """
+    Points id_version at a new offer of its own, through a new content group
+    and module.
+    """
+    cursor.execute(f'''
+        INSERT INTO {SOURCE_SCHEMA}.paign_default_offer
+        SELECT %(offer)s, 'Offer ' || %(offer)s, 'Moved', offer_type, value_amount, value_amount_type,
+               value_amount_type_id, current_status, actual_start_dt, actual_end_dt, created_dt, LOCALTIMESTAMP
+        FROM {SOURCE_SCHEMA}.paign_default_offer WHERE id = 1;
+        INSERT INTO {SOURCE_SCHEMA}.cf_content_group VALUES (%(offer)s, %(offer)s);
+        INSERT INTO {SOURCE_SCHEMA}.cf_modules VALUES (%(offer)s, %(offer)s);
+        UPDATE {SOURCE_SCHEMA}.paign_placement_version
+        SET module_id = %(offer)s, update_dt = LOCALTIMESTAMP
+        WHERE id = %(version)s;
+    ''', {"offer": id_offer, "version": id_version})
+
+
+@pytest.mark.parametrize("patch_cache", [False, True], ids=["cache_unpatched", "cache_patched"])
+def test_incremental_matches_full(synthetic, patch_cache):
+    source_pool, dest_pool, conn = synthetic
+    refresh_all(source_pool, dest_pool)
+    with conn.cursor() as cursor:
+        assert run_cleanse(cursor)[0] == "full"
+        cursor.execute("SELECT MIN(id_version) FROM analytical_model.version")
+        id_version = cursor.fetchone()[0]
+        move_version_to_new_offer(cursor, id_version, 900001)
+    conn.commit()
+    refresh_all(source_pool, dest_pool)
+    with conn.cursor() as cursor:
+        assert run_cleanse(cursor)[0] == "incremental"
+        cursor.execute("SELECT COUNT(*) FROM analytical_model.offer WHERE id_offer = 900001")
+        assert cursor.fetchone()[0] == 1
+
+        # Offer 900001 is orphaned by the move, and the rest of the source changes as usual
+        move_version_to_new_offer(cursor, id_version, 900002)
+        touch_source(cursor, cursor, 2000)
+    conn.commit()
+    refresh_all(source_pool, dest_pool)
+    if patch_cache:
+        with conn.cursor() as cursor:
+            build_valid_id_closure(cursor)
+        conn.commit()
+
+    with conn.cursor() as cursor:
+        assert run_cleanse(cursor)[0] == "incremental"
+        incremental = snapshot(cursor)
+    conn.rollback()
+    with conn.cursor() as cursor:
+        assert run_cleanse(cursor, full=True)[0] == "full"
+        full = snapshot(cursor)
+    conn.rollback()
+
+    assert 900001 not in {row[0] for row in full["offer"]}
+    assert 900002 in {row[0] for row in full["offer"]}
+    assert incremental == full
@@ -0,0 +1,46 @@
+"""
+RefreshDaemon scheduling: TableSchedule.record backs an idle or failing
+table off towards max_interval and drops back to its interval once rows
+arrive.
+"""
+import pytest
+
+from refresh import daemon
+from refresh.daemon import TableSchedule
+
+
+@pytest.fixture
+def schedule(monkeypatch):
+    monkeypatch.setattr(daemon.time, "monotonic", lambda: 1000.0)
+    return TableSchedule(spec=None, interval=10.0, max_interval=100.0, backoff=3.0)
+
+
+def test_empty_polls_back_off_to_max_interval(schedule):
+    waits = []
+    for _ in range(5):
+        schedule.record(0)
+        waits.append(schedule.wait)
+    assert waits == [30.0, 90.0, 100.0, 100.0, 100.0]
+    assert schedule.next_run == 1100.0
+    assert (schedule.polls, schedule.empty_polls, schedule.failures, schedule.rows) == (5, 5, 0, 0)
+
+
+def test_rows_reset_the_interval(schedule):
+    schedule.record(0)
+    schedule.record(0)
+    schedule.record(25)
+    assert schedule.wait == 10.0
+    assert schedule.next_run == 1010.0
+    schedule.record(0)
+    assert schedule.wait == 30.0
+    assert (schedule.polls, schedule.empty_polls, schedule.rows) == (4, 3, 25)
+
+
+def test_failures_back_off_like_empty_polls(schedule):
+    schedule.record(None, failed=True)
+    schedule.record(None, failed=True)
+    assert schedule.wait == 90.0
+    assert (schedule.failures, schedule.empty_polls) == (2, 0)
+    schedule.record(4)
+    assert schedule.wait == 10.0
+    assert (schedule.polls, schedule.failures, schedule.rows) == (3, 2, 4)
@@ -0,0 +1,53 @@
+"""
+dry_run_refresh against the synthetic schemas: it plans the cleanse
+run_cleanse would run and leaves both databases as they were.
+
+Runs against the Postgres in REFRESH_TEST_DSN (see conftest.py).
+"""
+from benchmarks.synthetic import touch_source
+from refresh.dry_run import dry_run_refresh
+from refresh.engine import RefreshOptions, refresh_table
+from refresh.tables import TABLE_SPECS
+from refresh.validation import run_cleanse
+
+
+def cleanse_state(cursor):
+    cursor.execute("SELECT cleansed_through, cleanse_mode FROM analytical_model.cleanse_state")
+    return cursor.fetchall()
+
+
+def test_dry_run_plans_the_incremental_cleanse(synthetic, tmp_path):
+    source_pool, dest_pool, conn = synthetic
+    options = RefreshOptions()
+    for spec in TABLE_SPECS:
+        refresh_table(spec, source_pool, dest_pool, options)
+    with conn.cursor() as cursor:
+        run_cleanse(cursor)
+    conn.commit()
+
+    reports = dry_run_refresh(TABLE_SPECS, source_pool, dest_pool, options, plan_dir=str(tmp_path))
+    assert [report["mode"] for report in reports] == ["incremental"] * len(TABLE_SPECS)
+
+    with conn.cursor() as cursor:
+        touch_source(cursor, cursor, 2000)
+    conn.commit()
+    for spec in TABLE_SPECS:
+        refresh_table(spec, source_pool, dest_pool, options)
+    with conn.cursor() as cursor:
+        state = cleanse_state(cursor)
+    conn.commit()
+
+    reports = dry_run_refresh(TABLE_SPECS, source_pool, dest_pool, options, plan_dir=str(tmp_path))
+    cleanse_reports = [report for report in reports if report["name"].startswith("cleanse")]
+    assert cleanse_reports
+    assert {report["mode"] for report in cleanse_reports} == {"incremental cleanse"}
+
+    reports = dry_run_refresh(TABLE_SPECS, source_pool, dest_pool, options, plan_dir=str(tmp_path),
+                              full_cleanse=True)
+    assert {report["mode"] for report in reports if report["name"].startswith("cleanse")} == {"cleanse"}
+
+    # The incremental cleanse the dry run planned is still to be run
+    with conn.cursor() as cursor:
+        assert cleanse_state(cursor) == state
+        assert run_cleanse(cursor)[0] == "incremental"
+    conn.rollback()
@@ -0,0 +1,76 @@
+"""
+update_log.ids format: compact_ids, expand_ids and compact_ids_sql round trips.
+
+The compact_ids_sql tests run against the Postgres in REFRESH_TEST_DSN and
+are skipped when it is not set.
+"""
+import os
+import random
+
+import pytest
+
+from refresh.id_log import compact_ids, compact_ids_sql, expand_ids, format_runs, id_runs, merge_runs
+
+
+@pytest.mark.parametrize("ids, logged", [
+    ([], ""),
+    ([7], "7"),
+    ([1, 2, 3], "1:3"),
+    ([5, 1, 2, 2, 3, 9, 10, 12], "1:3,5,9:10,12"),
+    ([-3, -2, -1, 0, 1, 4], "-3:1,4"),
+    ([-10, -8], "-10,-8"),
+])
+def test_compact_ids(ids, logged):
+    assert compact_ids(ids) == logged
+    assert expand_ids(logged) == sorted(set(ids))
+
+
+def test_expand_old_format():
+    # Rows logged before range compression hold ", "-joined IDs, in load order
+    assert expand_ids("12, 3, 4, 5") == [3, 4, 5, 12]
+    assert expand_ids("-4, 7") == [-4, 7]
+    assert expand_ids("1:3, 5") == [1, 2, 3, 5]
+    assert expand_ids("") == []
+    assert expand_ids(None) == []
+
+
+def test_round_trip_random():
+    generator = random.Random(9)
+    for _ in range(500):
+        ids = [generator.randint(-50, 50) for _ in range(generator.randint(0, 80))]
+        assert expand_ids(compact_ids(ids)) == sorted(set(ids))
+
+
+def test_merged_batches_match_one_pass():
+    generator = random.Random(11)
+    for _ in range(500):
+        ids = [generator.randint(-50, 50) for _ in range(generator.randint(0, 80))]
+        runs = []
+        for start in range(0, len(ids), 9):
+            runs = merge_runs(runs, id_runs(ids[start:start + 9]))
+        assert format_runs(runs) == compact_ids(ids)
+
+
+@pytest.fixture
+def cursor():
+    dsn = os.environ.get("REFRESH_TEST_DSN")
+    if not dsn:
+        pytest.skip("REFRESH_TEST_DSN is not set")
+    psycopg2 = pytest.importorskip("psycopg2")
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE loaded (id bigint)")
+            yield cursor
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@pytest.mark.parametrize("ids", [[], [7], [5, 1, 2, 2, 3, 9, 10, 12], [-3, -2, -1, 0, 1, 4, None]])
+def test_compact_ids_sql(cursor, ids):
+    cursor.executemany("INSERT INTO loaded VALUES (%s)", [(value,) for value in ids])
+    cursor.execute(compact_ids_sql("loaded", "id"))
+    logged = cursor.fetchone()[0]
+    assert logged == compact_ids(value for value in ids if value is not None)
+    assert expand_ids(logged) == sorted({value for value in ids if value is not None})
@@ -0,0 +1,54 @@
+"""
+rebuild_table against the synthetic schemas: rows added to the source since
+the closure cache was built survive the rebuild when they are valid.
+
+Runs against the Postgres in REFRESH_TEST_DSN (see conftest.py).
+"""
+import pytest
+
+from benchmarks.synthetic import SOURCE_SCHEMA
+from refresh.engine import RefreshOptions, refresh_table
+from refresh.rebuild import rebuild_table
+from refresh.tables import TABLE_SPECS
+from refresh.validation import build_valid_id_closure
+
+SPECS = {spec.name: spec for spec in TABLE_SPECS}
+
+
+@pytest.mark.parametrize("options", [
+    RefreshOptions(),
+    RefreshOptions(server_side=False, pipe=False),
+    RefreshOptions(server_side=False),
+], ids=["insert_select", "stream", "pipe"])
+def test_rebuild_keeps_new_valid_tactic(synthetic, options):
+    source_pool, dest_pool, conn = synthetic
+    for spec in TABLE_SPECS:
+        refresh_table(spec, source_pool, dest_pool, options)
+    with conn.cursor() as cursor:
+        build_valid_id_closure(cursor)
+        # New copies of tactic 1 under campaign 1, which is validated, and campaign 7, which is not
+        cursor.execute(f'''
+            INSERT INTO {SOURCE_SCHEMA}.paign_default_tactic
+            SELECT 100000 + c.campaign_id, c.campaign_id, audience_criteria, brand_name, name, actual_start_dt,
+                   actual_end_dt, tactic_type, planned_start_dt, planned_end_dt, created_dt, LOCALTIMESTAMP
+            FROM {SOURCE_SCHEMA}.paign_default_tactic
+            CROSS JOIN (VALUES (1::int8), (7::int8)) c (campaign_id)
+            WHERE id = 1
+        ''')
+    conn.commit()
+
+    extracted, loaded = rebuild_table(SPECS["tactic"], source_pool, dest_pool, options)
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id_campaign FROM analytical_model.tactic WHERE id_tactic IN (100001, 100007)")
+        assert cursor.fetchall() == [(1,)]
+        cursor.execute(f'''
+            SELECT COUNT(*) FROM {SOURCE_SCHEMA}.paign_default_tactic t
+            WHERE t.campaign_id IN (SELECT id_campaign FROM analytical_model.validated_campaigns_02282025)
+        ''')
+        assert cursor.fetchone()[0] == loaded
+        cursor.execute("SELECT COUNT(*), COUNT(DISTINCT id_tactic) FROM analytical_model.tactic")
+        assert cursor.fetchone() == (loaded, loaded)
+        cursor.execute(f"SELECT COUNT(*) FROM {SOURCE_SCHEMA}.paign_default_tactic")
+        assert cursor.fetchone()[0] == extracted
+    conn.rollback()
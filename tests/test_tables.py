@@ -0,0 +1,74 @@
+"""
+Table spec queries against the synthetic source: parallel slices return
+what a single stream does, version is never sliced, and excluded tactics
+are not numbered.
+
+The query tests run against the Postgres in REFRESH_TEST_DSN (see
+conftest.py).
+"""
+import pytest
+
+from benchmarks.synthetic import SOURCE_SCHEMA
+from refresh.backfill import key_range_params
+from refresh.engine import RefreshOptions, refresh_table
+from refresh.partitioned import partition_params, slice_count
+from refresh.tables import TABLE_SPECS
+from refresh.watermark import INITIAL_WATERMARK_KEY, INITIAL_WATERMARK_TS, watermark_params
+
+SPECS = {spec.name: spec for spec in TABLE_SPECS}
+
+
+def query_rows(cursor, spec, excluded_tactic_ids=(), partition_no=None, partition_count=None):
+    params = {**watermark_params(INITIAL_WATERMARK_TS, INITIAL_WATERMARK_KEY), **key_range_params(),
+              **partition_params(partition_no, partition_count), "excluded_tactic_ids": list(excluded_tactic_ids)}
+    cursor.execute(spec.query, params)
+    return cursor.fetchall()
+
+
+@pytest.fixture
+def cursor(synthetic):
+    _, _, conn = synthetic
+    with conn.cursor() as cursor:
+        cursor.execute(f"SET search_path = {SOURCE_SCHEMA}, public")
+        # Versions in several segments, in a NULL segment and in none
+        cursor.execute('''
+            INSERT INTO audience_segment_placement_versions
+            SELECT audiencesegment_id + 7, placementversion_id FROM audience_segment_placement_versions
+            WHERE placementversion_id % 5 = 0;
+            INSERT INTO audience_segment_placement_versions
+            SELECT NULL, placementversion_id FROM audience_segment_placement_versions
+            WHERE placementversion_id % 11 = 0;
+            DELETE FROM audience_segment_placement_versions WHERE placementversion_id % 13 = 0;
+        ''')
+        yield cursor
+    conn.rollback()
+
+
+@pytest.mark.parametrize("name", [spec.name for spec in TABLE_SPECS if spec.partitionable])
+@pytest.mark.parametrize("partition_count", [2, 5])
+def test_slices_match_single_stream(cursor, name, partition_count):
+    spec = SPECS[name]
+    sliced = []
+    for partition_no in range(partition_count):
+        sliced += query_rows(cursor, spec, partition_no=partition_no, partition_count=partition_count)
+    assert sorted(sliced) == sorted(query_rows(cursor, spec))
+
+
+def test_version_is_not_sliced():
+    assert slice_count(SPECS["version"], {"version": 1, "link": 4}) == 1
+    assert slice_count(SPECS["link"], {"version": 1, "link": 4}) == 4
+    with pytest.raises(ValueError):
+        slice_count(SPECS["version"], {"version": 4})
+
+
+def test_refresh_rejects_sliced_version(synthetic):
+    source_pool, dest_pool, _ = synthetic
+    with pytest.raises(ValueError):
+        refresh_table(SPECS["version"], source_pool, dest_pool,
+                      RefreshOptions(backfill_chunk_size=0, partitions={"version": 4}))
+
+
+def test_excluded_tactics_are_not_numbered(cursor):
+    excluded = query_rows(cursor, SPECS["version"], [3, 4])
+    cursor.execute("DELETE FROM paign_placement_version WHERE tactic_id IN (3, 4) OR tactic_id IS NULL")
+    assert sorted(excluded) == sorted(query_rows(cursor, SPECS["version"]))